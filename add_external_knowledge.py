@@ -2,236 +2,166 @@
 外部ナレッジをデータベースに追加するスクリプト
 
 使用方法:
-    python add_external_knowledge.py
+    python add_external_knowledge.py                                  # 既定の介護業界ナレッジファイルを取り込む
+    python add_external_knowledge.py docs/knowledge --industry 宿泊   # ディレクトリ以下の *.md をすべて取り込む
+    python add_external_knowledge.py docs/a.md docs/b.md --workers 4 --verbose
 
 機能:
 - external_knowledge テーブルを作成（存在しない場合）
-- Markdownファイルからナレッジを抽出してデータベースに挿入
+- 指定したファイル・ディレクトリ（サブディレクトリを含む）のMarkdownをセクションに分割してナレッジを抽出
+- ソースファイル名は管理画面のアップロードと同じくファイル名（同名のファイルが複数ある場合はエラー）
+- 分割とキーワード抽出（事前にコンパイルした複数キーワードの一括検索）はプロセスプールで並列に行う
+- 前回から変わったセクションだけを、ファイルごとに1つのトランザクションでまとめて追加・更新・削除
+- 処理件数とスループット（セクション/秒）を表示
 """
 
-import sqlite3
+import argparse
 import os
 import sys
-import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 # Windows環境での日本語出力対応
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
 
-
-def create_external_knowledge_table(cursor):
-    """外部ナレッジテーブルを作成"""
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS external_knowledge (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        industry_id INTEGER,
-        title TEXT NOT NULL,
-        content TEXT NOT NULL,
-        source_file TEXT,
-        section TEXT,
-        keywords TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (industry_id) REFERENCES industries (id)
-    )
-    ''')
-    print("✅ external_knowledge テーブルを作成/確認しました")
+import app as lms
 
 
-def get_industry_id(cursor, industry_name):
+def get_industry_id(db, industry_name):
     """業種名からIDを取得"""
-    result = cursor.execute(
-        'SELECT id FROM industries WHERE name = ?', 
+    result = db.execute(
+        'SELECT id FROM industries WHERE name = ?',
         (industry_name,)
     ).fetchone()
     return result[0] if result else None
 
 
-def parse_markdown_sections(content, source_file):
-    """Markdownファイルをセクションごとに分割"""
-    sections = []
-    current_section = None
-    current_content = []
-    
-    lines = content.split('\n')
-    
-    for line in lines:
-        # h2 または h3 のヘッダーを検出
-        h2_match = re.match(r'^## (.+)$', line)
-        h3_match = re.match(r'^### (.+)$', line)
-        
-        if h2_match or h3_match:
-            # 前のセクションを保存
-            if current_section and current_content:
-                sections.append({
-                    'title': current_section,
-                    'content': '\n'.join(current_content).strip(),
-                    'source_file': source_file
-                })
-            
-            current_section = h2_match.group(1) if h2_match else h3_match.group(1)
-            # マークダウンの装飾を削除
-            current_section = re.sub(r'\*\*(.+?)\*\*', r'\1', current_section)
-            current_section = current_section.strip()
-            current_content = []
-        else:
-            current_content.append(line)
-    
-    # 最後のセクションを保存
-    if current_section and current_content:
-        sections.append({
-            'title': current_section,
-            'content': '\n'.join(current_content).strip(),
-            'source_file': source_file
-        })
-    
-    return sections
-
-
-def extract_keywords(content):
-    """コンテンツからキーワードを抽出"""
-    # 太字のテキストをキーワードとして抽出
-    bold_keywords = re.findall(r'\*\*(.+?)\*\*', content)
-    
-    # 業界特有のキーワード
-    industry_keywords = [
-        '介護', 'ケアプラン', '記録', '文字起こし', '音声', 'AI', '自動化',
-        '効率化', '削減', '支援', 'システム', 'モニタリング', '見守り',
-        '高齢者', '福祉', 'ケアマネ', '介護職員', '人手不足'
-    ]
-    
-    found_keywords = []
-    for kw in industry_keywords:
-        if kw in content:
-            found_keywords.append(kw)
-    
-    # 太字キーワードと業界キーワードを結合
-    all_keywords = list(set(bold_keywords[:5] + found_keywords[:10]))
-    
-    return ','.join(all_keywords[:10])
-
-
-def insert_knowledge(cursor, industry_id, sections):
-    """ナレッジをデータベースに挿入"""
-    inserted = 0
-    for section in sections:
-        if len(section['content']) < 50:  # 短すぎるセクションはスキップ
-            continue
-        
-        keywords = extract_keywords(section['content'])
-        
-        cursor.execute('''
-            INSERT INTO external_knowledge 
-            (industry_id, title, content, source_file, section, keywords)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            industry_id,
-            section['title'],
-            section['content'],
-            section['source_file'],
-            section['title'],
-            keywords
-        ))
-        inserted += 1
-    
-    return inserted
-
-
-def clear_existing_knowledge(cursor, source_files):
-    """既存のナレッジを削除（同じソースファイルのもののみ）"""
-    for source_file in source_files:
-        cursor.execute(
-            'DELETE FROM external_knowledge WHERE source_file = ?',
-            (source_file,)
-        )
+def default_knowledge_files():
+    """引数を省略した場合に取り込むファイル（ワークスペースルートからの相対パス）"""
+    # スクリプトの場所: 50Development/LMS/
+    # ターゲットの場所: 04AIDD/02AIDC/AI4B/FocusedIndustry/
+    workspace_root = Path(__file__).resolve().parents[2]
+    folder = workspace_root / '04AIDD' / '02AIDC' / 'AI4B' / 'FocusedIndustry'
+    names = ['01_介護業界_UseCases.md', '業界別詳細_01_介護_テキストAI事例.md']
+    return [(folder / name, name) for name in names]
+
+
+def collect_knowledge_files(paths, pattern):
+    """ファイル・ディレクトリから (パス, ソースファイル名) の一覧を作る
+
+    ソースファイル名は管理画面のアップロードと同じくファイル名だけ（ディレクトリを含まない）にする。
+    同じ文書をこのスクリプトとアップロードのどちらで取り込んでも、同じ行を差分更新するため。
+    別々のパスに同じファイル名がある場合は、どちらかの内容で上書きしないよう ValueError にする
+    （同じファイルを重複して指定した場合は1度だけ取り込む）。
+    """
+    files = {}
+    for path in map(Path, paths):
+        candidates = sorted(f for f in path.rglob(pattern) if f.is_file()) if path.is_dir() else [path]
+        for candidate in candidates:
+            seen = files.setdefault(candidate.name, candidate)
+            if seen.resolve() != candidate.resolve():
+                raise ValueError(f"同じファイル名のファイルが複数あります: {seen} / {candidate}")
+    return [(path, name) for name, path in files.items()]
+
+
+def parse_knowledge_file(path, source_file, industry_id):
+    """ファイルを読み込んでセクションの行に変換（プロセスプールのワーカーで実行）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    sections = lms.parse_markdown_sections(content, source_file)
+    return source_file, len(sections), lms.knowledge_section_rows(sections, industry_id)
+
+
+def parse_all(files, industry_id, workers):
+    """ファイルを並列に分割し、終わったものから (ソースファイル名, セクション数, 行) を返す"""
+    if workers <= 1 or len(files) <= 1:
+        for path, name in files:
+            yield parse_knowledge_file(path, name, industry_id)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parse_knowledge_file, path, name, industry_id) for path, name in files]
+        for future in as_completed(futures):
+            yield future.result()
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Markdownの外部ナレッジを一括で取り込む')
+    parser.add_argument('paths', nargs='*', help='取り込むファイル・ディレクトリ（省略時は既定の介護業界ナレッジ）')
+    parser.add_argument('--industry', default='介護', help='ナレッジの業種名（既定: 介護）')
+    parser.add_argument('--pattern', default='*.md', help='ディレクトリから探すファイル名のパターン')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='分割・キーワード抽出を行うプロセス数（1なら並列化しない）')
+    parser.add_argument('--verbose', action='store_true', help='ファイルごとの結果を表示')
+    args = parser.parse_args()
+
     # データベース接続
-    db_path = 'lms.db'
+    db_path = lms.app.config['DATABASE']
     if not os.path.exists(db_path):
-        print("❌ lms.db が見つかりません。先に python init_db.py を実行してください。")
+        print(f"❌ {db_path} が見つかりません。先に python init_db.py を実行してください。")
         return
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
+
+    db = lms.get_db()
+
     # テーブル作成
-    create_external_knowledge_table(cursor)
-    
-    # 介護業界のIDを取得
-    nursing_id = get_industry_id(cursor, '介護')
-    if not nursing_id:
-        print("❌ 介護業界が見つかりません")
-        conn.close()
+    lms.create_external_knowledge_table(db)
+    print("✅ external_knowledge テーブルを作成/確認しました")
+
+    industry_id = get_industry_id(db, args.industry)
+    if not industry_id:
+        print(f"❌ {args.industry}業界が見つかりません")
+        db.close()
         return
-    
-    print(f"📋 介護業界ID: {nursing_id}")
-    
-    # ナレッジファイルのパス（ワークスペースルートからの相対パス）
-    # スクリプトの場所: 50Development/LMS/
-    # ターゲットの場所: 04AIDD/02AIDC/AI4B/FocusedIndustry/
-    workspace_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    
-    knowledge_files = [
-        {
-            'path': os.path.join(workspace_root, '04AIDD', '02AIDC', 'AI4B', 'FocusedIndustry', '01_介護業界_UseCases.md'),
-            'name': '01_介護業界_UseCases.md'
-        },
-        {
-            'path': os.path.join(workspace_root, '04AIDD', '02AIDC', 'AI4B', 'FocusedIndustry', '業界別詳細_01_介護_テキストAI事例.md'),
-            'name': '業界別詳細_01_介護_テキストAI事例.md'
-        }
-    ]
-    
-    # 既存のナレッジを削除
-    clear_existing_knowledge(cursor, [f['name'] for f in knowledge_files])
-    
-    total_inserted = 0
-    
-    for file_info in knowledge_files:
-        file_path = file_info['path']
-        
-        if not os.path.exists(file_path):
-            print(f"⚠️ ファイルが見つかりません: {file_path}")
-            continue
-        
-        print(f"\n📖 読み込み中: {file_info['name']}")
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # セクションに分割
-        sections = parse_markdown_sections(content, file_info['name'])
-        print(f"   セクション数: {len(sections)}")
-        
-        # データベースに挿入
-        inserted = insert_knowledge(cursor, nursing_id, sections)
-        total_inserted += inserted
-        print(f"   挿入数: {inserted}")
-    
-    conn.commit()
-    conn.close()
-    
-    print(f"\n✅ 完了! 合計 {total_inserted} 件のナレッジを追加しました")
-    print("\n📚 追加されたナレッジの確認:")
-    
-    # 確認のため再接続
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    results = cursor.execute('''
-        SELECT title, substr(content, 1, 50) as preview, source_file
-        FROM external_knowledge
-        WHERE industry_id = ?
-        ORDER BY id
-    ''', (nursing_id,)).fetchall()
-    
-    for title, preview, source in results:
-        print(f"  - [{source}] {title}")
-        print(f"    {preview}...")
-    
-    conn.close()
+
+    print(f"📋 {args.industry}業界ID: {industry_id}")
+
+    try:
+        files = collect_knowledge_files(args.paths, args.pattern) if args.paths else default_knowledge_files()
+    except ValueError as e:
+        print(f"❌ {e}（ソースファイル名はファイル名で区別するため、名前を変えてください）")
+        db.close()
+        return
+    missing = [path for path, _ in files if not path.is_file()]
+    for path in missing:
+        print(f"⚠️ ファイルが見つかりません: {path}")
+    files = [(path, name) for path, name in files if path.is_file()]
+    print(f"📖 {len(files)} ファイルを取り込みます（{args.workers} プロセス）")
+
+    total = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    section_count = 0
+    write_seconds = 0.0
+    start = time.perf_counter()
+
+    for source_file, parsed, rows in parse_all(files, industry_id, args.workers):
+        # 前回から変わったセクションだけを1つのトランザクションで反映
+        write_start = time.perf_counter()
+        diff = lms.sync_knowledge_rows(db, source_file, rows)
+        write_seconds += time.perf_counter() - write_start
+        section_count += len(rows)
+        for key, count in diff.items():
+            total[key] += count
+        if args.verbose:
+            print(f"   {source_file}: セクション {parsed} 件 / 追加 {diff['added']} / 更新 {diff['updated']} / "
+                  f"削除 {diff['deleted']} / 変更なし {diff['unchanged']}")
+
+    elapsed = time.perf_counter() - start
+
+    refresh_seconds = 0.0
+    if total['added'] or total['updated'] or total['deleted']:
+        refresh_start = time.perf_counter()
+        lms.refresh_retrieval_indexes(db)
+        refresh_seconds = time.perf_counter() - refresh_start
+
+    db.close()
+
+    print(f"\n✅ 完了! 追加 {total['added']} 件 / 更新 {total['updated']} 件 / 削除 {total['deleted']} 件"
+          f"（変更なし {total['unchanged']} 件）")
+    print(f"  セクション : {section_count} 件（{len(files)} ファイル）")
+    print(f"  スループット: {section_count / elapsed if elapsed else 0:.1f} セクション/秒"
+          f"（{elapsed:.2f} 秒、うち書き込み {write_seconds:.2f} 秒）")
+    if refresh_seconds:
+        print(f"  検索インデックス更新: {refresh_seconds:.2f} 秒")
 
 
 if __name__ == '__main__':
@@ -1,15 +1,36 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from markupsafe import escape
 from functools import wraps
+from contextlib import contextmanager
 import sqlite3
 import os
 import json
 import re
 import unicodedata
+import subprocess
+import hashlib
+import zlib
+import queue
+import time
+import math
+import random
+import atexit
+import gc
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
+from pathlib import Path
 import threading
 
+# NumPy（オプション - 並列文字起こしの音声処理で使用、Whisperの依存として導入される）
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Whisper（オプション - ローカル環境のみ）
 WHISPER_AVAILABLE = False
 try:
@@ -18,6 +39,14 @@ try:
 except ImportError:
     pass  # Whisperがインストールされていない環境（PythonAnywhereなど）
 
+# faster-whisper（オプション - CTranslate2によるCPU向け高速化バックエンド）
+FASTER_WHISPER_AVAILABLE = False
+try:
+    from faster_whisper import WhisperModel
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    pass
+
 # 環境変数読み込み（dotenvがある場合のみ）
 try:
     from dotenv import load_dotenv
@@ -43,6 +72,99 @@ ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
 RAKUTEN_AI_API_KEY = os.environ.get('RAKUTEN_AI_API_KEY', '')
 RAKUTEN_AI_BASE_URL = os.environ.get('RAKUTEN_AI_BASE_URL', 'https://api.ai.public.rakuten-it.com/rakutenllms/v1/')
 RAKUTEN_AI_MODEL = os.environ.get('RAKUTEN_AI_MODEL', 'rakutenai-3.0')
+# HTTP接続プール（プロセス内で共有し、TCP/TLSハンドシェイクを使い回す）
+RAKUTEN_AI_HTTP2 = os.environ.get('RAKUTEN_AI_HTTP2', '0') == '1'  # h2パッケージが必要
+RAKUTEN_AI_MAX_CONNECTIONS = int(os.environ.get('RAKUTEN_AI_MAX_CONNECTIONS', 20))
+RAKUTEN_AI_MAX_KEEPALIVE = int(os.environ.get('RAKUTEN_AI_MAX_KEEPALIVE', 10))
+RAKUTEN_AI_KEEPALIVE_EXPIRY = float(os.environ.get('RAKUTEN_AI_KEEPALIVE_EXPIRY', 30.0))
+RAKUTEN_AI_CONNECT_TIMEOUT = float(os.environ.get('RAKUTEN_AI_CONNECT_TIMEOUT', 5.0))
+RAKUTEN_AI_TIMEOUT = float(os.environ.get('RAKUTEN_AI_TIMEOUT', 60.0))
+# 障害時の保護（同時呼び出し数・チャット全体の制限時間・再試行・サーキットブレーカー）
+RAKUTEN_AI_MAX_CONCURRENT = int(os.environ.get('RAKUTEN_AI_MAX_CONCURRENT', 8))
+CHAT_DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', 20.0))  # 検索＋回答生成
+RAKUTEN_AI_MAX_RETRIES = int(os.environ.get('RAKUTEN_AI_MAX_RETRIES', 2))  # 429/5xx・接続エラー時
+RAKUTEN_AI_RETRY_BASE_SECONDS = float(os.environ.get('RAKUTEN_AI_RETRY_BASE_SECONDS', 0.5))
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5))  # 連続失敗でオープン
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30.0))
+
+# ========== 文字起こし設定 ==========
+# TRANSCRIBE_BACKEND: 'openai-whisper'（既定）または 'faster-whisper'（CPU向けint8量子化）
+TRANSCRIBE_BACKEND = os.environ.get('TRANSCRIBE_BACKEND', 'openai-whisper')
+WHISPER_MODEL_SIZE = os.environ.get('WHISPER_MODEL_SIZE', 'medium')
+TRANSCRIBE_THREADS = int(os.environ.get('TRANSCRIBE_THREADS', os.cpu_count() or 1))
+FASTER_WHISPER_COMPUTE_TYPE = os.environ.get('FASTER_WHISPER_COMPUTE_TYPE', 'int8')
+# ロードしたモデルを使われないまま保持する秒数（超えたら解放し、次の文字起こしで再ロード。0なら解放しない）
+TRANSCRIBE_MODEL_IDLE_SECONDS = float(os.environ.get('TRANSCRIBE_MODEL_IDLE_SECONDS', 600))
+# TRANSCRIBE_PARALLEL=1 で無音区間分割 + プロセスプールによる並列文字起こしを有効化
+TRANSCRIBE_PARALLEL = os.environ.get('TRANSCRIBE_PARALLEL', '0') == '1'
+# ワーカーごとにWhisperモデルを1つロードする（medium で1ワーカーあたり数GB）。メモリ不足を避けるため既定は最大2
+TRANSCRIBE_WORKERS = int(os.environ.get('TRANSCRIBE_WORKERS', min(os.cpu_count() or 1, 2)))
+TRANSCRIBE_CHUNK_SECONDS = float(os.environ.get('TRANSCRIBE_CHUNK_SECONDS', 60))
+# TRANSCRIBE_PROGRESS_CHUNKS=1 で openai-whisper もチャンクごとに順に文字起こしして進捗を通知する
+# （既定は全体を1回で文字起こしし、進捗は完了時のみ。チャンク境界で文脈が切れるため精度・速度が変わる）
+TRANSCRIBE_PROGRESS_CHUNKS = os.environ.get('TRANSCRIBE_PROGRESS_CHUNKS', '0') == '1'
+AUDIO_SAMPLE_RATE = 16000
+# デコード済み音声（16kHzモノラル .npy）のキャッシュ。再文字起こし時にffmpegのデコードを省略
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_MB = int(os.environ.get('AUDIO_CACHE_MAX_MB', 2048))
+
+# 文字起こしジョブスケジューラ（同時実行数の上限・優先度・実行時間帯・CPU優先度）
+TRANSCRIBE_MAX_CONCURRENT = int(os.environ.get('TRANSCRIBE_MAX_CONCURRENT', 1))
+TRANSCRIBE_MAX_PER_TENANT = int(os.environ.get('TRANSCRIBE_MAX_PER_TENANT', 1))
+TRANSCRIBE_NICE = int(os.environ.get('TRANSCRIBE_NICE', 10))
+TRANSCRIBE_ALLOWED_HOURS = os.environ.get('TRANSCRIBE_ALLOWED_HOURS', '')  # 例: '22-6'（空なら常時）
+# 1なら動画のアップロード時に文字起こしジョブを自動で登録（既定は無効。管理画面・一括登録から実行）
+TRANSCRIBE_ON_UPLOAD = os.environ.get('TRANSCRIBE_ON_UPLOAD', '0') == '1'
+TRANSCRIBE_JOB_TIMEOUT_HOURS = float(os.environ.get('TRANSCRIBE_JOB_TIMEOUT_HOURS', 6))
+# 実行中ジョブの生存確認の有効期間（秒）。更新が途絶えたジョブは異常終了とみなして待機中に戻す
+TRANSCRIBE_JOB_LEASE_SECONDS = float(os.environ.get('TRANSCRIBE_JOB_LEASE_SECONDS', 120))
+
+# ========== 概要生成設定 ==========
+# 長い文字起こしはチャンクごとに要約（map）し、部分要約を統合（reduce）する
+SUMMARY_CHUNK_CHARS = int(os.environ.get('SUMMARY_CHUNK_CHARS', 3000))
+SUMMARY_MAX_WORKERS = int(os.environ.get('SUMMARY_MAX_WORKERS', 4))
+# 部分要約が SUMMARY_CHUNK_CHARS に収まるまで統合を繰り返す段数の上限（超えた場合は警告を出して切り詰める）
+SUMMARY_MAX_ROUNDS = int(os.environ.get('SUMMARY_MAX_ROUNDS', 6))
+
+# ========== LLM応答キャッシュ設定 ==========
+# 同じ業種・同じ参考情報での同じ質問は、保存済みの回答を返してAPI呼び出しを省略する
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 5000))
+
+# ========== 類似質問キャッシュ設定 ==========
+# 言い換えた質問にも、同じ業種で過去に回答した類似の質問があればその回答を返す
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', '1') == '1'
+# sentence-transformersのモデル名（未設定・未インストールなら文字n-gramのTF-IDFで類似度を計算）
+SEMANTIC_CACHE_MODEL = os.environ.get('SEMANTIC_CACHE_MODEL', '')
+# 類似度の閾値（未設定なら 埋め込みモデル: 0.85 / 文字n-gram: 0.45）
+SEMANTIC_CACHE_THRESHOLD = os.environ.get('SEMANTIC_CACHE_THRESHOLD')
+
+# ========== RAGコンテキスト設定 ==========
+# 参考情報は関連度の高い文から順に、トークン数の上限まで詰める
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+CONTEXT_PASSAGE_CHARS = int(os.environ.get('CONTEXT_PASSAGE_CHARS', 300))  # 1パッセージの目安文字数
+# 検索用パッセージ（文字起こし・外部ナレッジを重なりのある窓に分割して索引）
+PASSAGE_CHARS = int(os.environ.get('PASSAGE_CHARS', 400))
+PASSAGE_OVERLAP_CHARS = int(os.environ.get('PASSAGE_OVERLAP_CHARS', 80))
+
+# ========== ベクトル検索設定 ==========
+# VECTOR_SEARCH_MODEL を設定すると、語句が一致しない関連コンテンツも埋め込みベクトルで検索し、
+# 全文検索の結果とRRF（Reciprocal Rank Fusion）で統合する（sentence-transformers、CPUで実行）
+VECTOR_SEARCH_MODEL = os.environ.get('VECTOR_SEARCH_MODEL', '')  # 例: 'intfloat/multilingual-e5-small'
+VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', 'vector_index')
+VECTOR_INDEX_BACKEND = os.environ.get('VECTOR_INDEX_BACKEND', 'brute')  # 'brute' または 'hnsw'（hnswlibが必要）
+RRF_K = int(os.environ.get('RRF_K', 60))
+
+# ========== 検索実行設定 ==========
+# 動画・文字起こし・ユースケース・外部ナレッジの検索を、読み取り専用接続でスレッドプールから並行に実行する
+RETRIEVAL_WORKERS = int(os.environ.get('RETRIEVAL_WORKERS', 8))  # 0なら順番に実行
+RETRIEVAL_SOURCE_TIMEOUT = float(os.environ.get('RETRIEVAL_SOURCE_TIMEOUT', 2.0))  # 超えたソースは結果なし（秒）
+# 検索結果のLRUキャッシュ（プロセス内。検索対象のコンテンツが更新されると古いエントリは使わない）
+RETRIEVAL_CACHE_ENABLED = os.environ.get('RETRIEVAL_CACHE_ENABLED', '1') == '1'
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get('RETRIEVAL_CACHE_MAX_ENTRIES', 2000))
+# 検索リクエストの中で反映するパッセージ・検索インデックスのキューの上限件数（残りはバックグラウンドで処理）
+INLINE_INDEX_SYNC_LIMIT = int(os.environ.get('INLINE_INDEX_SYNC_LIMIT', 20))
 
 # ========== GA4 設定 ==========
 GA_MEASUREMENT_ID = os.environ.get('GA_MEASUREMENT_ID', '')
@@ -737,11 +859,17 @@ def upload_video():
         existing_slugs = {r['slug'] for r in existing}
         slug = generate_slug(title, existing_slugs)
         
-        db.execute(
+        cursor = db.execute(
             'INSERT INTO videos (title, slug, description, filename, category_id, uploaded_by) VALUES (?, ?, ?, ?, ?, ?)',
             (title, slug, description, filename, category_id if category_id else None, session['user_id'])
         )
         db.commit()
+        schedule_vector_index_sync()
+        
+        # 新規アップロードは既存動画の一括処理より優先して文字起こし
+        if TRANSCRIBE_ON_UPLOAD and transcription_available():
+            enqueue_transcription(db, cursor.lastrowid, TRANSCRIBE_PRIORITY_HIGH)
+            transcription_scheduler.start()
         
         return jsonify({'success': True, 'message': 'Video uploaded successfully'})
     
@@ -783,6 +911,7 @@ def update_video(video_id):
         (title, description, video_id)
     )
     db.commit()
+    schedule_vector_index_sync()
     
     return jsonify({'success': True, 'message': 'Video updated successfully'})
 
@@ -2373,6 +2502,188 @@ def video_analytics_summary():
         'daily_activity': [dict(d) for d in daily_activity]
     })
 
+# ========== リアルタイム通知（Server-Sent Events） ==========
+
+# 他ワーカーのイベントを取り込む間隔（秒）と、event_feedの保持期間（秒）
+EVENT_FEED_POLL_SECONDS = float(os.environ.get('EVENT_FEED_POLL_SECONDS', 1.0))
+EVENT_FEED_RETENTION_SECONDS = 3600
+# 1接続のSSEを保持する上限秒数（超えたら閉じ、ブラウザが Last-Event-ID 付きで再接続する）
+SSE_MAX_STREAM_SECONDS = float(os.environ.get('SSE_MAX_STREAM_SECONDS', 300))
+
+class EventHub:
+    """プロセス内のpub/subハブ
+
+    publish() は同一プロセスの購読者へ即時配信し、同時に event_feed テーブルへ記録する。
+    購読者がいる間はバックグラウンドスレッドが event_feed を追跡し、
+    他のワーカープロセスが発行したイベントも配信する。
+    """
+    
+    def __init__(self, poll_seconds=EVENT_FEED_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._subscribers = {}   # channel -> set(Queue)
+        self._local_ids = set()  # 自プロセスで発行済み（追跡時に二重配信しない）
+        self._lock = threading.Lock()
+        self._poller = None
+        self._last_id = None
+    
+    def _connect(self):
+        db = sqlite3.connect(os.path.abspath(app.config['DATABASE']), timeout=5)
+        db.row_factory = sqlite3.Row
+        return db
+    
+    def publish(self, channel, event, data):
+        """イベントを発行し、event_feed上のIDを返す"""
+        payload = json.dumps(data, ensure_ascii=False)
+        event_id = None
+        try:
+            db = self._connect()
+            cursor = db.execute('INSERT INTO event_feed (channel, event, data) VALUES (?, ?, ?)',
+                                (channel, event, payload))
+            event_id = cursor.lastrowid
+            # コミット前に登録し、追跡スレッドとの二重配信を防ぐ
+            with self._lock:
+                if self._poller is not None:
+                    self._local_ids.add(event_id)
+            db.commit()
+            db.close()
+        except sqlite3.Error as e:
+            print(f"[EventHub] Feed write error: {e}")
+        self._deliver({'id': event_id, 'channel': channel, 'event': event, 'data': payload})
+        return event_id
+    
+    def subscribe(self, channels):
+        """チャンネルを購読し、イベントを受け取るキューを返す"""
+        q = queue.Queue(maxsize=1000)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(q)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_feed, daemon=True)
+                self._poller.start()
+        return q
+    
+    def unsubscribe(self, q):
+        with self._lock:
+            for channel in list(self._subscribers):
+                self._subscribers[channel].discard(q)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+    
+    def replay(self, channels, after_id):
+        """再接続時（Last-Event-ID）に取りこぼしたイベントを返す"""
+        db = self._connect()
+        placeholders = ','.join('?' * len(channels))
+        rows = db.execute(f'''
+            SELECT id, channel, event, data FROM event_feed
+            WHERE id > ? AND channel IN ({placeholders})
+            ORDER BY id
+        ''', (after_id, *channels)).fetchall()
+        db.close()
+        return [dict(r) for r in rows]
+    
+    def _deliver(self, message):
+        with self._lock:
+            targets = list(self._subscribers.get(message['channel'], ()))
+        for q in targets:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass  # 受信が追いつかないクライアントは取りこぼす（再接続時にreplayで補完）
+    
+    def _poll_feed(self):
+        """event_feedを追跡し、他プロセスが発行したイベントを配信（購読者がいなくなれば終了）"""
+        db = None
+        last_pruned = 0
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None
+                    self._local_ids.clear()
+                    self._last_id = None
+                    break
+            try:
+                if db is None:
+                    db = self._connect()
+                if self._last_id is None:
+                    self._last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM event_feed').fetchone()[0]
+                rows = db.execute('SELECT id, channel, event, data FROM event_feed WHERE id > ? ORDER BY id',
+                                  (self._last_id,)).fetchall()
+                for row in rows:
+                    self._last_id = row['id']
+                    with self._lock:
+                        is_local = row['id'] in self._local_ids
+                        self._local_ids.discard(row['id'])
+                    if not is_local:
+                        self._deliver(dict(row))
+                if time.time() - last_pruned > 60:
+                    db.execute("DELETE FROM event_feed WHERE created_at < datetime('now', ?)",
+                               (f'-{EVENT_FEED_RETENTION_SECONDS} seconds',))
+                    db.commit()
+                    last_pruned = time.time()
+            except sqlite3.Error as e:
+                print(f"[EventHub] Feed poll error: {e}")
+                db = None
+            time.sleep(self.poll_seconds)
+        if db is not None:
+            db.close()
+
+event_hub = EventHub()
+
+def format_sse(message):
+    """イベントをSSEの書式に変換"""
+    lines = []
+    if message.get('id') is not None:
+        lines.append(f"id: {message['id']}")
+    lines.append(f"event: {message['event']}")
+    lines.append(f"data: {message['data']}")
+    return '\n'.join(lines) + '\n\n'
+
+def sse_response(channels, heartbeat_seconds=15, max_seconds=None):
+    """指定チャンネルのイベントを配信するSSEレスポンスを返す
+    
+    同期ワーカーを占有し続けないよう、max_seconds（既定: SSE_MAX_STREAM_SECONDS）で接続を閉じる。
+    ブラウザの EventSource は retry の間隔で再接続し、取りこぼしは Last-Event-ID で再送される。
+    """
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    max_seconds = SSE_MAX_STREAM_SECONDS if max_seconds is None else max_seconds
+    
+    def generate():
+        q = event_hub.subscribe(channels)
+        closes_at = time.monotonic() + max_seconds
+        try:
+            yield 'retry: 3000\n\n'
+            if last_event_id:
+                for message in event_hub.replay(channels, last_event_id):
+                    yield format_sse(message)
+            while True:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    message = q.get(timeout=min(heartbeat_seconds, remaining))
+                except queue.Empty:
+                    # プロキシによる切断を防ぐためのコメント行
+                    yield ': keep-alive\n\n'
+                    continue
+                yield format_sse(message)
+        finally:
+            event_hub.unsubscribe(q)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# 管理者向けに購読可能なチャンネル
+ADMIN_EVENT_CHANNELS = {'transcription'}
+
+@app.route('/api/admin/events')
+@admin_required
+def admin_event_stream():
+    """管理者向けイベントストリーム（?channels=transcription,...）"""
+    channels = [c for c in request.args.get('channels', 'transcription').split(',') if c in ADMIN_EVENT_CHANNELS]
+    if not channels:
+        return jsonify({'error': '購読可能なチャンネルがありません'}), 400
+    return sse_response(channels)
+
 # ========== AIチャット機能 ==========
 
 # チャットページ
@@ -2479,136 +2790,1506 @@ def extract_keywords(text):
     
     return keywords[:8]  # 最大8キーワード
 
-def search_relevant_content(db, question, industry_id, is_admin=False):
-    """質問に関連するコンテンツを検索（業種別アクセス制御付き）"""
-    keywords = extract_keywords(question)
-    
-    # アクセス可能なカテゴリーIDを取得（業種別アクセス制御）
-    accessible_category_ids = get_accessible_category_ids(db, industry_id, is_admin)
+# 全文検索インデックス（migrate_db.py の migration 021、FTS5 trigram）
+FULLTEXT_TABLES = ('videos_fts', 'video_transcripts_fts', 'industry_usecases_fts', 'external_knowledge_fts',
+                   'content_passages_fts')
+
+def fulltext_index_available(db):
+    """全文検索インデックスが作成済みか（FTS5が使えない環境ではLIKE検索にフォールバック）"""
+    placeholders = ','.join('?' * len(FULLTEXT_TABLES))
+    count = db.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})", FULLTEXT_TABLES
+    ).fetchone()[0]
+    return count == len(FULLTEXT_TABLES)
+
+def fts_match_expression(keywords):
+    """3文字以上のキーワードをORでつないだMATCH式（trigramは3文字未満を検索できないためNone）"""
+    terms = ['"' + k.replace('"', '""') + '"' for k in keywords if len(k) >= 3]
+    return ' OR '.join(terms) or None
+
+def fulltext_search(db, select_sql, key_column, fts_table, like_columns, where_sql, params, keywords, limit,
+                    weights=None, use_index=True):
+    """1ソースをbm25順で上位limit件検索
+    
+    MATCHで検索し、件数が足りなければ3文字未満のキーワード（例: 「AI」「予約」）をLIKEで補う。
+    インデックスがない場合はすべてのキーワードをLIKEで検索する（ORでまとめて1クエリ）。
+    """
+    rows = []
+    short_keywords = keywords
+    if use_index:
+        short_keywords = [k for k in keywords if len(k) < 3]
+        match = fts_match_expression(keywords)
+        if match:
+            rank = f"bm25({fts_table}{''.join(f', {w}' for w in weights or [])})"
+            rows = db.execute(f'''
+                {select_sql}
+                JOIN {fts_table} ON {fts_table}.rowid = {key_column}
+                WHERE {fts_table} MATCH ? AND ({where_sql})
+                ORDER BY {rank}
+                LIMIT ?
+            ''', (match, *params, limit)).fetchall()
+    
+    if short_keywords and len(rows) < limit:
+        found = [r['id'] for r in rows]
+        conditions = ' OR '.join(f'LOWER({c}) LIKE ?' for _ in short_keywords for c in like_columns)
+        like_params = [f'%{k}%' for k in short_keywords for _ in like_columns]
+        exclude = f"AND {key_column} NOT IN ({','.join('?' * len(found))})" if found else ''
+        rows += db.execute(f'''
+            {select_sql}
+            WHERE ({conditions}) AND ({where_sql}) {exclude}
+            LIMIT ?
+        ''', (*like_params, *params, *found, limit - len(rows))).fetchall()
+    return [dict(r) for r in rows]
+
+# ----- パッセージストア（文字起こし・外部ナレッジの検索単位） -----
+
+_PASSAGE_BREAKS = '。！？!?\n'
+
+def chunk_passages(text, size=None, overlap=None):
+    """テキストを前の窓と overlap 文字重なる size 文字程度の窓に分割し、(開始, 終了) オフセットを返す
+    
+    窓の後ろ3割に文末があれば、窓の終わりをそこに合わせる。
+    """
+    size = size or PASSAGE_CHARS
+    overlap = min(PASSAGE_OVERLAP_CHARS if overlap is None else overlap, size // 2)
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(c, start + size * 7 // 10, end) for c in _PASSAGE_BREAKS)
+            if cut != -1:
+                end = cut + 1
+        spans.append((start, end))
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+def _segment_offsets(text, segments):
+    """セグメントが全文のどこにあるか（開始, 終了, 開始秒, 終了秒）。全文に見つからないセグメントは除く"""
+    offsets = []
+    cursor = 0
+    for seg in segments:
+        seg_text = seg['text'].strip()
+        pos = text.find(seg_text, cursor) if seg_text else -1
+        if pos == -1:
+            continue
+        offsets.append((pos, pos + len(seg_text), seg['start'], seg['end']))
+        cursor = pos + len(seg_text)
+    return offsets
+
+def build_passage_rows(db, source, source_id):
+    """出典（'transcript' / 'knowledge'）をパッセージに分割した content_passages の行
+    
+    文字起こしはセグメントと対応づけて、パッセージの開始・終了秒も記録する。
+    """
+    title = None
+    segments = []
+    if source == 'transcript':
+        row = db.execute("SELECT video_id, content, content_type FROM video_transcripts "
+                         "WHERE id = ? AND content_type != 'segment'", (source_id,)).fetchone()
+        if row and row['content_type'] == 'transcript':
+            segments = _segment_offsets(row['content'], get_transcript_segments(db, row['video_id']))
+    else:
+        row = db.execute('SELECT title, content FROM external_knowledge WHERE id = ?', (source_id,)).fetchone()
+        title = row['title'] if row else None
+    if not row:
+        return []
+    
+    rows = []
+    text = row['content']
+    for index, (start, end) in enumerate(chunk_passages(text)):
+        content = text[start:end].strip()
+        if not content:
+            continue
+        overlapping = [seg for seg in segments if seg[1] > start and seg[0] < end]
+        rows.append((
+            source, source_id, index, title, content, start, end,
+            min(seg[2] for seg in overlapping) if overlapping else None,
+            max(seg[3] for seg in overlapping) if overlapping else None
+        ))
+    return rows
+
+def sync_passages(db, batch_size=200, max_batches=None):
+    """passage_queue（トリガーで登録）の出典のパッセージを作り直す（処理した出典数を返す）
+    
+    呼び出し元のトランザクションが開いている場合は何もしない（次回の検索時に処理）。
+    max_batches を指定すると、その回数分のバッチだけ処理して戻る。
+    """
+    processed = 0
+    batches = 0
+    while not db.in_transaction and (max_batches is None or batches < max_batches):
+        batches += 1
+        queued = db.execute('SELECT id, source, source_id FROM passage_queue ORDER BY id LIMIT ?',
+                            (batch_size,)).fetchall()
+        if not queued:
+            break
+        targets = list(dict.fromkeys((q['source'], q['source_id']) for q in queued))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for source, source_id in targets:
+                db.execute('DELETE FROM content_passages WHERE source = ? AND source_id = ?', (source, source_id))
+                db.executemany('''
+                    INSERT INTO content_passages
+                    (source, source_id, passage_index, title, content, char_start, char_end, timestamp_start, timestamp_end)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', build_passage_rows(db, source, source_id))
+            db.execute('DELETE FROM passage_queue WHERE id <= ?', (queued[-1]['id'],))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        processed += len(targets)
+    return processed
+
+def refresh_retrieval_indexes(db, db_path=None):
+    """コンテンツの追加・更新後に、パッセージ・全体検索インデックスを作り直してベクトルインデックスの差分更新を開始"""
+    sync_passages(db)
+    sync_search_index(db)
+    schedule_vector_index_sync(db_path)
+
+_queue_drain_lock = threading.Lock()
+
+def _drain_index_queues(db_path):
+    """キューを最後まで処理（バックグラウンドスレッドで実行）"""
+    if not _queue_drain_lock.acquire(blocking=False):
+        return
+    db = sqlite3.connect(db_path, timeout=30)
+    db.row_factory = sqlite3.Row
+    try:
+        sync_passages(db)
+        sync_search_index(db)
+    except sqlite3.OperationalError as e:
+        print(f"[SearchIndex] 更新エラー: {e}")
+    finally:
+        db.close()
+        _queue_drain_lock.release()
+
+def sync_index_queue_inline(db, sync, queue_table):
+    """検索リクエストの中ではキューの先頭（INLINE_INDEX_SYNC_LIMIT 件）だけを反映し、残りはバックグラウンドで処理
     
-    # ビデオを検索（タイトルと説明文）- アクセス制御適用
+    コンテンツの一括更新直後でも、検索リクエストがキュー全体の処理を待たないようにする。
+    """
+    sync(db, batch_size=INLINE_INDEX_SYNC_LIMIT, max_batches=1)
+    if db.in_transaction or _queue_drain_lock.locked():
+        return
+    if db.execute(f'SELECT 1 FROM {queue_table} LIMIT 1').fetchone():
+        thread = threading.Thread(target=_drain_index_queues, args=(os.path.abspath(app.config['DATABASE']),))
+        thread.daemon = True
+        thread.start()
+
+def format_timestamp(seconds):
+    """秒数を「m:ss」（1時間以上は「h:mm:ss」）に整形"""
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+# ----- ベクトル検索（語句検索との併用） -----
+
+# HNSW近似最近傍探索（オプション - VECTOR_INDEX_BACKEND=hnsw の場合のみ使用）
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+class SentenceTransformerEncoder:
+    """ローカルの多言語埋め込みモデル（sentence-transformers、CPU）でテキストをベクトル化"""
+    
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self._model.get_sentence_embedding_dimension()
+        # e5系のモデルは質問・文書に接頭辞を付けて学習されている
+        self._prefixes = ('query: ', 'passage: ') if 'e5' in model_name.lower() else ('', '')
+    
+    def encode(self, texts, query=False):
+        prefix = self._prefixes[0 if query else 1]
+        return self._model.encode([prefix + t for t in texts], normalize_embeddings=True,
+                                  convert_to_numpy=True).astype(np.float32)
+
+# ベクトル化する出典（種類, IDを列挙するSQL）。文字起こし・外部ナレッジはパッセージ単位
+VECTOR_SOURCES = [
+    ('video', 'SELECT id FROM videos'),
+    ('passage', 'SELECT id FROM content_passages'),
+]
+
+def load_vector_passages(db, source, source_id):
+    """ベクトル化するテキスト（動画はタイトル＋説明、パッセージは見出し＋本文）"""
+    if source == 'video':
+        row = db.execute('SELECT title, description FROM videos WHERE id = ?', (source_id,)).fetchone()
+        return [f"{row['title']}\n{row['description'] or ''}".strip()] if row else []
+    if source == 'passage':
+        row = db.execute('SELECT title, content FROM content_passages WHERE id = ?', (source_id,)).fetchone()
+        return [f"{row['title']}\n{row['content']}" if row['title'] else row['content']] if row else []
+    return []
+
+class VectorIndex:
+    """パッセージ埋め込みのインデックス
+    
+    ベクトルは float16 の行列としてファイルに追記し、検索時はメモリマップで読み込む。
+    行番号と出典（source, source_id）の対応は vector_entries テーブルで管理し、
+    変更された出典は vector_index_queue（トリガーで登録）から差分だけ再計算する。
+    """
+    
+    def __init__(self, directory, encoder, backend='brute'):
+        self.directory = directory
+        self.encoder = encoder
+        self.backend = backend if backend == 'hnsw' and hnswlib is not None else 'brute'
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._matrix = None
+        self._rows = 0
+        self._hnsw = None
+        self._hnsw_rows = 0
+    
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"vectors-{self.encoder.dim}.f16")
+    
+    @property
+    def row_bytes(self):
+        return self.encoder.dim * 2
+    
+    def _file_rows(self):
+        """ファイル上の行数（書き込み途中で終了した端数は切り捨てる）"""
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+        if size % self.row_bytes:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size - size % self.row_bytes)
+        return size // self.row_bytes
+    
+    def _load(self):
+        """ファイルが伸びていればメモリマップを開き直す（HNSWには追加分のみ登録）"""
+        rows = self._file_rows()
+        with self._lock:
+            if rows != self._rows:
+                self._matrix = np.memmap(self.path, dtype=np.float16, mode='r',
+                                         shape=(rows, self.encoder.dim)) if rows else None
+                self._rows = rows
+            if self.backend == 'hnsw' and self._rows > self._hnsw_rows:
+                if self._hnsw is None:
+                    self._hnsw = hnswlib.Index(space='ip', dim=self.encoder.dim)
+                    self._hnsw.init_index(max_elements=max(1024, self._rows * 2), ef_construction=200, M=16)
+                elif self._rows > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(self._rows * 2)
+                new_rows = np.arange(self._hnsw_rows, self._rows)
+                self._hnsw.add_items(np.asarray(self._matrix[self._hnsw_rows:], dtype=np.float32), new_rows)
+                self._hnsw_rows = self._rows
+            return self._matrix, self._rows
+    
+    def search(self, text, k):
+        """質問に近い行を (行番号, コサイン類似度) の降順で最大k件"""
+        matrix, rows = self._load()
+        if not rows:
+            return []
+        query = self.encoder.encode([text], query=True)[0]
+        k = min(k, rows)
+        if self._hnsw is not None:
+            self._hnsw.set_ef(max(50, k))
+            labels, distances = self._hnsw.knn_query(query, k=k)
+            return [(int(r), 1 - float(d)) for r, d in zip(labels[0], distances[0])]
+        # 総当たり（ブロックごとにfloat32へ変換してメモリ使用量を抑える）
+        scores = np.concatenate([
+            np.asarray(matrix[start:start + 65536], dtype=np.float32) @ query
+            for start in range(0, rows, 65536)
+        ])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(r), float(scores[r])) for r in top]
+    
+    def _reset_if_stale(self, db):
+        """ベクトルファイルと対応表が一致しない（ファイルの削除・モデルの変更）場合は全件を登録し直す"""
+        signature = f"{getattr(self.encoder, 'model_name', '')}:{self.encoder.dim}"
+        stored = db.execute("SELECT value FROM app_settings WHERE key = 'vector_index'").fetchone()
+        max_row = db.execute('SELECT MAX(row) FROM vector_entries').fetchone()[0]
+        if stored and stored[0] == signature and (max_row is None or max_row < self._file_rows()):
+            return
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if max_row is not None:
+                print("[VectorIndex] ベクトルファイルが対応表と一致しないため、全件を再登録します")
+                db.execute('DELETE FROM vector_entries')
+                db.execute('DELETE FROM vector_index_queue')
+                for source, sql in VECTOR_SOURCES:
+                    db.execute(f"INSERT INTO vector_index_queue (source, source_id) SELECT ?, id FROM ({sql})", (source,))
+            with self._lock:
+                self._matrix, self._rows, self._hnsw, self._hnsw_rows = None, 0, None, 0
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('vector_index', ?)", (signature,))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    
+    def sync(self, db, batch_size=64):
+        """キューに登録された出典を再ベクトル化して追記し、古い行を無効化する（処理した件数を返す）"""
+        if not self._sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._reset_if_stale(db)
+            processed = 0
+            while True:
+                queued = db.execute(
+                    'SELECT id, source, source_id FROM vector_index_queue ORDER BY id LIMIT ?', (batch_size,)
+                ).fetchall()
+                if not queued:
+                    return processed
+                targets = list(dict.fromkeys((q['source'], q['source_id']) for q in queued))
+                entries = [(source, source_id, index, text)
+                           for source, source_id in targets
+                           for index, text in enumerate(load_vector_passages(db, source, source_id))]
+                vectors = self.encoder.encode([e[3] for e in entries]) if entries else None
+                
+                # 行番号の採番・追記・対応表の更新は書き込みロック内で行う（複数プロセスでの同時更新対策）
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    start = self._file_rows()
+                    if vectors is not None:
+                        with open(self.path, 'ab') as f:
+                            f.write(np.asarray(vectors, dtype=np.float16).tobytes())
+                    db.executemany('UPDATE vector_entries SET deleted = 1 WHERE source = ? AND source_id = ? AND deleted = 0',
+                                   targets)
+                    db.executemany(
+                        'INSERT INTO vector_entries (row, source, source_id, passage_index) VALUES (?, ?, ?, ?)',
+                        [(start + i, source, source_id, index) for i, (source, source_id, index, _) in enumerate(entries)]
+                    )
+                    db.execute('DELETE FROM vector_index_queue WHERE id <= ?', (queued[-1]['id'],))
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                processed += len(targets)
+                print(f"[VectorIndex] {len(targets)} items, {len(entries)} passages indexed")
+        finally:
+            self._sync_lock.release()
+
+def _create_vector_index():
+    if not VECTOR_SEARCH_MODEL:
+        return None
+    if np is None:
+        print("[VectorIndex] numpy がインストールされていないためベクトル検索を無効化します")
+        return None
+    try:
+        encoder = SentenceTransformerEncoder(VECTOR_SEARCH_MODEL)
+    except Exception as e:
+        print(f"[VectorIndex] 埋め込みモデルを読み込めないためベクトル検索を無効化します: {e}")
+        return None
+    return VectorIndex(VECTOR_INDEX_DIR, encoder, VECTOR_INDEX_BACKEND)
+
+_vector_index = None
+_vector_index_loaded = False
+
+def get_vector_index():
+    """ベクトルインデックス（VECTOR_SEARCH_MODEL 未設定・モデルを読み込めない場合はNone）"""
+    global _vector_index, _vector_index_loaded
+    if not _vector_index_loaded:
+        _vector_index_loaded = True
+        _vector_index = _create_vector_index()
+    return _vector_index
+
+def _sync_vector_index(db_path):
+    index = get_vector_index()
+    if index is None:
+        return
+    db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    try:
+        index.sync(db)
+    except sqlite3.OperationalError as e:
+        print(f"[VectorIndex] 更新エラー: {e}")
+    finally:
+        db.close()
+
+def schedule_vector_index_sync(db_path=None):
+    """コンテンツの追加・更新後にベクトルインデックスの差分更新をバックグラウンドで開始"""
+    index = get_vector_index()
+    if index is None or index._sync_lock.locked():
+        return
+    thread = threading.Thread(target=_sync_vector_index,
+                              args=(db_path or os.path.abspath(app.config['DATABASE']),))
+    thread.daemon = True
+    thread.start()
+
+def vector_search(db, question, limit):
+    """ベクトル検索で近い出典を種類ごとに類似度順で返す（{'video': [id, ...], ...}）"""
+    index = get_vector_index()
+    if index is None:
+        return {}
+    try:
+        if db.execute('SELECT 1 FROM vector_index_queue LIMIT 1').fetchone():
+            schedule_vector_index_sync()
+        hits = index.search(question, limit * 5)
+    except sqlite3.OperationalError:
+        return {}  # マイグレーション未実行
+    if not hits:
+        return {}
+    rows = [r for r, _ in hits]
+    placeholders = ','.join('?' * len(rows))
+    entries = {
+        e['row']: (e['source'], e['source_id'])
+        for e in db.execute(
+            f'SELECT row, source, source_id FROM vector_entries WHERE deleted = 0 AND row IN ({placeholders})', rows
+        ).fetchall()
+    }
+    ranked = {}
+    for row, _ in hits:
+        if row in entries:
+            source, source_id = entries[row]
+            ids = ranked.setdefault(source, [])
+            if source_id not in ids:
+                ids.append(source_id)
+    return ranked
+
+def rrf_fuse(db, lexical, vector_ids, select_sql, key_column, where_sql, params, limit):
+    """語句検索とベクトル検索の順位を Reciprocal Rank Fusion（1 / (RRF_K + 順位) の和）で統合
+    
+    ベクトル検索のみで見つかった行は、語句検索と同じ条件（アクセス制御）で取得し直す。
+    """
+    scores = {}
+    for rank, row in enumerate(lexical, 1):
+        scores[row['id']] = scores.get(row['id'], 0) + 1 / (RRF_K + rank)
+    for rank, item_id in enumerate(vector_ids, 1):
+        scores[item_id] = scores.get(item_id, 0) + 1 / (RRF_K + rank)
+    
+    rows = {row['id']: row for row in lexical}
+    missing = [i for i in vector_ids if i not in rows]
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        for row in db.execute(f'{select_sql} WHERE {key_column} IN ({placeholders}) AND ({where_sql})',
+                              (*missing, *params)).fetchall():
+            rows[row['id']] = dict(row)
+    return sorted(rows.values(), key=lambda r: -scores[r['id']])[:limit]
+
+# ----- 検索の並行実行（動画・文字起こし・ユースケース・外部ナレッジ） -----
+
+def _retrieve_videos(db, req):
+    """動画を検索（タイトルと説明文、タイトルの一致を重視）"""
+    category_ids = req['accessible_category_ids']
+    if not category_ids:
+        return []
+    category_filter = f"v.category_id IS NULL OR v.category_id IN ({','.join('?' * len(category_ids))})"
+    video_sql = '''
+        SELECT v.id, v.title, v.description, c.name as category_name
+        FROM videos v
+        LEFT JOIN categories c ON v.category_id = c.id
+    '''
     videos = []
-    for keyword in keywords[:5]:  # 最初の5キーワードで検索
-        if accessible_category_ids:
-            # アクセス可能なカテゴリーの動画のみ検索
-            placeholders = ','.join('?' * len(accessible_category_ids))
-            search_results = db.execute(f'''
-                SELECT DISTINCT v.id, v.title, v.description, c.name as category_name
-                FROM videos v
-                LEFT JOIN categories c ON v.category_id = c.id
-                WHERE (LOWER(v.title) LIKE ? OR LOWER(v.description) LIKE ?)
-                AND (v.category_id IS NULL OR v.category_id IN ({placeholders}))
-                LIMIT 5
-            ''', (f'%{keyword}%', f'%{keyword}%', *accessible_category_ids)).fetchall()
-        else:
-            # アクセス可能なカテゴリーがない場合は空
-            search_results = []
-        videos.extend([dict(v) for v in search_results])
-    
-    # 重複を除去
-    seen_ids = set()
-    unique_videos = []
-    for v in videos:
-        if v['id'] not in seen_ids:
-            seen_ids.add(v['id'])
-            unique_videos.append(v)
-    
-    # トランスクリプトを検索（アクセス制御適用）
+    if req['keywords']:
+        videos = fulltext_search(db, video_sql, 'v.id', 'videos_fts', ['v.title', 'v.description'],
+                                 category_filter, category_ids, req['keywords'], 5,
+                                 weights=[3.0, 1.0], use_index=req['use_index'])
+    if req['vector_hits']:
+        videos = rrf_fuse(db, videos, req['vector_hits'].get('video', []), video_sql, 'v.id',
+                          category_filter, category_ids, 5)
+    return videos
+
+def _retrieve_transcripts(db, req):
+    """トランスクリプトのパッセージを検索（idは文字起こしのID、passage_idはパッセージのID）"""
+    category_ids = req['accessible_category_ids']
+    if not category_ids:
+        return []
+    transcript_sql = '''
+        SELECT p.id, p.source_id, p.content, p.timestamp_start, p.timestamp_end,
+               v.id as video_id, v.title as video_title
+        FROM content_passages p
+        JOIN video_transcripts vt ON vt.id = p.source_id
+        JOIN videos v ON vt.video_id = v.id
+    '''
+    transcript_filter = (f"p.source = 'transcript' AND "
+                         f"(v.category_id IS NULL OR v.category_id IN ({','.join('?' * len(category_ids))}))")
     transcripts = []
-    for keyword in keywords[:3]:
-        if accessible_category_ids:
-            placeholders = ','.join('?' * len(accessible_category_ids))
-            transcript_results = db.execute(f'''
-                SELECT vt.content, v.id as video_id, v.title as video_title
-                FROM video_transcripts vt
-                JOIN videos v ON vt.video_id = v.id
-                LEFT JOIN categories c ON v.category_id = c.id
-                WHERE LOWER(vt.content) LIKE ?
-                AND (v.category_id IS NULL OR v.category_id IN ({placeholders}))
-                LIMIT 3
-            ''', (f'%{keyword}%', *accessible_category_ids)).fetchall()
-        else:
-            transcript_results = []
-        transcripts.extend([dict(t) for t in transcript_results])
-    
-    # ユースケースを検索
-    usecases = []
-    if industry_id:
-        for keyword in keywords[:3]:
-            usecase_results = db.execute('''
-                SELECT title, description, example_prompt
-                FROM industry_usecases
-                WHERE industry_id = ? AND (LOWER(title) LIKE ? OR LOWER(description) LIKE ? OR LOWER(keywords) LIKE ?)
-                LIMIT 3
-            ''', (industry_id, f'%{keyword}%', f'%{keyword}%', f'%{keyword}%')).fetchall()
-            usecases.extend([dict(u) for u in usecase_results])
-    
-    # 外部ナレッジを検索（業種別）
+    if req['keywords']:
+        transcripts = fulltext_search(db, transcript_sql, 'p.id', 'content_passages_fts', ['p.content'],
+                                      transcript_filter, category_ids, req['keywords'], 3,
+                                      use_index=req['use_index'])
+    if req['vector_hits']:
+        transcripts = rrf_fuse(db, transcripts, req['vector_hits'].get('passage', []), transcript_sql, 'p.id',
+                               transcript_filter, category_ids, 3)
+    return [dict(t, id=t['source_id'], passage_id=t['id']) for t in transcripts]
+
+def _retrieve_usecases(db, req):
+    """ユースケースを検索（ユーザーの業種のみ）"""
+    if not (req['keywords'] and req['industry_id']):
+        return []
+    return fulltext_search(db, '''
+        SELECT u.id, u.title, u.description, u.example_prompt
+        FROM industry_usecases u
+    ''', 'u.id', 'industry_usecases_fts', ['u.title', 'u.description', 'u.keywords'],
+        'u.industry_id = ?', [req['industry_id']], req['keywords'], 3,
+        weights=[3.0, 1.0, 2.0], use_index=req['use_index'])
+
+def _retrieve_knowledge(db, req):
+    """外部ナレッジのパッセージを検索（業種別、管理者は全ナレッジ。idはナレッジのID）"""
+    industry_id = req['industry_id']
+    if not (industry_id or req['is_admin']):
+        return []
+    knowledge_sql = '''
+        SELECT p.id, p.source_id, k.title, p.content, k.source_file, k.keywords
+        FROM content_passages p
+        JOIN external_knowledge k ON k.id = p.source_id
+    '''
+    where_sql, params = ("p.source = 'knowledge' AND k.industry_id = ?", [industry_id]) if industry_id \
+        else ("p.source = 'knowledge'", [])
     knowledge = []
     try:
-        # テーブルが存在するか確認
-        db.execute("SELECT 1 FROM external_knowledge LIMIT 1").fetchone()
-        
-        for keyword in keywords[:5]:
-            if industry_id:
-                # ユーザーの業種に関連するナレッジを検索
-                knowledge_results = db.execute('''
-                    SELECT DISTINCT title, content, source_file, keywords
-                    FROM external_knowledge
-                    WHERE industry_id = ? 
-                    AND (LOWER(title) LIKE ? OR LOWER(content) LIKE ? OR LOWER(keywords) LIKE ?)
-                    LIMIT 3
-                ''', (industry_id, f'%{keyword}%', f'%{keyword}%', f'%{keyword}%')).fetchall()
-            elif is_admin:
-                # 管理者は全ナレッジを検索可能
-                knowledge_results = db.execute('''
-                    SELECT DISTINCT title, content, source_file, keywords
-                    FROM external_knowledge
-                    WHERE LOWER(title) LIKE ? OR LOWER(content) LIKE ? OR LOWER(keywords) LIKE ?
-                    LIMIT 3
-                ''', (f'%{keyword}%', f'%{keyword}%', f'%{keyword}%')).fetchall()
+        if req['keywords']:
+            knowledge = fulltext_search(db, knowledge_sql, 'p.id', 'content_passages_fts',
+                                        ['p.title', 'p.content'], where_sql, params,
+                                        req['keywords'], 8, weights=[3.0, 1.0], use_index=req['use_index'])
+        if req['vector_hits']:
+            knowledge = rrf_fuse(db, knowledge, req['vector_hits'].get('passage', []), knowledge_sql, 'p.id',
+                                 where_sql, params, 8)
+    except sqlite3.OperationalError:
+        # external_knowledge テーブルが存在しない場合はスキップ
+        return []
+    
+    # 重複を除去（タイトルベース、同じナレッジは最も関連度の高いパッセージのみ）
+    seen_titles = set()
+    unique_knowledge = []
+    for k in knowledge:
+        if k['title'] not in seen_titles:
+            seen_titles.add(k['title'])
+            unique_knowledge.append(dict(k, id=k['source_id'], passage_id=k['id']))
+    return unique_knowledge[:5]
+
+# 検索するソース（名前, 検索関数）。検索関数は (db, req) を受け取り結果の行（dict）のリストを返す
+RETRIEVAL_SOURCES = [
+    ('videos', _retrieve_videos),
+    ('transcripts', _retrieve_transcripts),
+    ('usecases', _retrieve_usecases),
+    ('knowledge', _retrieve_knowledge),
+]
+
+_retrieval_pool = None
+_retrieval_pool_pid = None
+_retrieval_pool_lock = threading.Lock()
+
+def get_retrieval_pool():
+    """ソース別検索用のスレッドプールを取得（プロセス共有、fork後は作り直す）"""
+    global _retrieval_pool, _retrieval_pool_pid
+    with _retrieval_pool_lock:
+        if _retrieval_pool is None or _retrieval_pool_pid != os.getpid():
+            _retrieval_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+            _retrieval_pool_pid = os.getpid()
+        return _retrieval_pool
+
+def database_file(db):
+    """接続しているDBファイルの絶対パス（メモリDBなら None）"""
+    row = db.execute('PRAGMA database_list').fetchone()
+    return row[2] or None
+
+def _run_retrieval_source(path, func, req, handle):
+    """ワーカースレッドで1ソースを読み取り専用接続で検索（handle に接続と所要時間を記録）"""
+    start = time.perf_counter()
+    db = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True)
+    db.row_factory = sqlite3.Row
+    handle['db'] = db
+    try:
+        return func(db, req)
+    finally:
+        handle['db'] = None
+        db.close()
+        handle['ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+def run_retrieval(db, req):
+    """RETRIEVAL_SOURCES を並行に検索し、({ソース名: 結果}, {ソース名: 所要ミリ秒}) を返す
+    
+    各ソースは読み取り専用の別接続で検索する。RETRIEVAL_SOURCE_TIMEOUT 秒以内に終わらなかった
+    ソースは実行中のクエリを中断して結果なし（所要時間は None）とする。
+    RETRIEVAL_WORKERS が0、メモリDB、または未コミットの変更がある接続では db で順番に検索する。
+    """
+    results = {}
+    timings = {}
+    path = database_file(db)
+    if RETRIEVAL_WORKERS <= 0 or path is None or db.in_transaction:
+        for name, func in RETRIEVAL_SOURCES:
+            start = time.perf_counter()
+            results[name] = func(db, req)
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        return results, timings
+    
+    pool = get_retrieval_pool()
+    handles = {name: {} for name, _ in RETRIEVAL_SOURCES}
+    futures = {name: pool.submit(_run_retrieval_source, path, func, req, handles[name])
+               for name, func in RETRIEVAL_SOURCES}
+    wait(futures.values(), timeout=RETRIEVAL_SOURCE_TIMEOUT)
+    for name, future in futures.items():
+        if future.done():
+            results[name] = future.result()
+            timings[name] = handles[name]['ms']
+            continue
+        future.cancel()
+        running = handles[name].get('db')
+        if running is not None:
+            try:
+                running.interrupt()  # 実行中のクエリを中断してワーカーを解放
+            except sqlite3.ProgrammingError:
+                pass  # 直前に終了して接続が閉じられた
+        print(f"[Retrieval] {name} timed out after {RETRIEVAL_SOURCE_TIMEOUT}s")
+        results[name] = []
+        timings[name] = None
+    return results, timings
+
+# ----- 検索結果キャッシュ -----
+
+def content_version(db, key='content_version'):
+    """検索対象のコンテンツのバージョン（追加・更新・削除のたびにトリガーで増える。未マイグレーションなら None）
+    
+    key='search_version' は全体検索のインデックス（Q&A・セグメントを含む）のバージョン。
+    """
+    try:
+        row = db.execute("SELECT value FROM app_settings WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+class RetrievalCache:
+    """検索結果のLRUキャッシュ（スレッドセーフ）
+    
+    エントリは作成時のコンテンツのバージョンを持ち、バージョンが変わったエントリはミスとして削除する。
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_MAX_ENTRIES)
+
+def cached_retrieval(db, key, compute, cacheable=None, version_keys=('content_version',)):
+    """compute() の結果を key（ハッシュ可能な値）とコンテンツのバージョンでキャッシュし、(結果, ヒットしたか) を返す
+    
+    チャットの検索のほか、サジェスト・プレビューなど検索結果を使うAPIで共有する。
+    key には結果を左右する入力（正規化したクエリ・業種・管理者か）をすべて含めること。
+    cacheable(結果) が False の結果（タイムアウトで欠けた結果など）は保存しない。
+    結果はキャッシュと共有するため、呼び出し側で変更しない。
+    version_keys のバージョン（app_settings のキー）のどれかが変わったエントリは使わない。
+    """
+    version = None
+    if RETRIEVAL_CACHE_ENABLED and RETRIEVAL_CACHE_MAX_ENTRIES > 0:
+        version = tuple(content_version(db, k) for k in version_keys)
+        if None in version:
+            version = None
+    if version is None:
+        return compute(), False
+    value = retrieval_cache.get(key, version)
+    if value is not None:
+        return value, True
+    # compute 中にコンテンツが更新された場合も、読み取り前のバージョンで保存するので次回はミスになる
+    value = compute()
+    if cacheable is None or cacheable(value):
+        retrieval_cache.put(key, version, value)
+    return value, False
+
+def search_relevant_content(db, question, industry_id, is_admin=False):
+    """質問に関連するコンテンツを検索（業種別アクセス制御付き）
+    
+    動画・文字起こし・ユースケース・外部ナレッジをそれぞれ1クエリで、関連度（bm25）の高い順に取得する。
+    4つのソースは run_retrieval で並行に検索し、ソースごとの所要ミリ秒を timings に返す。
+    文字起こし・外部ナレッジは、文書の先頭ではなく質問に一致したパッセージを返す。
+    ベクトル検索が有効な場合は、動画・パッセージの順位をRRFで統合する。
+    結果はキーワード・業種・管理者か（ベクトル検索が有効なら質問文も）ごとにキャッシュし、
+    キャッシュから返した場合は cached が True（timings は空）になる。
+    """
+    sync_index_queue_inline(db, sync_passages, 'passage_queue')
+    keywords = extract_keywords(question)
+    vector_enabled = get_vector_index() is not None
+    key = ('relevant', tuple(sorted(set(keywords))), industry_id, bool(is_admin),
+           normalize_question(question) if vector_enabled else None)
+    
+    def compute():
+        req = {
+            'keywords': keywords,
+            'industry_id': industry_id,
+            'is_admin': is_admin,
+            'use_index': fulltext_index_available(db),
+            'vector_hits': vector_search(db, question, 5) if vector_enabled else {},
+            # アクセス可能なカテゴリーIDを取得（業種別アクセス制御）
+            'accessible_category_ids': get_accessible_category_ids(db, industry_id, is_admin)
+        }
+        return run_retrieval(db, req)
+    
+    # 時間切れのソースがある結果はキャッシュしない
+    (results, timings), cached = cached_retrieval(db, key, compute,
+                                                  cacheable=lambda value: None not in value[1].values())
+    return dict(results, timings={} if cached else timings, cached=cached)
+
+# ----- 全体検索（/api/search） -----
+
+# 英数字は単語、それ以外（日本語など）は連続部分として取り出す
+_SEARCH_TOKEN = re.compile(r'[a-z0-9]+|[^\W_a-z0-9]+')
+_SEARCH_TERM_SPLIT = re.compile(r'[\s、。！？!?・,.\(\)（）「」『』\[\]【】"]+')
+SEARCH_KINDS = ('video', 'segment', 'qa', 'knowledge')
+
+def search_tokens(text):
+    """検索インデックス用にテキストを分割（英数字は単語、日本語は2文字ずつ重ねて区切った文字列）
+    
+    日本語の連続部分は末尾の1文字も加え、1文字の検索語が前方一致で見つかるようにする。
+    """
+    tokens = []
+    for run in _SEARCH_TOKEN.findall(unicodedata.normalize('NFKC', text or '').lower()):
+        if run.isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+    return ' '.join(tokens)
+
+def search_match_expression(query):
+    """検索語（空白区切り、すべてを含む文書が対象）から search_fts の MATCH 式とハイライトする語を作る
+    
+    英数字と1文字の語は前方一致、2文字以上の日本語は2文字ずつのフレーズで一致させる。
+    """
+    clauses = []
+    terms = []
+    for term in _SEARCH_TERM_SPLIT.split(unicodedata.normalize('NFKC', query).lower()):
+        for run in _SEARCH_TOKEN.findall(term):
+            if run in terms:
+                continue
+            terms.append(run)
+            if run.isascii() or len(run) == 1:
+                clauses.append(f'"{run}"*')
             else:
-                knowledge_results = []
-            knowledge.extend([dict(k) for k in knowledge_results])
+                clauses.append('"' + ' '.join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+    return ' AND '.join(clauses[:8]), terms[:8]
+
+def highlight_snippet(text, terms, width=120):
+    """最初に一致した位置の周辺 width 文字を、一致部分を <mark> で囲んで返す（HTMLエスケープ済み）"""
+    text = unicodedata.normalize('NFKC', text or '')
+    pattern = re.compile('|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, min(match.start() - width // 3, len(text) - width)) if match else 0
+    snippet = text[start:start + width]
+    parts = []
+    pos = 0
+    for m in pattern.finditer(snippet):
+        parts.append(str(escape(snippet[pos:m.start()])))
+        parts.append(f"<mark>{escape(m.group())}</mark>")
+        pos = m.end()
+    parts.append(str(escape(snippet[pos:])))
+    return ('…' if start else '') + ''.join(parts) + ('…' if start + width < len(text) else '')
+
+def build_search_document(db, kind, ref_id):
+    """search_documents の1行（kind, ref_id, video_id, tenant_id, industry_id, title, body, 開始秒, 終了秒）
+    
+    出典が削除されていれば None。Q&Aは質問と回答をまとめて1つのスレッドとして索引する。
+    """
+    if kind == 'video':
+        row = db.execute('SELECT id, title, description FROM videos WHERE id = ?', (ref_id,)).fetchone()
+        return row and (kind, ref_id, row['id'], None, None, row['title'], row['description'], None, None)
+    if kind == 'segment':
+        row = db.execute('''
+            SELECT video_id, content, timestamp_start, timestamp_end FROM video_transcripts
+            WHERE id = ? AND content_type = 'segment'
+        ''', (ref_id,)).fetchone()
+        return row and (kind, ref_id, row['video_id'], None, None, None, row['content'],
+                        row['timestamp_start'], row['timestamp_end'])
+    if kind == 'qa':
+        row = db.execute('SELECT video_id, tenant_id, question_text FROM video_questions WHERE id = ?',
+                         (ref_id,)).fetchone()
+        if row is None:
+            return None
+        answers = db.execute('SELECT answer_text FROM video_answers WHERE question_id = ? ORDER BY created_at, id',
+                             (ref_id,)).fetchall()
+        return (kind, ref_id, row['video_id'], row['tenant_id'], None, row['question_text'],
+                '\n'.join(a['answer_text'] for a in answers), None, None)
+    if kind == 'knowledge':
+        row = db.execute('SELECT industry_id, title, content FROM external_knowledge WHERE id = ?',
+                         (ref_id,)).fetchone()
+        return row and (kind, ref_id, None, None, row['industry_id'], row['title'], row['content'], None, None)
+    return None
+
+def sync_search_index(db, batch_size=500, max_batches=None):
+    """search_queue（トリガーで登録）の文書を検索インデックスに作り直す（処理した文書数を返す）
+    
+    呼び出し元のトランザクションが開いている場合は何もしない（次回の検索時に処理）。
+    max_batches を指定すると、その回数分のバッチだけ処理して戻る。
+    """
+    processed = 0
+    batches = 0
+    while not db.in_transaction and (max_batches is None or batches < max_batches):
+        batches += 1
+        queued = db.execute('SELECT id, kind, ref_id FROM search_queue ORDER BY id LIMIT ?',
+                            (batch_size,)).fetchall()
+        if not queued:
+            break
+        targets = list(dict.fromkeys((q['kind'], q['ref_id']) for q in queued))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for kind, ref_id in targets:
+                db.execute('DELETE FROM search_documents WHERE kind = ? AND ref_id = ?', (kind, ref_id))
+                doc = build_search_document(db, kind, ref_id)
+                if doc is None:
+                    continue
+                cursor = db.execute('''
+                    INSERT INTO search_documents
+                    (kind, ref_id, video_id, tenant_id, industry_id, title, body, timestamp_start, timestamp_end)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', doc)
+                db.execute('INSERT INTO search_fts (rowid, title, body) VALUES (?, ?, ?)',
+                           (cursor.lastrowid, search_tokens(doc[5]), search_tokens(doc[6])))
+            db.execute('DELETE FROM search_queue WHERE id <= ?', (queued[-1]['id'],))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        processed += len(targets)
+    return processed
+
+def search_content(db, query, industry_id, is_admin, role, tenant_id,
+                   kind=None, category_id=None, cursor=None, per_page=20):
+    """検索インデックスから、閲覧できる動画・セグメント・Q&A・外部ナレッジを関連度順に検索
+    
+    アクセス制御は get_accessible_category_ids（動画に紐づく結果）、テナント（Q&A、super_adminは全テナント）、
+    業種（外部ナレッジ、管理者は全業種）で行う。
+    ページングは前のページ末尾の (スコア, 文書ID) を cursor に渡すキーセット方式。
+    facets は検索語に一致する結果のカテゴリー別・種類別の件数（それぞれ自身の絞り込みは除いて数える）。
+    
+    Raises:
+        ValueError: 検索語がない、または cursor が不正
+    """
+    expression, terms = search_match_expression(query)
+    if not expression:
+        raise ValueError('検索語を入力してください')
+    after = None
+    if cursor:
+        try:
+            score, doc_id = cursor.rsplit(':', 1)
+            after = (float(score), int(doc_id))
+        except ValueError:
+            raise ValueError('cursor が不正です')
+    
+    sync_index_queue_inline(db, sync_search_index, 'search_queue')
+    key = ('search', expression, kind, category_id, after, per_page,
+           industry_id, bool(is_admin), role == 'super_admin', tenant_id)
+    
+    def compute():
+        category_ids = get_accessible_category_ids(db, industry_id, is_admin)
+        in_categories = f" OR v.category_id IN ({','.join('?' * len(category_ids))})" if category_ids else ''
+        category_sql = f'v.id IS NOT NULL AND (v.category_id IS NULL{in_categories})'
+        tenant_sql, tenant_params = ('1', []) if role == 'super_admin' else ('d.tenant_id = ?', [tenant_id])
+        knowledge_sql, knowledge_params = ('1', []) if is_admin else \
+            (('d.industry_id = ?', [industry_id]) if industry_id else ('0', []))
+        base_sql = f'''
+            FROM search_fts
+            JOIN search_documents d ON d.id = search_fts.rowid
+            LEFT JOIN videos v ON v.id = d.video_id
+            LEFT JOIN categories c ON c.id = v.category_id
+            WHERE search_fts MATCH ?
+              AND ((d.kind IN ('video', 'segment') AND {category_sql})
+                   OR (d.kind = 'qa' AND {category_sql} AND {tenant_sql})
+                   OR (d.kind = 'knowledge' AND {knowledge_sql}))
+        '''
+        base_params = [expression, *category_ids, *category_ids, *tenant_params, *knowledge_params]
+        kind_sql, kind_params = (' AND d.kind = ?', [kind]) if kind else ('', [])
+        category_filter_sql, category_filter_params = (' AND v.category_id = ?', [category_id]) \
+            if category_id else ('', [])
         
-        # 重複を除去（タイトルベース）
-        seen_titles = set()
-        unique_knowledge = []
-        for k in knowledge:
-            if k['title'] not in seen_titles:
-                seen_titles.add(k['title'])
-                unique_knowledge.append(k)
-        knowledge = unique_knowledge[:5]
-    except Exception as e:
-        # external_knowledge テーブルが存在しない場合はスキップ
-        knowledge = []
+        score_sql = 'bm25(search_fts, 5.0, 1.0)'  # タイトルの一致を重視
+        page_sql = f'{base_sql}{kind_sql}{category_filter_sql}'
+        page_params = [*base_params, *kind_params, *category_filter_params]
+        if after:
+            page_sql += f' AND ({score_sql} > ? OR ({score_sql} = ? AND d.id > ?))'
+            page_params += [after[0], after[0], after[1]]
+        rows = db.execute(f'''
+            SELECT d.id, d.kind, d.ref_id, d.title, d.body, d.timestamp_start, d.timestamp_end,
+                   v.id AS video_id, v.title AS video_title, v.slug AS video_slug,
+                   c.id AS category_id, c.name AS category_name, {score_sql} AS score
+            {page_sql}
+            ORDER BY score, d.id
+            LIMIT ?
+        ''', (*page_params, per_page + 1)).fetchall()
+        
+        results = []
+        for r in rows[:per_page]:
+            video = {'id': r['video_id'], 'title': r['video_title'], 'slug': r['video_slug']} \
+                if r['video_id'] else None
+            text = r['body'] if r['body'] and any(t in unicodedata.normalize('NFKC', r['body']).lower()
+                                                   for t in terms) else r['title']
+            results.append({
+                'type': r['kind'],
+                'id': r['ref_id'],
+                'title': r['video_title'] if r['kind'] == 'segment' else r['title'],
+                'snippet': highlight_snippet(text, terms),
+                'video': video,
+                'category': {'id': r['category_id'], 'name': r['category_name']} if r['category_id'] else None,
+                'timestamp_start': r['timestamp_start'],
+                'timestamp_end': r['timestamp_end'],
+                'url': f"/watch/{video['slug'] or video['id']}" if video else None
+            })
+        next_cursor = f"{rows[per_page - 1]['score']!r}:{rows[per_page - 1]['id']}" if len(rows) > per_page else None
+        
+        categories = db.execute(f'''
+            SELECT c.id, c.name, COUNT(*) AS count {base_sql}{kind_sql}
+            GROUP BY c.id ORDER BY count DESC, c.id
+        ''', (*base_params, *kind_params)).fetchall()
+        kinds = db.execute(f'''
+            SELECT d.kind, COUNT(*) AS count {base_sql}{category_filter_sql}
+            GROUP BY d.kind
+        ''', (*base_params, *category_filter_params)).fetchall()
+        return {
+            'results': results,
+            'next_cursor': next_cursor,
+            'facets': {
+                'categories': [{'id': c['id'], 'name': c['name'], 'count': c['count']} for c in categories],
+                'types': {k['kind']: k['count'] for k in kinds}
+            }
+        }
     
+    # Q&A・セグメントの更新は search_version だけが増える（チャットのキャッシュは無効にしない）
+    result, _ = cached_retrieval(db, key, compute, version_keys=('content_version', 'search_version'))
+    return result
+
+# ----- タイトル補完（/api/suggest） -----
+
+_KATAKANA_TO_HIRAGANA = {c: c - 0x60 for c in range(ord('ァ'), ord('ヶ') + 1)}
+SUGGEST_SCAN_LIMIT = 200  # 1回の補完で調べるキーの上限（短い入力で候補が多すぎる場合）
+
+def normalize_suggest_text(text):
+    """補完のキー・入力を正規化（NFKC・小文字・カタカナをひらがなに・空白や記号を除去）"""
+    text = unicodedata.normalize('NFKC', text or '').lower().translate(_KATAKANA_TO_HIRAGANA)
+    return re.sub(r'[\W_]+', '', text)
+
+def suggest_keys(title, slug=None):
+    """タイトルの補完キー {(キー, 語の位置)}
+    
+    表記・ひらがな読み・ローマ字（ヘボン式・訓令式）のそれぞれで、各語の先頭から末尾までをキーにする
+    （「予約」「よやく」「yoyaku」で「ホテルの予約管理」が見つかる）。スラッグも位置0のキーにする。
+    """
+    items = [item for item in get_kakasi().convert(unicodedata.normalize('NFKC', title or '')) if item['orig'].strip()]
+    keys = {}
+    for position in range(len(items)):
+        for form in ('orig', 'hira', 'hepburn', 'kunrei'):
+            key = normalize_suggest_text(''.join(item[form] for item in items[position:]))
+            if key and key not in keys:
+                keys[key] = position
+    if slug:
+        keys.setdefault(normalize_suggest_text(slug), 0)
+    return set(keys.items())
+
+class SuggestIndex:
+    """動画・カテゴリーのタイトルの前方一致インデックス（(キー, 位置, 種類, ID) のソート済み配列を bisect で検索）
+    
+    コンテンツのバージョンが変わったときだけDBと突き合わせ、タイトル・スラッグ・カテゴリーが
+    変わった項目のキーだけを作り直す（読み・ローマ字への変換は変更分のみ）。
+    """
+    
+    def __init__(self):
+        self._keys = []
+        self._items = {}  # (種類, ID) -> {'title', 'slug', 'category_id', 'keys'}
+        self._lock = threading.Lock()
+        self.version = None
+        self.db_path = None
+    
+    def _add(self, ref, title, slug, category_id):
+        """項目を登録し、追加するキーの一覧を返す"""
+        keys = suggest_keys(title, slug)
+        self._items[ref] = {'title': title, 'slug': slug, 'category_id': category_id, 'keys': keys}
+        return [(key, position, *ref) for key, position in keys]
+    
+    def _remove(self, ref):
+        """項目の登録を外し、削除するキーの一覧を返す"""
+        return [(key, position, *ref) for key, position in self._items.pop(ref)['keys']]
+    
+    def refresh(self, db):
+        """DBの変更を反映（作り直した項目数を返す）
+        
+        追加・削除するキーをまとめてから、キーの配列を1度だけ作り直す
+        （既存のキーはソート済みのため、末尾に追加したキーとのマージで済む）。
+        """
+        version = content_version(db)
+        path = database_file(db)
+        if version is not None and version == self.version and path == self.db_path:
+            return 0
+        rows = {('video', r['id']): (r['title'], r['slug'], r['category_id'])
+                for r in db.execute('SELECT id, title, slug, category_id FROM videos')}
+        rows.update({('category', r['id']): (r['name'], r['slug'], r['id'])
+                     for r in db.execute('SELECT id, name, slug FROM categories')})
+        changed = 0
+        with self._lock:
+            if path != self.db_path:
+                self._keys = []
+                self._items = {}
+            removed = set()
+            added = []
+            for ref in [ref for ref in self._items if ref not in rows]:
+                removed.update(self._remove(ref))
+                changed += 1
+            for ref, (title, slug, category_id) in rows.items():
+                item = self._items.get(ref)
+                if item and (item['title'], item['slug'], item['category_id']) == (title, slug, category_id):
+                    continue
+                if item:
+                    removed.update(self._remove(ref))
+                added += self._add(ref, title, slug, category_id)
+                changed += 1
+            if removed or added:
+                # 検索中のスレッドが古い配列を読み続けられるよう、新しい配列に差し替える
+                keys = [entry for entry in self._keys if entry not in removed] + added
+                keys.sort()
+                self._keys = keys
+            self.version = version
+            self.db_path = path
+        return changed
+    
+    def lookup(self, query, accessible_category_ids, limit=8):
+        """入力で始まるタイトルを、閲覧できるものに絞って返す（タイトルの先頭から一致するものを優先）"""
+        prefix = normalize_suggest_text(query)
+        if not prefix:
+            return []
+        found = {}
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            for key, position, kind, item_id in self._keys[start:start + SUGGEST_SCAN_LIMIT]:
+                if not key.startswith(prefix):
+                    break
+                item = self._items[(kind, item_id)]
+                if item['category_id'] is not None and item['category_id'] not in accessible_category_ids:
+                    continue
+                if (kind, item_id) not in found or position < found[(kind, item_id)][0]:
+                    found[(kind, item_id)] = (position, item)
+        ranked = sorted(found.items(), key=lambda f: (f[1][0], len(f[1][1]['title']), f[1][1]['title']))
+        return [{
+            'type': kind,
+            'id': item_id,
+            'title': item['title'],
+            'slug': item['slug'],
+            'url': f"/{'watch' if kind == 'video' else 'courses'}/{item['slug'] or item_id}"
+        } for (kind, item_id), (_, item) in ranked[:limit]]
+
+suggest_index = SuggestIndex()
+
+# ----- Rakuten AI 3.0 API HTTPクライアント（接続プール共有） -----
+
+_llm_client = None
+_llm_client_pid = None
+_llm_client_lock = threading.Lock()
+
+def llm_client_options():
+    """httpxクライアント（同期・非同期共通）の接続プール・タイムアウト設定"""
+    http2 = RAKUTEN_AI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("[LLM] h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+    # SSL検証を無効化（社内ネットワーク対応）
     return {
-        'videos': unique_videos[:5],
-        'transcripts': transcripts[:3],
-        'usecases': usecases[:3],
-        'knowledge': knowledge
+        'verify': False,
+        'http2': http2,
+        'timeout': httpx.Timeout(RAKUTEN_AI_TIMEOUT, connect=RAKUTEN_AI_CONNECT_TIMEOUT),
+        'limits': httpx.Limits(
+            max_connections=RAKUTEN_AI_MAX_CONNECTIONS,
+            max_keepalive_connections=RAKUTEN_AI_MAX_KEEPALIVE,
+            keepalive_expiry=RAKUTEN_AI_KEEPALIVE_EXPIRY
+        )
     }
 
-# Rakuten AI 3.0 APIを呼び出す
-def call_rakuten_ai(prompt, context="", available_videos=None):
-    """Rakuten AI 3.0 APIを呼び出して回答を生成"""
-    try:
-        # OpenAI互換のエンドポイントを使用
-        headers = {
-            "Authorization": f"Bearer {RAKUTEN_AI_API_KEY}",
-            "Content-Type": "application/json"
-        }
+def get_llm_client():
+    """プロセス共有のhttpxクライアントを取得（keep-alive・接続プール、fork後は作り直す）"""
+    global _llm_client, _llm_client_pid
+    with _llm_client_lock:
+        if _llm_client is None or _llm_client_pid != os.getpid():
+            _llm_client = httpx.Client(**llm_client_options())
+            _llm_client_pid = os.getpid()
+        return _llm_client
+
+@atexit.register
+def close_llm_client():
+    """共有クライアントの接続を閉じる（プロセス終了時）"""
+    global _llm_client
+    with _llm_client_lock:
+        if _llm_client is not None and _llm_client_pid == os.getpid():
+            _llm_client.close()
+        _llm_client = None
+
+class LLMMetrics:
+    """LLM呼び出しごとの所要時間（接続・最初のバイトまで・全体）を直近N件保持"""
+    
+    def __init__(self, maxlen=1000):
+        self._records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+    
+    def record(self, operation, connect_ms, ttfb_ms, total_ms, status, ttft_ms=None):
+        with self._lock:
+            self._records.append({
+                'operation': operation,
+                'connect_ms': connect_ms,
+                'ttfb_ms': ttfb_ms,
+                'ttft_ms': ttft_ms,
+                'total_ms': total_ms,
+                'status': status
+            })
+    
+    def summary(self):
+        """操作ごとの件数・接続再利用率・各所要時間のp50/p95（ストリーミングは最初のトークンまでの時間も）"""
+        with self._lock:
+            records = list(self._records)
         
-        # 利用可能なビデオリストを作成
-        video_list = ""
-        if available_videos:
-            video_list = "\n利用可能なトレーニング動画:\n" + "\n".join([f"- {v['title']}" for v in available_videos])
+        def percentile(values, p):
+            if not values:
+                return None
+            values = sorted(values)
+            return round(values[min(len(values) - 1, int(len(values) * p))], 1)
         
-        messages = [
-            {
-                "role": "system",
-                "content": f"""あなたは業務での生成AI活用を支援するエキスパートアシスタントです。
+        result = {}
+        for operation in sorted({r['operation'] for r in records}):
+            rows = [r for r in records if r['operation'] == operation]
+            stats = {
+                'count': len(rows),
+                'errors': sum(1 for r in rows if r['status'] != 200),
+                'connection_reuse_rate': round(sum(1 for r in rows if r['connect_ms'] == 0) / len(rows), 3)
+            }
+            for key in ('connect_ms', 'ttfb_ms', 'ttft_ms', 'total_ms'):
+                values = [r[key] for r in rows if r[key] is not None]
+                if key == 'ttft_ms' and not values:
+                    continue
+                stats[key] = {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+            result[operation] = stats
+        return result
+
+llm_metrics = LLMMetrics()
+
+def _llm_timing_trace(start, timing):
+    """httpcoreのトレースイベントから接続時間とTTFBを記録するコールバック"""
+    def trace(event_name, info):
+        now = (time.perf_counter() - start) * 1000
+        if event_name == 'connection.connect_tcp.started':
+            timing['connect_started'] = now
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            timing['connected'] = now
+        elif event_name.endswith('.receive_response_headers.complete'):
+            timing['ttfb'] = now
+    return trace
+
+def record_llm_call(operation, start, timing, status, ttft_ms=None):
+    """1回のLLM呼び出しの所要時間を記録（新規接続がなければ接続時間は0＝keep-aliveで再利用）"""
+    total_ms = (time.perf_counter() - start) * 1000
+    connect_ms = timing.get('connected', 0) - timing.get('connect_started', 0)
+    llm_metrics.record(operation, round(connect_ms, 1), timing.get('ttfb'), round(total_ms, 1),
+                       status, ttft_ms=ttft_ms)
+
+def parse_stream_line(line):
+    """OpenAI互換のストリーミング応答の1行を解析し、(終了したか, テキスト片) を返す"""
+    # "data: {...}" の行のみ扱い、"data: [DONE]" で終了
+    if not line.startswith('data:'):
+        return False, None
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return True, None
+    try:
+        choices = json.loads(data).get('choices') or []
+    except json.JSONDecodeError:
+        return False, None
+    return False, ((choices[0].get('delta') or {}).get('content') if choices else None)
+
+def _rakuten_ai_headers():
+    return {
+        "Authorization": f"Bearer {RAKUTEN_AI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+class LLMHTTPError(RuntimeError):
+    """APIが200以外を返した（ストリーミング時）"""
+    
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"API Error: {status_code} - {text}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def post_rakuten_ai(payload, operation='chat', timeout=None):
+    """共有クライアントでchat/completionsを呼び出し、所要時間を記録してレスポンスを返す"""
+    headers = _rakuten_ai_headers()
+    start = time.perf_counter()
+    timing = {}
+    status = None
+    try:
+        response = get_llm_client().post(
+            f"{RAKUTEN_AI_BASE_URL}chat/completions",
+            headers=headers,
+            json=payload,
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+            extensions={'trace': _llm_timing_trace(start, timing)}
+        )
+        status = response.status_code
+        return response
+    finally:
+        record_llm_call(operation, start, timing, status)
+
+def stream_rakuten_ai(payload, operation='chat_stream', timeout=None):
+    """stream: trueでchat/completionsを呼び出し、生成されたテキスト片を順に返すジェネレータ
+    
+    APIエラー時はLLMHTTPErrorを送出する。最初のトークンまでの時間（TTFT）も記録する。
+    """
+    start = time.perf_counter()
+    timing = {}
+    status = None
+    ttft_ms = None
+    try:
+        with get_llm_client().stream(
+            'POST',
+            f"{RAKUTEN_AI_BASE_URL}chat/completions",
+            headers=_rakuten_ai_headers(),
+            json=dict(payload, stream=True),
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+            extensions={'trace': _llm_timing_trace(start, timing)}
+        ) as response:
+            status = response.status_code
+            if response.status_code != 200:
+                response.read()
+                raise LLMHTTPError(response.status_code, response.text, response.headers.get('Retry-After'))
+            
+            for line in response.iter_lines():
+                done, text = parse_stream_line(line)
+                if done:
+                    break
+                if text:
+                    if ttft_ms is None:
+                        ttft_ms = round((time.perf_counter() - start) * 1000, 1)
+                    yield text
+    finally:
+        record_llm_call(operation, start, timing, status, ttft_ms=ttft_ms)
+
+# ----- 障害時の保護（同時実行数・制限時間・再試行・サーキットブレーカー） -----
+
+class LLMUnavailableError(Exception):
+    """LLMを呼び出せない（ブレーカー作動中・混雑・制限時間切れ・再試行しても失敗）"""
+
+class Deadline:
+    """リクエスト全体（検索＋回答生成）の制限時間"""
+    
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+class CircuitBreaker:
+    """連続して失敗したら一定時間呼び出しを止める
+    
+    closed: 通常 → 連続失敗が閾値に達すると open: 即座に拒否
+    → reset_seconds 経過で half_open: 1件だけ試しに通し（他は結果が出るまで拒否）、
+      成功すれば closed、失敗すれば再び open
+    試行が結果を記録しないまま reset_seconds を過ぎた場合は、失われたとみなして次の1件を通す。
+    """
+    
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+    
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._state == 'open':
+                if now - self._opened_at < self.reset_seconds:
+                    return False
+                self._state = 'half_open'
+                self._probe_started = None
+            if self._state == 'half_open':
+                if self._probe_started is not None and now - self._probe_started < self.reset_seconds:
+                    return False
+                self._probe_started = now
+            return True
+    
+    def abandon(self):
+        """allow() で通した呼び出しを、結果を記録せずにやめた（同時実行数の空き待ちで断念など）"""
+        with self._lock:
+            self._probe_started = None
+    
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._probe_started = None
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started = None
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    print(f"[LLM] サーキットブレーカー作動（連続失敗 {self._failures} 回）")
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'retry_in_seconds': round(max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at)), 1)
+                if self._state == 'open' else None
+            }
+
+llm_circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS)
+llm_semaphore = threading.BoundedSemaphore(RAKUTEN_AI_MAX_CONCURRENT)
+
+# 再試行する（一時的な障害とみなす）ステータスコード
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def retry_delay(attempt, retry_after, deadline):
+    """次の再試行までの待ち秒数（Retry-Afterを優先、なければ指数バックオフ＋ジッター）
+    
+    再試行回数の上限に達したか、待つと制限時間を超える場合はNone。
+    """
+    if attempt >= RAKUTEN_AI_MAX_RETRIES:
+        return None
+    delay = random.uniform(0, RAKUTEN_AI_RETRY_BASE_SECONDS * 2 ** attempt)
+    if retry_after and str(retry_after).isdigit():
+        delay = float(retry_after)
+    if delay >= deadline.remaining():
+        return None
+    return delay
+
+def deadline_timeout(deadline):
+    """制限時間の残りに合わせたhttpxのタイムアウト"""
+    remaining = min(RAKUTEN_AI_TIMEOUT, deadline.remaining())
+    return httpx.Timeout(remaining, connect=min(RAKUTEN_AI_CONNECT_TIMEOUT, remaining))
+
+def guarded_post_rakuten_ai(payload, deadline, operation='chat'):
+    """サーキットブレーカー・同時実行数上限・制限時間・再試行付きでchat/completionsを呼び出す
+    
+    一時的な障害（429/5xx・接続エラー・タイムアウト）で回答を得られない場合はLLMUnavailableErrorを送出する。
+    """
+    if not llm_circuit_breaker.allow():
+        raise LLMUnavailableError('circuit_open')
+    if not llm_semaphore.acquire(timeout=deadline.remaining()):
+        llm_circuit_breaker.abandon()
+        raise LLMUnavailableError('busy')
+    try:
+        attempt = 0
+        while True:
+            if deadline.expired:
+                llm_circuit_breaker.record_failure()
+                raise LLMUnavailableError('deadline')
+            retry_after = None
+            try:
+                response = post_rakuten_ai(payload, operation, timeout=deadline_timeout(deadline))
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    llm_circuit_breaker.record_success()
+                    return response
+                error = f"API Error: {response.status_code}"
+                retry_after = response.headers.get('Retry-After')
+            
+            delay = retry_delay(attempt, retry_after, deadline)
+            if delay is None:
+                llm_circuit_breaker.record_failure()
+                raise LLMUnavailableError(error)
+            time.sleep(delay)
+            attempt += 1
+    finally:
+        llm_semaphore.release()
+
+def guarded_stream_rakuten_ai(payload, deadline, operation='chat_stream'):
+    """guarded_post_rakuten_ai のストリーミング版
+    
+    制限時間は最初のトークンまでに適用し、再試行もトークンを送り始める前の失敗のみ行う。
+    """
+    if not llm_circuit_breaker.allow():
+        raise LLMUnavailableError('circuit_open')
+    if not llm_semaphore.acquire(timeout=deadline.remaining()):
+        llm_circuit_breaker.abandon()
+        raise LLMUnavailableError('busy')
+    try:
+        attempt = 0
+        while True:
+            if deadline.expired:
+                llm_circuit_breaker.record_failure()
+                raise LLMUnavailableError('deadline')
+            started = False
+            try:
+                for text in stream_rakuten_ai(payload, operation, timeout=deadline_timeout(deadline)):
+                    started = True
+                    yield text
+                llm_circuit_breaker.record_success()
+                return
+            except (httpx.TransportError, LLMHTTPError) as e:
+                retryable = not isinstance(e, LLMHTTPError) or e.status_code in RETRYABLE_STATUS_CODES
+                if not retryable:
+                    llm_circuit_breaker.record_success()
+                    raise
+                if started:
+                    llm_circuit_breaker.record_failure()
+                    raise
+                delay = retry_delay(attempt, getattr(e, 'retry_after', None), deadline)
+                if delay is None:
+                    llm_circuit_breaker.record_failure()
+                    raise LLMUnavailableError(str(e))
+            time.sleep(delay)
+            attempt += 1
+    finally:
+        llm_semaphore.release()
+
+@app.route('/api/admin/llm-metrics')
+@admin_required
+def get_llm_metrics():
+    """LLM呼び出しの所要時間（接続・TTFB・全体）の集計とサーキットブレーカーの状態"""
+    return jsonify({
+        'success': True,
+        'metrics': llm_metrics.summary(),
+        'circuit_breaker': llm_circuit_breaker.snapshot()
+    })
+
+# チャット回答用のリクエストを構築
+def build_chat_payload(prompt, context="", available_videos=None):
+    """チャット回答用のchat/completionsリクエストを組み立てる"""
+    # 利用可能なビデオリストを作成
+    video_list = ""
+    if available_videos:
+        video_list = "\n利用可能なトレーニング動画:\n" + "\n".join([f"- {v['title']}" for v in available_videos])
+    
+    messages = [
+        {
+            "role": "system",
+            "content": f"""あなたは業務での生成AI活用を支援するエキスパートアシスタントです。
 ユーザーの業種に合わせた具体的で実践的なアドバイスを提供してください。
 回答は簡潔で分かりやすく、箇条書きを活用してください。
 
@@ -2619,137 +4300,688 @@ def call_rakuten_ai(prompt, context="", available_videos=None):
 - 存在しないコンテンツ名を言及しないでください
 
 質問に対する実践的なアドバイスのみを提供してください。"""
-            }
-        ]
-        
-        if context:
-            messages.append({
-                "role": "system",
-                "content": f"参考情報:\n{context}"
-            })
-        
+        }
+    ]
+    
+    if context:
         messages.append({
-            "role": "user",
-            "content": prompt
+            "role": "system",
+            "content": f"参考情報:\n{context}"
         })
+    
+    messages.append({
+        "role": "user",
+        "content": prompt
+    })
+    
+    payload = {
+        "model": RAKUTEN_AI_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": 1000
+    }
+    return payload
+
+# Rakuten AI 3.0 APIを呼び出す
+def call_rakuten_ai(prompt, context="", available_videos=None, deadline=None):
+    """Rakuten AI 3.0 APIを呼び出して回答を生成
+    
+    一時的な障害で回答できない場合は 'unavailable': True を付けて返す（呼び出し側で検索結果のみの回答に切り替える）。
+    """
+    try:
+        payload = build_chat_payload(prompt, context, available_videos)
         
-        payload = {
-            "model": RAKUTEN_AI_MODEL,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 1000
-        }
+        # OpenAI互換のエンドポイントを使用（共有クライアントで接続を再利用）
+        response = guarded_post_rakuten_ai(payload, deadline or Deadline(CHAT_DEADLINE_SECONDS), 'chat')
         
-        # SSL検証を無効化（社内ネットワーク対応）
-        with httpx.Client(verify=False, timeout=60.0) as client:
-            response = client.post(
-                f"{RAKUTEN_AI_BASE_URL}chat/completions",
-                headers=headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    'success': True,
-                    'response': data['choices'][0]['message']['content']
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': f"API Error: {response.status_code} - {response.text}"
-                }
-                
+        if response.status_code == 200:
+            data = response.json()
+            return {
+                'success': True,
+                'response': data['choices'][0]['message']['content']
+            }
+        else:
+            return {
+                'success': False,
+                'error': f"API Error: {response.status_code} - {response.text}"
+            }
+    
+    except LLMUnavailableError as e:
+        return {
+            'success': False,
+            'unavailable': True,
+            'error': str(e)
+        }
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
 
-# チャットAPI
-@app.route('/api/chat', methods=['POST'])
-@login_required
-def chat_api():
-    data = request.json
-    message = data.get('message', '').strip()
+# ----- LLM応答キャッシュ -----
+
+def normalize_question(text):
+    """キャッシュキー用に質問を正規化（全角半角・大文字小文字・空白・末尾の記号の違いを吸収）"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = re.sub(r'\s+', '', text)
+    return text.rstrip('?!.。、')
+
+def llm_cache_key(question, industry_id, context_ids, context, payload):
+    """質問・業種・参考情報（IDと内容のハッシュ）・モデル・temperatureからキャッシュキーを作る
+    
+    参考情報の内容をキーに含めるため、ナレッジや文字起こしが更新されると
+    古いキャッシュには当たらなくなる（古いエントリはTTL/LRUで削除される）。
+    """
+    key_source = json.dumps([
+        normalize_question(question),
+        industry_id,
+        context_ids,
+        hashlib.sha256(context.encode('utf-8')).hexdigest(),
+        payload['model'],
+        payload['temperature']
+    ], ensure_ascii=False)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def record_cache_stat(db, name, hit):
+    """キャッシュのヒット/ミス件数を加算（呼び出し側でcommit）"""
+    db.execute('''
+        INSERT INTO cache_stats (name, hits, misses) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+    ''', (name, 1 if hit else 0, 0 if hit else 1))
+
+def get_cache_stats(db, name):
+    """キャッシュのヒット/ミス件数とヒット率"""
+    row = db.execute('SELECT hits, misses FROM cache_stats WHERE name = ?', (name,)).fetchone()
+    hits, misses = (row[0], row[1]) if row else (0, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None
+    }
+
+def _read_cached_response(db, cache_key):
+    """キャッシュ済みの回答を読み、最終利用日時を更新する（なし・期限切れはNone）"""
+    row = db.execute('SELECT response, created_at FROM llm_response_cache WHERE cache_key = ?',
+                     (cache_key,)).fetchone()
+    now = time.time()
+    if row and now - row[1] <= LLM_CACHE_TTL_SECONDS:
+        db.execute('UPDATE llm_response_cache SET hit_count = hit_count + 1, last_used_at = ? WHERE cache_key = ?',
+                   (now, cache_key))
+        return row[0]
+    if row:
+        db.execute('DELETE FROM llm_response_cache WHERE cache_key = ?', (cache_key,))
+    return None
+
+def get_cached_llm_response(db, cache_key):
+    """キャッシュ済みの回答を返す（なし・期限切れはNone）"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        response = _read_cached_response(db, cache_key)
+    except sqlite3.OperationalError:
+        return None  # キャッシュテーブルがない場合はキャッシュなしで実行
+    record_cache_stat(db, 'llm_response', response is not None)
+    db.commit()
+    return response
+
+def store_llm_response(db, cache_key, industry_id, question, response, context_ids):
+    """回答をキャッシュに保存し、期限切れと上限超過分（最終利用が古い順）を削除
     
-    if not message:
-        return jsonify({'success': False, 'error': 'メッセージが空です'}), 400
+    context_ids は回答に使った参考情報（"video:3" など）。参考情報が更新・削除されるとトリガーで削除され、
+    類似質問キャッシュはそのうえで動画の閲覧権限を確認して使う。
+    """
+    if not LLM_CACHE_ENABLED:
+        return
+    now = time.time()
+    try:
+        db.execute('''
+            INSERT OR REPLACE INTO llm_response_cache
+                (cache_key, industry_id, question, response, context_ids, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (cache_key, industry_id, question, response, json.dumps(context_ids), now, now))
+        db.execute('DELETE FROM llm_response_cache WHERE created_at < ?', (now - LLM_CACHE_TTL_SECONDS,))
+        db.execute('''
+            DELETE FROM llm_response_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (LLM_CACHE_MAX_ENTRIES,))
+        db.commit()
+    except sqlite3.OperationalError as e:
+        print(f"LLM応答キャッシュ保存エラー: {e}")
+
+# ----- 類似質問キャッシュ -----
+
+def question_ngrams(text):
+    """質問を文字bigramに分解（ひらがな・記号で区切り、内容語の並びだけを使う）"""
+    grams = Counter()
+    for part in re.split(r'[ぁ-ん]+|[^\w]+', normalize_question(text)):
+        if len(part) == 1:
+            grams[part] += 1
+        for i in range(len(part) - 1):
+            grams[part[i:i + 2]] += 1
+    return grams
+
+class CharNgramVectorizer:
+    """文字n-gramのTF-IDFで質問をベクトル化（埋め込みモデルがない場合の代替）
+    
+    IDFが質問の集合に依存するため、質問が増えたら全体を作り直す（n-gramの集計だけなので軽い）。
+    """
+    
+    backend = 'ngram'
+    incremental = False
+    
+    def fit(self, texts):
+        docs = [question_ngrams(t) for t in texts]
+        df = Counter()
+        for doc in docs:
+            df.update(doc.keys())
+        self._idf = {g: math.log((1 + len(docs)) / (1 + n)) + 1 for g, n in df.items()}
+        # 既存の質問にないn-gramは最大の重みにして、共通部分だけで類似度が高くならないようにする
+        self._unseen_idf = math.log(1 + len(docs)) + 1
+        return [self._weight(doc) for doc in docs]
+    
+    def transform(self, text):
+        return self._weight(question_ngrams(text))
+    
+    def _weight(self, grams):
+        vector = {g: count * self._idf.get(g, self._unseen_idf) for g, count in grams.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {g: v / norm for g, v in vector.items()}
+    
+    def stack(self, vectors):
+        return list(vectors)
+    
+    def similarities(self, query, vectors):
+        return [sum(weight * vector.get(g, 0.0) for g, weight in query.items()) for vector in vectors]
+
+class SentenceEmbeddingVectorizer:
+    """ローカルの埋め込みモデル（sentence-transformers、CPU）で質問をベクトル化
+    
+    質問のベクトルは他の質問に依存しないため、新しく回答した質問だけをベクトル化して索引に追加する。
+    """
+    
+    backend = 'embedding'
+    incremental = True
+    
+    def __init__(self, model):
+        self._model = model
+    
+    def fit(self, texts):
+        if not texts:
+            return []
+        return list(self._model.encode([normalize_question(t) for t in texts], normalize_embeddings=True))
+    
+    def transform(self, text):
+        return self._model.encode([normalize_question(text)], normalize_embeddings=True)[0]
+    
+    def stack(self, vectors):
+        return np.array(vectors) if vectors else []
+    
+    def similarities(self, query, vectors):
+        return [float(v) for v in vectors @ query] if len(vectors) else []
+
+class SemanticCache:
+    """業種ごとの回答済み質問のベクトル索引
+    
+    llm_response_cache の内容から作成する。前回から保存された回答だけを読み込んでベクトル化し
+    （n-gramの場合は全体を作り直す）、削除された回答は索引から除く。ベクトル化はロックの外で行い、
+    ロック中は索引の差し替えだけを行うため、再構築中も他の業種・他のリクエストの検索を待たせない。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._indexes = {}
+        self._model = None
+        self._model_loaded = False
+    
+    def _vectorizer(self):
+        with self._model_lock:
+            if not self._model_loaded:
+                self._model_loaded = True
+                if SEMANTIC_CACHE_MODEL:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                        self._model = SentenceTransformer(SEMANTIC_CACHE_MODEL, device='cpu')
+                    except Exception as e:
+                        print(f"[SemanticCache] 埋め込みモデルを読み込めません（文字n-gramで代替）: {e}")
+        return SentenceEmbeddingVectorizer(self._model) if self._model else CharNgramVectorizer()
+    
+    @property
+    def backend(self):
+        return self._vectorizer().backend
+    
+    @property
+    def threshold(self):
+        if SEMANTIC_CACHE_THRESHOLD:
+            return float(SEMANTIC_CACHE_THRESHOLD)
+        return 0.85 if self.backend == 'embedding' else 0.45
+    
+    def _index(self, db, industry_id):
+        with self._lock:
+            index = self._indexes.get(industry_id)
+        since = index['rowid'] if index else 0
+        rows = db.execute('''
+            SELECT rowid, cache_key, question, context_ids FROM llm_response_cache
+            WHERE industry_id IS ? AND rowid > ? ORDER BY rowid
+        ''', (industry_id, since)).fetchall()
+        count = db.execute('SELECT COUNT(*) FROM llm_response_cache WHERE industry_id IS ?',
+                           (industry_id,)).fetchone()[0]
+        if index and not rows and len(index['keys']) == count:
+            return index
+        
+        # 回答の質問・参考情報（{cache_key: (質問, context_ids)}）
+        entries = dict(index['entries']) if index else {}
+        for row in rows:
+            entries[row[1]] = (row[2], tuple(json.loads(row[3] or '[]')))
+        if len(entries) != count:
+            live = {r[0] for r in db.execute('SELECT cache_key FROM llm_response_cache WHERE industry_id IS ?',
+                                             (industry_id,)).fetchall()}
+            entries = {key: entry for key, entry in entries.items() if key in live}
+        
+        keys = list(entries)
+        if index and index['vectorizer'].incremental:
+            vectorizer = index['vectorizer']
+            vectors = {key: vector for key, vector in index['vectors'].items() if key in entries}
+            added = [key for key in keys if key not in vectors] + [row[1] for row in rows if row[1] in vectors]
+            vectors.update(zip(added, vectorizer.fit([entries[key][0] for key in added])))
+        else:
+            vectorizer = self._vectorizer()
+            vectors = dict(zip(keys, vectorizer.fit([entries[key][0] for key in keys])))
+        
+        new_index = {
+            'rowid': rows[-1][0] if rows else since,
+            'keys': keys,
+            'entries': entries,
+            'vectors': vectors,
+            'vectorizer': vectorizer,
+            'matrix': vectorizer.stack([vectors[key] for key in keys])
+        }
+        with self._lock:
+            current = self._indexes.get(industry_id)
+            # 並行して作られたより新しい索引があればそちらを使う
+            if current is not None and current is not index and current['rowid'] >= new_index['rowid']:
+                return current
+            self._indexes[industry_id] = new_index
+        return new_index
+    
+    def lookup(self, db, industry_id, question, accept=None):
+        """同じ業種で最も類似した回答済みの質問を返す（閾値未満ならNone）
+        
+        accept(context_ids) を指定した場合は、それが真になる回答だけを候補にする。
+        """
+        index = self._index(db, industry_id)
+        if not index['keys']:
+            return None
+        vectorizer = index['vectorizer']
+        similarities = vectorizer.similarities(vectorizer.transform(question), index['matrix'])
+        threshold = self.threshold
+        candidates = sorted((i for i, s in enumerate(similarities) if s >= threshold),
+                            key=similarities.__getitem__, reverse=True)
+        for best in candidates:
+            cache_key = index['keys'][best]
+            question_text, context_ids = index['entries'][cache_key]
+            if accept is not None and not accept(context_ids):
+                continue
+            return {
+                'cache_key': cache_key,
+                'question': question_text,
+                'similarity': round(similarities[best], 3)
+            }
+        return None
+    
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+semantic_cache = SemanticCache()
+
+def get_cached_chat_answer(db, chat, message):
+    """応答キャッシュを完全一致→類似質問（同じ業種）の順に引き、回答を返す（なければNone）
+    
+    類似質問の回答は、参考情報（context_ids）の動画・文字起こしの動画がすべて残っていて、
+    このユーザーの閲覧できるカテゴリーにある場合だけ使う。参考情報の更新・削除で回答はトリガーにより
+    削除されるため、無関係なコンテンツの更新では類似質問の回答は無効にならない。
+    """
+    cached = get_cached_llm_response(db, chat['cache_key'])
+    if cached is not None or not (LLM_CACHE_ENABLED and SEMANTIC_CACHE_ENABLED):
+        return cached
+    
+    accessible, _ = cached_retrieval(
+        db, ('accessible_categories', chat['industry_id'], bool(chat.get('is_admin'))),
+        lambda: frozenset(get_accessible_category_ids(db, chat['industry_id'], chat.get('is_admin'))))
+    
+    def accept(context_ids):
+        refs = {}
+        for cid in context_ids:
+            source, _, ref_id = cid.partition(':')
+            if source in ('video', 'transcript'):
+                refs.setdefault(source, []).append(int(ref_id))
+        video_ids = refs.get('video', [])
+        transcript_ids = refs.get('transcript', [])
+        if not (video_ids or transcript_ids):
+            return True
+        rows = db.execute(f'''
+            SELECT category_id FROM videos WHERE id IN ({','.join('?' * len(video_ids))})
+            UNION ALL
+            SELECT v.category_id FROM video_transcripts vt JOIN videos v ON v.id = vt.video_id
+            WHERE vt.id IN ({','.join('?' * len(transcript_ids))})
+        ''', video_ids + transcript_ids).fetchall()
+        return len(rows) == len(video_ids) + len(transcript_ids) and \
+            all(r[0] is None or r[0] in accessible for r in rows)
     
+    try:
+        match = semantic_cache.lookup(db, chat['industry_id'], message, accept)
+        cached = _read_cached_response(db, match['cache_key']) if match else None
+    except sqlite3.OperationalError:
+        return None
+    record_cache_stat(db, 'llm_semantic', cached is not None)
+    db.commit()
+    if cached is not None:
+        print(f"[SemanticCache] 類似質問のキャッシュを使用（類似度 {match['similarity']}）: {match['question']}")
+    return cached
+
+@app.route('/api/admin/llm-cache', methods=['GET', 'DELETE'])
+@admin_required
+def llm_cache_admin():
+    """LLM応答・検索結果キャッシュの件数・ヒット率の取得（DELETEで全削除）"""
     db = get_db()
-    industry_id = session.get('industry_id')
-    industry_name = session.get('industry_name', '全業種')
-    is_admin = session.get('is_admin', False)
+    if request.method == 'DELETE':
+        db.execute('DELETE FROM llm_response_cache')
+        db.execute("DELETE FROM cache_stats WHERE name IN ('llm_response', 'llm_semantic')")
+        db.commit()
+        semantic_cache.clear()
+        retrieval_cache.clear()
+        return jsonify({'success': True})
+    
+    stats = get_cache_stats(db, 'llm_response')
+    stats['entries'] = db.execute('SELECT COUNT(*) FROM llm_response_cache').fetchone()[0]
+    stats['ttl_seconds'] = LLM_CACHE_TTL_SECONDS
+    stats['max_entries'] = LLM_CACHE_MAX_ENTRIES
+    stats['enabled'] = LLM_CACHE_ENABLED
+    
+    # 類似質問キャッシュ（完全一致でヒットしなかった質問のうち、類似質問で回答できた割合）
+    semantic = get_cache_stats(db, 'llm_semantic')
+    semantic['enabled'] = SEMANTIC_CACHE_ENABLED
+    semantic['backend'] = semantic_cache.backend
+    semantic['threshold'] = semantic_cache.threshold
+    stats['semantic'] = semantic
+    
+    # 検索結果キャッシュ（プロセス内、このワーカーの件数）
+    retrieval = retrieval_cache.stats()
+    retrieval['enabled'] = RETRIEVAL_CACHE_ENABLED
+    retrieval['max_entries'] = RETRIEVAL_CACHE_MAX_ENTRIES
+    stats['retrieval'] = retrieval
+    
+    # 完全一致・類似質問を合わせた、API呼び出しを省略できた割合
+    total = stats['hits'] + stats['misses']
+    stats['overall_hit_rate'] = round((stats['hits'] + semantic['hits']) / total, 3) if total else None
+    return jsonify({'success': True, 'cache': stats})
+
+# ----- RAGコンテキストの組み立て（トークン予算） -----
+
+_TOKEN_PATTERN = re.compile(r'[\u4e00-\u9fff\u3400-\u4dbf]|[\u3040-\u30ff]+|[A-Za-z0-9_]+|\S')
+_SENTENCE_END = re.compile(r'(?<=[。！？!?\n])')
+
+def estimate_tokens(text):
+    """トークン数の概算（トークナイザーを読み込まずに正規表現だけで数える）
+    
+    漢字は1字1トークン、かなは2字で1トークン、英数字は4文字で1トークン、記号は1トークンとみなす。
+    """
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if piece[0] < '\u3040':
+            tokens += 1 if len(piece) == 1 and not piece.isalnum() else -(-len(piece) // 4)
+        elif piece[0] <= '\u30ff':
+            tokens += -(-len(piece) // 2)
+        else:
+            tokens += 1
+    return tokens
+
+def split_passages(text, max_chars=None):
+    """テキストを文の区切りで max_chars 程度のパッセージに分割"""
+    max_chars = max_chars or CONTEXT_PASSAGE_CHARS
+    passages = []
+    current = ''
+    for sentence in _SENTENCE_END.split(text):
+        if current and len(current) + len(sentence) > max_chars:
+            passages.append(current.strip())
+            current = ''
+        current += sentence
+        # 句点のない長文は文字数で区切る
+        while len(current) > max_chars * 2:
+            passages.append(current[:max_chars].strip())
+            current = current[max_chars:]
+    if current.strip():
+        passages.append(current.strip())
+    return [p for p in passages if p]
+
+def _char_trigrams(text):
+    text = re.sub(r'\s+', '', text)
+    return {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+
+# 出典ごとの重み（業界の専門知識を優先）と見出し
+CONTEXT_SECTIONS = [
+    ('knowledge', '【業界の専門知識・ユースケース情報】', 1.0),
+    ('usecase', '【関連ユースケース】', 0.9),
+    ('video', '【関連トレーニング動画】', 0.6),
+    ('transcript', '【動画の内容】', 0.8),
+]
+
+def pack_context(relevant, question, budget=None):
+    """検索結果をパッセージに分け、関連度順・重複除去のうえでトークン予算内に詰める
+    
+    スコア = 出典の重み / (1 + 検索順位) × (0.5 + 質問キーワードの出現割合)
+    
+    Returns:
+        dict: context（プロンプト用テキスト）, tokens（概算トークン数）, context_ids（使った出典）,
+              passages（候補数）, dropped（重複・予算超過で使わなかった数）
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    keywords = extract_keywords(question)
+    weights = {source: weight for source, _, weight in CONTEXT_SECTIONS}
+    
+    candidates = []
+    def add(source, rank, item_id, title, texts):
+        for index, text in enumerate(texts):
+            lowered = text.lower()
+            coverage = sum(1 for k in keywords if k in lowered) / len(keywords) if keywords else 0
+            candidates.append({
+                'source': source, 'rank': rank, 'index': index, 'id': f"{source}:{item_id}",
+                'title': title, 'text': text,
+                'score': weights[source] / (1 + rank) * (0.5 + coverage),
+                'tokens': estimate_tokens(text)
+            })
+    
+    for rank, k in enumerate(relevant.get('knowledge', [])):
+        add('knowledge', rank, k['id'], k['title'], split_passages(k['content']))
+    for rank, uc in enumerate(relevant['usecases']):
+        add('usecase', rank, uc['id'], uc['title'], [f"{uc['title']}: {uc['description']}"])
+    for rank, v in enumerate(relevant['videos']):
+        add('video', rank, v['id'], v['title'], [f"{v['title']}: {v.get('description') or ''}"])
+    for rank, t in enumerate(relevant['transcripts']):
+        title = t['video_title']
+        if t.get('timestamp_start') is not None:
+            title += f"（{format_timestamp(t['timestamp_start'])}〜）"
+        add('transcript', rank, t['id'], title, split_passages(t['content']))
+    
+    # スコアの高い順に、既に選んだパッセージと大きく重なるものを除いて予算まで詰める
+    selected = []
+    selected_trigrams = []
+    used = 0
+    opened = set()
+    titled = set()
+    headers = {source: header for source, header, _ in CONTEXT_SECTIONS}
+    for c in sorted(candidates, key=lambda c: -c['score']):
+        trigrams = _char_trigrams(c['text'])
+        if any(len(trigrams & other) >= 0.7 * min(len(trigrams), len(other)) for other in selected_trigrams):
+            continue
+        cost = c['tokens'] + 2
+        if c['source'] not in opened:
+            cost += estimate_tokens(headers[c['source']])
+        if c['source'] == 'knowledge' and c['id'] not in titled:
+            cost += estimate_tokens(c['title']) + 2
+        if used + cost > budget:
+            continue
+        used += cost
+        opened.add(c['source'])
+        if c['source'] == 'knowledge':
+            titled.add(c['id'])
+        selected.append(c)
+        selected_trigrams.append(trigrams)
+    
+    # 出典の順・元の並び順で組み立てる
+    parts = []
+    for source, header, _ in CONTEXT_SECTIONS:
+        chosen = sorted((c for c in selected if c['source'] == source), key=lambda c: (c['rank'], c['index']))
+        if not chosen:
+            continue
+        parts.append(("\n" if parts else "") + header)
+        if source == 'knowledge':
+            previous = None
+            for c in chosen:
+                if previous is None or previous['id'] != c['id']:
+                    parts.append(f"\n■ {c['title']}")
+                elif c['index'] != previous['index'] + 1:
+                    parts.append("…")
+                parts.append(c['text'])
+                previous = c
+        elif source == 'transcript':
+            parts.extend(f"- {c['title']}: {c['text']}" for c in chosen)
+        else:
+            parts.extend(f"- {c['text']}" for c in chosen)
+    
+    return {
+        'context': "\n".join(parts),
+        'tokens': used,
+        'context_ids': sorted({c['id'] for c in selected}),
+        'passages': len(candidates),
+        'dropped': len(candidates) - len(selected)
+    }
+
+def prepare_chat(db, message, industry_id, industry_name, is_admin):
+    """RAG検索で参考情報と推薦動画を準備する（業種別アクセス制御適用）
     
+    Returns:
+        dict: prompt, context, videos（検索結果）, recommended_videos（上位3件、スラッグ付き）,
+              payload（APIリクエスト）, cache_key, context_ids（応答キャッシュ用）, context_tokens
+    """
     # RAG検索で関連コンテンツを取得（業種別アクセス制御適用）
     relevant = search_relevant_content(db, message, industry_id, is_admin)
     
-    # コンテキストを構築
-    context_parts = []
-    
-    # 外部ナレッジを優先的に追加（業界の専門知識）
-    if relevant.get('knowledge'):
-        context_parts.append("【業界の専門知識・ユースケース情報】")
-        for k in relevant['knowledge']:
-            # コンテンツを適切な長さに切り詰め
-            content_preview = k['content'][:500] + '...' if len(k['content']) > 500 else k['content']
-            context_parts.append(f"\n■ {k['title']}\n{content_preview}")
+    # 関連度の高いパッセージからトークン予算内でコンテキストを構築
+    packed = pack_context(relevant, message)
+    print(f"[Context] {packed['tokens']}/{CONTEXT_TOKEN_BUDGET} tokens "
+          f"({packed['passages'] - packed['dropped']}/{packed['passages']} passages)")
+    print("[Retrieval] cache hit" if relevant.get('cached') else "[Retrieval] " + ", ".join(
+        f"{name} {'timeout' if ms is None else f'{ms}ms'}" for name, ms in relevant.get('timings', {}).items()))
+    
+    # 推薦動画を準備（スラッグを含める）
+    recommended_videos = []
+    for v in relevant['videos'][:3]:
+        # スラッグがなければ生成
+        slug = v.get('slug') or ensure_slug_for_video(db, v['id'])
+        recommended_videos.append({
+            'id': v['id'],
+            'slug': slug,
+            'title': v['title']
+        })
     
-    if relevant['usecases']:
-        context_parts.append("\n【関連ユースケース】")
-        for uc in relevant['usecases']:
-            context_parts.append(f"- {uc['title']}: {uc['description']}")
+    # プロンプトを構築
+    prompt = f"業種: {industry_name}\n\n質問: {message}"
+    context = packed['context']
+    payload = build_chat_payload(prompt, context, relevant['videos'])
     
-    if relevant['videos']:
-        context_parts.append("\n【関連トレーニング動画】")
-        for v in relevant['videos']:
-            context_parts.append(f"- {v['title']}: {v.get('description', '')}")
+    # 参考情報として使ったコンテンツのID（応答キャッシュのキーに含める。動画一覧はプロンプトに常に含まれる）
+    context_ids = sorted(set(packed['context_ids']) | {f"video:{v['id']}" for v in relevant['videos']})
     
-    if relevant['transcripts']:
-        context_parts.append("\n【動画の内容】")
-        for t in relevant['transcripts']:
-            content_preview = t['content'][:200] + '...' if len(t['content']) > 200 else t['content']
-            context_parts.append(f"- {t['video_title']}: {content_preview}")
+    return {
+        'prompt': prompt,
+        'context': context,
+        'videos': relevant['videos'],
+        'knowledge': relevant.get('knowledge', []),
+        'usecases': relevant['usecases'],
+        'recommended_videos': recommended_videos,
+        'industry_id': industry_id,
+        'is_admin': is_admin,
+        'payload': payload,
+        'context_ids': context_ids,
+        'context_tokens': packed['tokens'],
+        'cache_key': llm_cache_key(message, industry_id, context_ids, context, payload)
+    }
+
+def build_fallback_answer(chat):
+    """AIが回答できないときの、検索結果（専門知識・ユースケース）のみの回答"""
+    lines = ["現在AIアシスタントが応答できないため、質問に関連する情報をご案内します。"]
+    if chat['knowledge']:
+        lines.append("\n【関連する専門知識】")
+        for k in chat['knowledge'][:3]:
+            preview = k['content'][:150] + '...' if len(k['content']) > 150 else k['content']
+            lines.append(f"■ **{k['title']}**\n{preview}")
+    if chat['usecases']:
+        lines.append("\n【関連ユースケース】")
+        for uc in chat['usecases']:
+            lines.append(f"- **{uc['title']}**: {uc['description']}")
+    if len(lines) == 1:
+        lines.append("関連する情報が見つかりませんでした。しばらくしてから再度お試しください。")
+    if chat['recommended_videos']:
+        lines.append("\n関連するトレーニング動画もご覧ください。")
+    return "\n".join(lines)
+
+def save_chat_history(db, user_id, message, response, recommended_videos):
+    """チャット履歴を保存（失敗しても回答は返す）"""
+    try:
+        db.execute('''
+            INSERT INTO chat_history (user_id, message, response, recommended_videos)
+            VALUES (?, ?, ?, ?)
+        ''', (
+            user_id,
+            message,
+            response,
+            json.dumps([v['id'] for v in recommended_videos]) if recommended_videos else None
+        ))
+        db.commit()
+    except Exception as e:
+        print(f"チャット履歴保存エラー: {e}")
+
+# チャットAPI
+@app.route('/api/chat', methods=['POST'])
+@login_required
+def chat_api():
+    data = request.json
+    message = data.get('message', '').strip()
     
-    context = "\n".join(context_parts) if context_parts else ""
+    if not message:
+        return jsonify({'success': False, 'error': 'メッセージが空です'}), 400
     
-    # プロンプトを構築
-    prompt = f"業種: {industry_name}\n\n質問: {message}"
+    # 検索から回答生成までの制限時間
+    deadline = Deadline(CHAT_DEADLINE_SECONDS)
+    db = get_db()
+    chat = prepare_chat(db, message, session.get('industry_id'),
+                        session.get('industry_name', '全業種'), session.get('is_admin', False))
     
-    # Rakuten AI 3.0 APIを呼び出し（利用可能なビデオ情報を渡す）
-    result = call_rakuten_ai(prompt, context, relevant['videos'])
+    cached = get_cached_chat_answer(db, chat, message)
+    if cached is not None:
+        result = {'success': True, 'response': cached}
+    else:
+        # Rakuten AI 3.0 APIを呼び出し（利用可能なビデオ情報を渡す）
+        result = call_rakuten_ai(chat['prompt'], chat['context'], chat['videos'], deadline)
+        if result['success']:
+            store_llm_response(db, chat['cache_key'], chat['industry_id'], message,
+                               result['response'], chat['context_ids'])
+        elif result.get('unavailable'):
+            # APIの障害・混雑時はエラーにせず、検索結果のみの回答を返す
+            result = {'success': True, 'response': build_fallback_answer(chat), 'fallback': True}
     
     if result['success']:
-        # 推薦動画を準備（スラッグを含める）
-        recommended_videos = []
-        for v in relevant['videos'][:3]:
-            # スラッグがなければ生成
-            slug = v.get('slug') or ensure_slug_for_video(db, v['id'])
-            recommended_videos.append({
-                'id': v['id'],
-                'slug': slug,
-                'title': v['title']
-            })
-        
-        # チャット履歴を保存
-        try:
-            db.execute('''
-                INSERT INTO chat_history (user_id, message, response, recommended_videos)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                session['user_id'],
-                message,
-                result['response'],
-                json.dumps([v['id'] for v in recommended_videos]) if recommended_videos else None
-            ))
-            db.commit()
-        except Exception as e:
-            print(f"チャット履歴保存エラー: {e}")
+        save_chat_history(db, session['user_id'], message, result['response'], chat['recommended_videos'])
         
         return jsonify({
             'success': True,
             'response': result['response'],
-            'recommended_videos': recommended_videos
+            'recommended_videos': chat['recommended_videos'],
+            'cached': cached is not None,
+            'fallback': result.get('fallback', False)
         })
     else:
         return jsonify({
@@ -2757,6 +4989,134 @@ def chat_api():
             'error': result['error']
         }), 500
 
+# チャットAPI（ストリーミング）
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream_api():
+    """回答をSSEで逐次返す
+    
+    イベント: videos（推薦動画、最初に送信）→ token（テキスト片）→ done（全文） / error
+    APIの障害・混雑時は検索結果のみの回答を1つのtokenで送る（doneのfallbackがtrue）。
+    """
+    data = request.json or {}
+    message = data.get('message', '').strip()
+    
+    if not message:
+        return jsonify({'success': False, 'error': 'メッセージが空です'}), 400
+    
+    deadline = Deadline(CHAT_DEADLINE_SECONDS)
+    db = get_db()
+    chat = prepare_chat(db, message, session.get('industry_id'),
+                        session.get('industry_name', '全業種'), session.get('is_admin', False))
+    user_id = session['user_id']
+    cached = get_cached_chat_answer(db, chat, message)
+    
+    def generate():
+        try:
+            # 推薦動画はLLMの回答を待たずに先に送る
+            yield format_sse({'event': 'videos', 'data': json.dumps(chat['recommended_videos'], ensure_ascii=False)})
+            fallback = False
+            if cached is not None:
+                # キャッシュ済みの回答は1回でまとめて送る
+                parts = [cached]
+                yield format_sse({'event': 'token', 'data': json.dumps({'text': cached}, ensure_ascii=False)})
+            else:
+                parts = []
+                try:
+                    for text in guarded_stream_rakuten_ai(chat['payload'], deadline):
+                        parts.append(text)
+                        yield format_sse({'event': 'token', 'data': json.dumps({'text': text}, ensure_ascii=False)})
+                except LLMUnavailableError:
+                    fallback = True
+                    parts = [build_fallback_answer(chat)]
+                    yield format_sse({'event': 'token', 'data': json.dumps({'text': parts[0]}, ensure_ascii=False)})
+                except Exception as e:
+                    yield format_sse({'event': 'error', 'data': json.dumps({'error': str(e)}, ensure_ascii=False)})
+                    return
+            
+            # ストリーム完了時にチャット履歴を保存
+            response_text = ''.join(parts)
+            if cached is None and not fallback:
+                store_llm_response(db, chat['cache_key'], chat['industry_id'], message,
+                                   response_text, chat['context_ids'])
+            save_chat_history(db, user_id, message, response_text, chat['recommended_videos'])
+            yield format_sse({'event': 'done', 'data': json.dumps(
+                {'response': response_text, 'cached': cached is not None, 'fallback': fallback},
+                ensure_ascii=False)})
+        finally:
+            db.close()
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/chat/preview')
+@login_required
+def chat_preview_api():
+    """入力中の質問に関連する動画・ナレッジ・ユースケースを返す（LLMは呼ばない。検索結果はキャッシュを共有）"""
+    message = request.args.get('q', '').strip()
+    if not message:
+        return jsonify({'success': False, 'error': 'メッセージが空です'}), 400
+    
+    db = get_db()
+    relevant = search_relevant_content(db, message, session.get('industry_id'), session.get('is_admin', False))
+    videos = [{
+        'id': v['id'],
+        'slug': v.get('slug') or ensure_slug_for_video(db, v['id']),
+        'title': v['title']
+    } for v in relevant['videos'][:3]]
+    db.close()
+    return jsonify({
+        'success': True,
+        'videos': videos,
+        'knowledge': [k['title'] for k in relevant['knowledge']],
+        'usecases': [{'title': u['title'], 'example_prompt': u['example_prompt']} for u in relevant['usecases']],
+        'cached': relevant['cached']
+    })
+
+@app.route('/api/search')
+@login_required
+def search_api():
+    """動画・文字起こしセグメント・Q&A・外部ナレッジの全体検索
+    
+    パラメータ: q（空白区切りの検索語。すべてを含む結果を返す）, type（video / segment / qa / knowledge）,
+    category_id, cursor（前のページの next_cursor）, per_page（1〜50、既定20）
+    一致部分を <mark> で囲んだ snippet、カテゴリー別・種類別の件数（facets）を返す。
+    """
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('type') or None
+    if kind and kind not in SEARCH_KINDS:
+        return jsonify({'success': False, 'error': f"type は {' / '.join(SEARCH_KINDS)} のいずれかです"}), 400
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 50)
+    
+    db = get_db()
+    try:
+        result = search_content(db, query, session.get('industry_id'), session.get('is_admin', False),
+                                session.get('role', 'user'), session.get('tenant_id'),
+                                kind=kind, category_id=request.args.get('category_id', type=int),
+                                cursor=request.args.get('cursor'), per_page=per_page)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        db.close()
+    return jsonify({'success': True, **result})
+
+@app.route('/api/suggest')
+@login_required
+def suggest_api():
+    """動画・カテゴリーのタイトル補完（漢字・かな・ローマ字・スラッグの前方一致、業種別アクセス制御付き）"""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    industry_id = session.get('industry_id')
+    is_admin = session.get('is_admin', False)
+    
+    db = get_db()
+    suggest_index.refresh(db)
+    # アクセスできるカテゴリーは検索結果キャッシュに保存（アクセス権の変更でバージョンが変わる）
+    accessible, _ = cached_retrieval(db, ('accessible_categories', industry_id, bool(is_admin)),
+                                     lambda: frozenset(get_accessible_category_ids(db, industry_id, is_admin)))
+    db.close()
+    return jsonify({'success': True, 'suggestions': suggest_index.lookup(query, accessible, limit)})
+
 # ビデオのトランスクリプトを追加/更新するAPI
 @app.route('/api/admin/videos/<int:video_id>/transcript', methods=['POST'])
 @admin_required
@@ -2777,6 +5137,9 @@ def update_video_transcript(video_id):
     
     # 既存のトランスクリプトを削除（同じタイプのもの）
     db.execute('DELETE FROM video_transcripts WHERE video_id = ? AND content_type = ?', (video_id, content_type))
+    # 全文を手動で差し替えた場合、古いセグメントは内容と一致しなくなるため削除
+    if content_type == 'transcript':
+        db.execute('DELETE FROM video_transcripts WHERE video_id = ? AND content_type = ?', (video_id, 'segment'))
     
     # 新しいトランスクリプトを追加
     db.execute('''
@@ -2784,15 +5147,428 @@ def update_video_transcript(video_id):
         VALUES (?, ?, ?)
     ''', (video_id, content, content_type))
     db.commit()
+    refresh_retrieval_indexes(db)
+    
+    # 概要の再生成（変更のないチャンクは部分要約キャッシュを再利用）
+    if content_type == 'transcript' and data.get('regenerate_summary'):
+        db_path = os.path.abspath(app.config['DATABASE'])
+        thread = threading.Thread(target=regenerate_video_summary_async, args=(video_id, content, db_path))
+        thread.daemon = True
+        thread.start()
     
     return jsonify({'success': True, 'message': 'トランスクリプトを保存しました'})
 
 # ========== 自動文字起こし機能 ==========
 
+def save_transcript_segments(db, video_id, segments):
+    """Whisperのセグメント（start/end/text）を1行ずつvideo_transcriptsに保存"""
+    db.execute('DELETE FROM video_transcripts WHERE video_id = ? AND content_type = ?',
+               (video_id, 'segment'))
+    rows = []
+    for seg in segments:
+        text = (seg.get('text') or '').strip()
+        if not text:
+            continue
+        rows.append((video_id, text, 'segment', float(seg['start']), float(seg['end'])))
+    db.executemany('''
+        INSERT INTO video_transcripts (video_id, content, content_type, timestamp_start, timestamp_end)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+def get_transcript_segments(db, video_id, start=None, end=None, limit=None, offset=0):
+    """タイムスタンプ付きセグメントを取得（時間範囲・ページ指定可）"""
+    query = '''
+        SELECT id, content, timestamp_start, timestamp_end
+        FROM video_transcripts
+        WHERE video_id = ? AND content_type = 'segment'
+    '''
+    params = [video_id]
+    # 指定範囲と重なるセグメントを返す
+    if start is not None:
+        query += ' AND timestamp_end > ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND timestamp_start < ?'
+        params.append(end)
+    query += ' ORDER BY timestamp_start'
+    if limit is not None:
+        query += ' LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+    return [{
+        'id': r['id'],
+        'start': r['timestamp_start'],
+        'end': r['timestamp_end'],
+        'text': r['content']
+    } for r in db.execute(query, params).fetchall()]
+
+def load_audio_pcm(path, sample_rate=AUDIO_SAMPLE_RATE):
+    """ffmpegで動画から16kHzモノラルPCMを抽出し、float32配列として返す"""
+    cmd = [
+        'ffmpeg', '-nostdin', '-threads', '0', '-i', path,
+        '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sample_rate), '-'
+    ]
+    out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+def file_content_hash(path, block_size=1024 * 1024):
+    """ファイル内容のSHA-256ハッシュを返す"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_audio_cache_dir():
+    """音声キャッシュディレクトリの絶対パス（バックグラウンドスレッド対応）"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, AUDIO_CACHE_DIR)
+
+def ensure_cached_audio(video_path):
+    """動画の内容ハッシュをキーにデコード済み音声をキャッシュし、.npyファイルのパスを返す"""
+    cache_dir = get_audio_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{file_content_hash(video_path)}.npy")
+    
+    if os.path.exists(cache_path):
+        # LRU判定用に最終利用時刻を更新
+        os.utime(cache_path)
+        print(f"[Whisper] Using cached audio: {cache_path}")
+        return cache_path
+    
+    audio = load_audio_pcm(video_path)
+    # 書き込み途中のファイルを読まれないよう、一時ファイル経由で置き換える
+    tmp_path = cache_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, audio)
+    os.replace(tmp_path, cache_path)
+    evict_audio_cache(keep=cache_path)
+    return cache_path
+
+def load_cached_audio(cache_path):
+    """キャッシュ済み音声をメモリマップで読み込む（読み取り専用）"""
+    return np.load(cache_path, mmap_mode='r')
+
+def evict_audio_cache(max_bytes=None, keep=None):
+    """容量上限を超えた音声キャッシュを最終利用が古い順に削除し、削除件数を返す"""
+    if max_bytes is None:
+        max_bytes = AUDIO_CACHE_MAX_MB * 1024 * 1024
+    cache_dir = get_audio_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue  # 他プロセスが使用中の場合はスキップ
+        total -= size
+        removed += 1
+    return removed
+
+def find_silence_chunks(audio, sample_rate=AUDIO_SAMPLE_RATE, target_seconds=60.0,
+                        max_seconds=None, min_silence_seconds=0.3, frame_seconds=0.03):
+    """音声を無音区間（エネルギーベースのVAD）で分割し、(開始サンプル, 終了サンプル)のリストを返す
+
+    target_seconds を超えた後の最初の無音区間の中央で区切る。
+    max_seconds 以内に無音区間がなければその位置で強制的に区切る。
+    """
+    total = len(audio)
+    if max_seconds is None:
+        max_seconds = target_seconds * 2
+    frame = max(1, int(sample_rate * frame_seconds))
+    n_frames = total // frame
+    if n_frames == 0:
+        return [(0, total)] if total else []
+    
+    frames = np.asarray(audio[:n_frames * frame], dtype=np.float32).reshape(n_frames, frame)
+    energy = np.sqrt((frames ** 2).mean(axis=1))
+    # 雑音レベル（下位5%）と発話レベル（上位5%）から求める適応的な閾値
+    noise_floor, speech_level = np.percentile(energy, [5, 95])
+    threshold = max(float(noise_floor + 0.1 * (speech_level - noise_floor)), 1e-4)
+    silent = np.concatenate(([False], energy < threshold, [False]))
+    edges = np.flatnonzero(silent[1:] != silent[:-1])
+    run_starts, run_ends = edges[0::2], edges[1::2]
+    min_frames = max(1, int(min_silence_seconds / frame_seconds))
+    keep = (run_ends - run_starts) >= min_frames
+    cut_points = ((run_starts[keep] + run_ends[keep]) // 2) * frame
+    
+    target_len = int(target_seconds * sample_rate)
+    max_len = int(max_seconds * sample_rate)
+    chunks = []
+    start = 0
+    while total - start > max_len:
+        idx = np.searchsorted(cut_points, start + target_len)
+        if idx < len(cut_points) and cut_points[idx] <= start + max_len:
+            cut = int(cut_points[idx])
+        else:
+            cut = start + max_len
+        chunks.append((start, cut))
+        start = cut
+    chunks.append((start, total))
+    return chunks
+
+# ----- 文字起こしバックエンド -----
+# transcribe(audio) は {'text': str, 'segments': [{'start', 'end', 'text'}]} を返す
+# audio はファイルパスまたは16kHzモノラルのfloat32配列
+# progress を渡すと、対応するバックエンドは進捗（0.0〜1.0）を通知する
+
+class WhisperBackend:
+    """openai-whisper（PyTorch）による文字起こし"""
+    name = 'openai-whisper'
+    
+    def __init__(self, model_size, threads):
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+        self.model = whisper.load_model(model_size)
+    
+    def transcribe(self, audio, language='ja', progress=None):
+        """文字起こし（progressには完了した割合を通知）
+        
+        openai-whisper は途中経過を返さないため、通常は完了時にのみ通知する。
+        TRANSCRIBE_PROGRESS_CHUNKS を有効にした場合は、音声を無音区間でチャンク（TRANSCRIBE_CHUNK_SECONDS）に
+        区切って順に文字起こしし、チャンクごとに進捗を通知する（音声をファイルパスで渡した場合は対象外）。
+        """
+        if TRANSCRIBE_PROGRESS_CHUNKS and progress and np is not None and isinstance(audio, np.ndarray):
+            chunks = find_silence_chunks(audio, target_seconds=TRANSCRIBE_CHUNK_SECONDS)
+            if len(chunks) > 1:
+                chunk_results = []
+                for done, (start, end) in enumerate(chunks, 1):
+                    offset_seconds = start / AUDIO_SAMPLE_RATE
+                    chunk_results.append([{
+                        'start': seg['start'] + offset_seconds,
+                        'end': seg['end'] + offset_seconds,
+                        'text': seg['text']
+                    } for seg in self._transcribe(audio[start:end], language)['segments']])
+                    progress(done / len(chunks))
+                return stitch_chunk_segments(chunk_results)
+        result = self._transcribe(audio, language)
+        if progress:
+            progress(1.0)
+        return result
+    
+    def _transcribe(self, audio, language):
+        if np is not None and isinstance(audio, np.ndarray) and not audio.flags.writeable:
+            # PyTorchは読み取り専用配列を直接扱えないため、メモリマップから複製
+            audio = np.array(audio)
+        result = self.model.transcribe(
+            audio,
+            language=language,
+            verbose=None,
+            temperature=0,
+            condition_on_previous_text=True
+        )
+        return {
+            'text': result['text'],
+            'segments': [{'start': seg['start'], 'end': seg['end'], 'text': seg['text']}
+                         for seg in result.get('segments', [])]
+        }
+
+class FasterWhisperBackend:
+    """faster-whisper（CTranslate2、CPU int8量子化）による文字起こし"""
+    name = 'faster-whisper'
+    
+    def __init__(self, model_size, threads):
+        self.model = WhisperModel(
+            model_size,
+            device='cpu',
+            compute_type=FASTER_WHISPER_COMPUTE_TYPE,
+            cpu_threads=threads
+        )
+    
+    def transcribe(self, audio, language='ja', progress=None):
+        segments, info = self.model.transcribe(
+            audio,
+            language=language,
+            temperature=0,
+            condition_on_previous_text=True
+        )
+        # segmentsはジェネレータのため、ここで推論が実行される
+        results = []
+        for seg in segments:
+            results.append({'start': seg.start, 'end': seg.end, 'text': seg.text})
+            if progress and info.duration:
+                progress(min(1.0, seg.end / info.duration))
+        segments = results
+        return {
+            'text': ''.join(seg['text'] for seg in segments),
+            'segments': segments
+        }
+
+TRANSCRIPTION_BACKENDS = {
+    'openai-whisper': (WhisperBackend, lambda: WHISPER_AVAILABLE),
+    'faster-whisper': (FasterWhisperBackend, lambda: FASTER_WHISPER_AVAILABLE),
+}
+
+def transcription_available(backend_name=None):
+    """指定（既定は環境変数）の文字起こしバックエンドが利用可能か"""
+    entry = TRANSCRIPTION_BACKENDS.get(backend_name or TRANSCRIBE_BACKEND)
+    return bool(entry and entry[1]())
+
+# ロード済みモデルのキャッシュ（モデルのロードは数十秒かかるため使い回す）
+# {(バックエンド名, モデルサイズ, スレッド数): {'backend', 'last_used', 'in_use'}}
+_backend_cache = {}
+_backend_cache_lock = threading.Lock()
+_backend_reaper = None
+
+def get_transcription_backend(backend_name=None, model_size=None, threads=None):
+    """文字起こしバックエンドを取得（同一設定ではプロセス内で1度だけロード）
+    
+    TRANSCRIBE_MODEL_IDLE_SECONDS の間使われなかったモデルは解放される。
+    文字起こし中に解放されないよう、長い処理は use_transcription_backend で囲む。
+    """
+    backend_name = backend_name or TRANSCRIBE_BACKEND
+    model_size = model_size or WHISPER_MODEL_SIZE
+    threads = threads or TRANSCRIBE_THREADS
+    if backend_name not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Unknown transcription backend: {backend_name}")
+    key = (backend_name, model_size, threads)
+    with _backend_cache_lock:
+        if key not in _backend_cache:
+            backend_cls = TRANSCRIPTION_BACKENDS[backend_name][0]
+            print(f"[Whisper] Loading backend: {backend_name} ({model_size}, {threads} threads)")
+            _backend_cache[key] = {'backend': backend_cls(model_size, threads), 'last_used': 0.0, 'in_use': 0}
+        entry = _backend_cache[key]
+        entry['last_used'] = time.monotonic()
+    _schedule_backend_reaper()
+    return entry['backend']
+
+@contextmanager
+def use_transcription_backend(backend_name=None, model_size=None, threads=None):
+    """文字起こしの間、バックエンドを解放対象から外す"""
+    backend = get_transcription_backend(backend_name, model_size, threads)
+    with _backend_cache_lock:
+        entries = [e for e in _backend_cache.values() if e['backend'] is backend]
+        for entry in entries:
+            entry['in_use'] += 1
+    try:
+        yield backend
+    finally:
+        with _backend_cache_lock:
+            for entry in entries:
+                entry['in_use'] -= 1
+                entry['last_used'] = time.monotonic()
+
+def _schedule_backend_reaper():
+    """アイドル状態のモデルを解放するタイマーを開始（ロード済みのモデルがある間だけ動く）"""
+    global _backend_reaper
+    if TRANSCRIBE_MODEL_IDLE_SECONDS <= 0:
+        return
+    with _backend_cache_lock:
+        if _backend_reaper is not None or not _backend_cache:
+            return
+        _backend_reaper = threading.Timer(min(TRANSCRIBE_MODEL_IDLE_SECONDS, 60), unload_idle_transcription_backends)
+        _backend_reaper.daemon = True
+        _backend_reaper.start()
+
+def unload_idle_transcription_backends(now=None):
+    """TRANSCRIBE_MODEL_IDLE_SECONDS 以上使われていないモデルを解放（解放した数を返す）"""
+    global _backend_reaper
+    now = time.monotonic() if now is None else now
+    with _backend_cache_lock:
+        idle = [key for key, entry in _backend_cache.items()
+                if entry['in_use'] == 0 and now - entry['last_used'] >= TRANSCRIBE_MODEL_IDLE_SECONDS]
+        for key in idle:
+            print(f"[Whisper] Unloading idle backend: {key[0]} ({key[1]})")
+            del _backend_cache[key]
+        _backend_reaper = None
+    if idle:
+        gc.collect()
+    _schedule_backend_reaper()
+    return len(idle)
+
+# ワーカープロセスごとに1度だけロードするバックエンド
+_worker_backend = None
+
+def _init_transcribe_worker(backend_name, model_size, threads):
+    """並列文字起こしワーカーの初期化（モデルのロードとスレッド数の制限）"""
+    global _worker_backend
+    _worker_backend = get_transcription_backend(backend_name, model_size, threads)
+
+def _transcribe_chunk(audio_path, start, end):
+    """1チャンクを文字起こしし、動画全体の時刻に補正したセグメントを返す"""
+    # 音声はプロセス間で受け渡さず、各ワーカーがキャッシュをメモリマップで直接読む
+    audio_chunk = load_cached_audio(audio_path)[start:end]
+    offset_seconds = start / AUDIO_SAMPLE_RATE
+    result = _worker_backend.transcribe(audio_chunk)
+    return [{
+        'start': seg['start'] + offset_seconds,
+        'end': seg['end'] + offset_seconds,
+        'text': seg['text']
+    } for seg in result['segments']]
+
+def stitch_chunk_segments(chunk_results):
+    """チャンクごとのセグメントを時刻順に連結し、Whisper互換の結果を返す"""
+    segments = [seg for chunk in chunk_results for seg in chunk]
+    segments.sort(key=lambda seg: seg['start'])
+    return {
+        'text': ''.join(seg['text'] for seg in segments),
+        'segments': segments
+    }
+
+def transcribe_parallel(video_path, workers=None, backend_name=None, model_size=None, progress=None):
+    """無音区間で分割したチャンクをプロセスプールで並列に文字起こし（progressには完了チャンクの割合を通知）"""
+    backend_name = backend_name or TRANSCRIBE_BACKEND
+    model_size = model_size or WHISPER_MODEL_SIZE
+    workers = max(1, workers or os.cpu_count() or 1)
+    audio_path = ensure_cached_audio(video_path)
+    audio = load_cached_audio(audio_path)
+    chunks = find_silence_chunks(audio, target_seconds=TRANSCRIBE_CHUNK_SECONDS)
+    workers = min(workers, len(chunks)) or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"[Whisper] Parallel transcription: {len(chunks)} chunks, {workers} workers")
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_transcribe_worker,
+                             initargs=(backend_name, model_size, threads)) as pool:
+        futures = [
+            pool.submit(_transcribe_chunk, audio_path, start, end)
+            for start, end in chunks
+        ]
+        if progress:
+            for done, _ in enumerate(as_completed(futures), 1):
+                progress(done / len(futures))
+        chunk_results = [f.result() for f in futures]
+    
+    return stitch_chunk_segments(chunk_results)
+
+def publish_transcription_status(video_id, status, progress=None):
+    """文字起こしの状態遷移・進捗（%）を管理画面へ通知"""
+    event_hub.publish('transcription', 'status', {
+        'video_id': video_id,
+        'status': status,
+        'progress': progress
+    })
+
+def _transcription_progress_reporter(video_id):
+    """1%単位に間引いて進捗を通知するコールバックを返す"""
+    last = [-1]
+    
+    def report(fraction):
+        percent = int(fraction * 100)
+        if percent > last[0]:
+            last[0] = percent
+            publish_transcription_status(video_id, 'processing', percent)
+    return report
+
 def transcribe_video_async(video_id, video_path):
     """バックグラウンドで動画を文字起こし"""
-    if not WHISPER_AVAILABLE:
-        print("[Whisper] Whisper is not available")
+    if not transcription_available():
+        print(f"[Whisper] Transcription backend is not available: {TRANSCRIBE_BACKEND}")
         return
     
     # 絶対パスを取得（バックグラウンドスレッドでも正しく動作するように）
@@ -2805,6 +5581,7 @@ def transcribe_video_async(video_id, video_path):
         db.row_factory = sqlite3.Row
         db.execute('UPDATE videos SET transcription_status = ? WHERE id = ?', ('processing', video_id))
         db.commit()
+        publish_transcription_status(video_id, 'processing', 0)
         
         print(f"[Whisper] Starting transcription: {video_path}")
         
@@ -2814,37 +5591,41 @@ def transcribe_video_async(video_id, video_path):
             os.environ['PATH'] = os.path.dirname(local_ffmpeg) + os.pathsep + os.environ.get('PATH', '')
             print(f"[Whisper] Using local ffmpeg: {local_ffmpeg}")
         
-        # Whisperモデルをロード（medium推奨）
-        model = whisper.load_model("medium")
-        
-        # 文字起こし実行
-        result = model.transcribe(
-            video_path,
-            language='ja',
-            verbose=False,
-            temperature=0,
-            condition_on_previous_text=True
-        )
+        if TRANSCRIBE_PARALLEL and np is not None:
+            # 無音区間で分割し、全CPUコアで並列に文字起こし
+            result = transcribe_parallel(video_path, TRANSCRIBE_WORKERS,
+                                         progress=_transcription_progress_reporter(video_id))
+        else:
+            # デコード済み音声をキャッシュから読み込む（NumPyがない環境ではファイルを直接渡す）
+            audio = load_cached_audio(ensure_cached_audio(video_path)) if np is not None else video_path
+            # 文字起こし実行（TRANSCRIBE_BACKEND / WHISPER_MODEL_SIZE で選択したバックエンド）
+            with use_transcription_backend() as backend:
+                result = backend.transcribe(audio, progress=_transcription_progress_reporter(video_id))
         
         transcript_text = result['text']
         print(f"[Whisper] Transcription completed: {len(transcript_text)} characters")
         
-        # トランスクリプトをDBに保存
+        # トランスクリプトをDBに保存（全文 + タイムスタンプ付きセグメント）
         db.execute('DELETE FROM video_transcripts WHERE video_id = ? AND content_type = ?', 
                    (video_id, 'transcript'))
         db.execute('''
             INSERT INTO video_transcripts (video_id, content, content_type)
             VALUES (?, ?, ?)
         ''', (video_id, transcript_text, 'transcript'))
+        segment_count = save_transcript_segments(db, video_id, result.get('segments', []))
+        print(f"[Whisper] Saved {segment_count} segments")
         
-        # 概要を生成（Rakuten AI 3.0を使用）
-        summary = generate_video_summary(transcript_text)
+        # 概要を生成（Rakuten AI 3.0を使用、長い動画はチャンク単位でmap-reduce要約）
+        publish_transcription_status(video_id, 'summarizing', 100)
+        summary = generate_video_summary(transcript_text, db)
         
         # ステータスを「完了」に更新、概要を保存
         db.execute('UPDATE videos SET transcription_status = ?, summary = ? WHERE id = ?', 
                    ('completed', summary, video_id))
         db.commit()
+        refresh_retrieval_indexes(db, db_path)
         db.close()
+        publish_transcription_status(video_id, 'completed', 100)
         
         print(f"[Whisper] Processing complete: video_id={video_id}")
         
@@ -2860,69 +5641,241 @@ def transcribe_video_async(video_id, video_path):
             db.execute('UPDATE videos SET transcription_status = ? WHERE id = ?', ('failed', video_id))
             db.commit()
             db.close()
+            publish_transcription_status(video_id, 'failed')
         except:
             pass
 
-def generate_video_summary(transcript_text):
-    """トランスクリプトから概要を生成（Rakuten AI 3.0使用）"""
+SUMMARY_SYSTEM_PROMPT = "あなたは動画コンテンツの概要を作成する専門家です。与えられた文字起こしテキストから、簡潔で分かりやすい概要を日本語で作成してください。概要は3〜5文程度にまとめてください。"
+SUMMARY_MAP_PROMPT = "あなたは動画コンテンツの要約を作成する専門家です。与えられたのは長い動画の文字起こしの一部です。この部分で説明されている要点を、固有名詞や数値を残して日本語の箇条書きで簡潔にまとめてください。"
+SUMMARY_REDUCE_PROMPT = "あなたは動画コンテンツの要約を統合する専門家です。与えられたのは1本の動画を前から順に区切って作成した部分要約です。重複を除き、流れが分かるように統合した要約を日本語の箇条書きで作成してください。"
+
+def build_summary_payload(system_prompt, user_content, max_tokens=500):
+    """要約用のchat/completionsリクエストを組み立てる"""
+    return {
+        "model": RAKUTEN_AI_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0.3,
+        "max_tokens": max_tokens
+    }
+
+def _request_summary(system_prompt, user_content, max_tokens=500):
+    """要約用にRakuten AI 3.0 APIを呼び出し、生成テキストを返す（失敗時はNone）"""
+    payload = build_summary_payload(system_prompt, user_content, max_tokens)
+    
+    response = post_rakuten_ai(payload, 'summary')
+    
+    if response.status_code == 200:
+        data = response.json()
+        return data['choices'][0]['message']['content']
+    else:
+        print(f"概要生成API エラー: {response.status_code}")
+        return None
+
+def _split_long_unit(unit, max_chars, window=8):
+    """句点のない長い文を、直前window文字のハッシュで決まる位置で分割（上限を超える場合のみ強制分割）"""
+    pieces = []
+    min_chars = max(window, max_chars // 4)
+    divisor = max(1, max_chars // 8)
+    start = 0
+    while len(unit) - start > max_chars:
+        cut = start + max_chars
+        for i in range(start + min_chars, start + max_chars):
+            if zlib.crc32(unit[i - window:i].encode('utf-8')) % divisor == 0:
+                cut = i
+                break
+        pieces.append(unit[start:cut])
+        start = cut
+    pieces.append(unit[start:])
+    return pieces
+
+def chunk_transcript_for_summary(transcript_text, max_chars=None):
+    """文字起こしを要約用チャンクに分割（文末で区切り、句点のない長い文は内容で決まる位置で区切る）
+
+    区切り位置は内容から決める（一定長を超えた後、ハッシュ値が条件を満たす単位の直後で区切る）ため、
+    一部を編集しても他のチャンクの境界は変わらず、部分要約のキャッシュが再利用できる。
+    Whisperの結果と手動編集後の全文で同じ規則を使うため、セグメントではなく全文だけから区切る。
+    """
+    max_chars = max_chars or SUMMARY_CHUNK_CHARS
+    units = [piece for u in re.split(r'(?<=[。！？!?\n])', transcript_text) if u.strip()
+             for piece in _split_long_unit(u, max_chars)]
+    
+    chunks = []
+    current = []
+    size = 0
+    for unit in units:
+        if size + len(unit) > max_chars and current:
+            chunks.append(''.join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += len(unit)
+        boundary = int(hashlib.md5(unit.encode('utf-8')).hexdigest()[:8], 16) % 4 == 0
+        if size >= max_chars // 2 and boundary:
+            chunks.append(''.join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+def _pack_texts(texts, max_chars):
+    """テキストを順序を保ったまま、上限文字数以内のグループに詰め合わせる"""
+    packed = []
+    current = ''
+    for text in texts:
+        if current and len(current) + len(text) + 1 > max_chars:
+            packed.append(current)
+            current = ''
+        current = f"{current}\n{text}" if current else text
+    if current:
+        packed.append(current)
+    return packed
+
+def _summary_cache_key(prompt, text):
+    """部分要約キャッシュのキー（モデル・プロンプト・本文のハッシュ）"""
+    return hashlib.sha256(f"{RAKUTEN_AI_MODEL}\n{prompt}\n{text}".encode('utf-8')).hexdigest()
+
+def _summarize_parts(db, prompt, parts):
+    """複数テキストを並列に要約（キャッシュ済みのものはAPIを呼ばない）"""
+    keys = [_summary_cache_key(prompt, part) for part in parts]
+    cached = {}
+    if db is not None:
+        try:
+            placeholders = ','.join('?' * len(keys))
+            rows = db.execute(
+                f'SELECT chunk_hash, summary FROM summary_chunk_cache WHERE chunk_hash IN ({placeholders})',
+                keys
+            ).fetchall()
+            cached = {r[0]: r[1] for r in rows}
+        except sqlite3.OperationalError:
+            db = None  # キャッシュテーブルがない場合はキャッシュなしで実行
+    
+    missing = [(key, part) for key, part in zip(keys, parts) if key not in cached]
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, SUMMARY_MAX_WORKERS)) as pool:
+            results = list(pool.map(lambda item: _request_summary(prompt, item[1]), missing))
+        for (key, _), summary in zip(missing, results):
+            if summary is None:
+                continue
+            cached[key] = summary
+            if db is not None:
+                db.execute('INSERT OR REPLACE INTO summary_chunk_cache (chunk_hash, summary) VALUES (?, ?)',
+                           (key, summary))
+        if db is not None:
+            db.commit()
+    print(f"[Summary] {len(parts)} parts ({len(parts) - len(missing)} cached)")
+    
+    # 1つでも失敗した場合は不完全な要約を作らない
+    if any(key not in cached for key in keys):
+        return None
+    return [cached[key] for key in keys]
+
+def summary_map_reduce(transcript_text):
+    """概要生成の手順（map-reduce）を表すジェネレーター。同期版・非同期版（asgi_app.py）で共有する
+    
+    ('parts', プロンプト, テキストのリスト) を yield したら部分要約のリスト（失敗時はNone）を、
+    ('request', システムプロンプト, 本文) を yield したら生成テキスト（失敗時はNone）を send する。
+    戻り値が最終的な概要（失敗時はNone）。
+    部分要約を結合した長さが SUMMARY_CHUNK_CHARS に収まるまで統合を繰り返し、
+    SUMMARY_MAX_ROUNDS 段で収まらない場合だけ、警告を出して切り詰める。
+    """
+    if len(transcript_text) <= SUMMARY_CHUNK_CHARS:
+        return (yield ('request', SUMMARY_SYSTEM_PROMPT,
+                       f"以下の動画の文字起こしテキストから概要を作成してください：\n\n{transcript_text}"))
+    
+    parts = chunk_transcript_for_summary(transcript_text)
+    prompt = SUMMARY_MAP_PROMPT
+    for rounds in range(SUMMARY_MAX_ROUNDS + 1):
+        combined = '\n'.join(parts)
+        if len(combined) <= SUMMARY_CHUNK_CHARS:
+            break
+        if rounds == SUMMARY_MAX_ROUNDS:
+            print(f"[Summary] 警告: {SUMMARY_MAX_ROUNDS}段で部分要約が収まらないため、"
+                  f"{len(combined)}文字を{SUMMARY_CHUNK_CHARS}文字に切り詰めます")
+            break
+        summaries = yield ('parts', prompt, parts)
+        if summaries is None:
+            return None
+        parts = _pack_texts(summaries, SUMMARY_CHUNK_CHARS)
+        prompt = SUMMARY_REDUCE_PROMPT
+    
+    partial_summaries = combined[:SUMMARY_CHUNK_CHARS]
+    return (yield ('request', SUMMARY_SYSTEM_PROMPT,
+                   f"以下は動画の文字起こしを前から順に要約したものです。動画全体の概要を作成してください：\n\n{partial_summaries}"))
+
+def generate_video_summary(transcript_text, db=None):
+    """トランスクリプトから概要を生成（Rakuten AI 3.0使用）
+
+    長いトランスクリプトはチャンクごとに並列で要約し（map）、部分要約を統合して（reduce）
+    最終的な概要を作成する（手順は summary_map_reduce）。db を渡すと部分要約をチャンクのハッシュでキャッシュする。
+    """
     if not RAKUTEN_AI_API_KEY:
         return None
     
     try:
-        # トランスクリプトが長すぎる場合は切り詰め
-        max_length = 3000
-        if len(transcript_text) > max_length:
-            transcript_text = transcript_text[:max_length] + "..."
-        
-        headers = {
-            "Authorization": f"Bearer {RAKUTEN_AI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        messages = [
-            {
-                "role": "system",
-                "content": "あなたは動画コンテンツの概要を作成する専門家です。与えられた文字起こしテキストから、簡潔で分かりやすい概要を日本語で作成してください。概要は3〜5文程度にまとめてください。"
-            },
-            {
-                "role": "user",
-                "content": f"以下の動画の文字起こしテキストから概要を作成してください：\n\n{transcript_text}"
-            }
-        ]
-        
-        payload = {
-            "model": RAKUTEN_AI_MODEL,
-            "messages": messages,
-            "temperature": 0.3,
-            "max_tokens": 500
-        }
-        
-        with httpx.Client(verify=False, timeout=60.0) as client:
-            response = client.post(
-                f"{RAKUTEN_AI_BASE_URL}chat/completions",
-                headers=headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data['choices'][0]['message']['content']
-            else:
-                print(f"概要生成API エラー: {response.status_code}")
-                return None
+        steps = summary_map_reduce(transcript_text)
+        step = next(steps)
+        while True:
+            kind, prompt, content = step
+            result = _summarize_parts(db, prompt, content) if kind == 'parts' else _request_summary(prompt, content)
+            try:
+                step = steps.send(result)
+            except StopIteration as done:
+                return done.value
                 
     except Exception as e:
         print(f"概要生成エラー: {e}")
         return None
 
+def regenerate_video_summary_async(video_id, transcript_text, db_path):
+    """バックグラウンドで概要を再生成して保存"""
+    try:
+        db = sqlite3.connect(db_path)
+        summary = generate_video_summary(transcript_text, db)
+        if summary:
+            db.execute('UPDATE videos SET summary = ? WHERE id = ?', (summary, video_id))
+            db.commit()
+        db.close()
+    except Exception as e:
+        print(f"概要再生成エラー: {e}")
+
+def load_transcript_for_summary(db, video_id):
+    """概要生成用に保存済みの全文を取得（なければNone）"""
+    row = db.execute(
+        'SELECT content FROM video_transcripts WHERE video_id = ? AND content_type = ? ORDER BY id DESC LIMIT 1',
+        (video_id, 'transcript')
+    ).fetchone()
+    return row['content'] if row else None
+
+# 概要再生成API（保存済みの文字起こしから生成し、結果を返す）
+@app.route('/api/admin/videos/<int:video_id>/summary', methods=['POST'])
+@admin_required
+def regenerate_video_summary(video_id):
+    db = get_db()
+    if not db.execute('SELECT id FROM videos WHERE id = ?', (video_id,)).fetchone():
+        return jsonify({'success': False, 'error': 'ビデオが見つかりません'}), 404
+    
+    transcript_text = load_transcript_for_summary(db, video_id)
+    if not transcript_text:
+        return jsonify({'success': False, 'error': '文字起こしがありません'}), 400
+    
+    summary = generate_video_summary(transcript_text, db)
+    if not summary:
+        return jsonify({'success': False, 'error': '概要の生成に失敗しました'}), 500
+    
+    db.execute('UPDATE videos SET summary = ? WHERE id = ?', (summary, video_id))
+    db.commit()
+    return jsonify({'success': True, 'summary': summary})
+
 # 文字起こし開始API
 @app.route('/api/admin/videos/<int:video_id>/transcribe', methods=['POST'])
 @admin_required
 def start_transcription(video_id):
-    if not WHISPER_AVAILABLE:
+    if not transcription_available():
         return jsonify({
             'success': False, 
-            'error': 'Whisperがインストールされていません。ローカル環境でのみ利用可能です。'
+            'error': f'文字起こしエンジン（{TRANSCRIBE_BACKEND}）がインストールされていません。ローカル環境でのみ利用可能です。'
         }), 400
     
     db = get_db()
@@ -2940,14 +5893,10 @@ def start_transcription(video_id):
     if not os.path.exists(video_path):
         return jsonify({'success': False, 'error': '動画ファイルが見つかりません'}), 404
     
-    # ステータスを「pending」に更新
-    db.execute('UPDATE videos SET transcription_status = ? WHERE id = ?', ('pending', video_id))
-    db.commit()
-    
-    # バックグラウンドで文字起こしを開始
-    thread = threading.Thread(target=transcribe_video_async, args=(video_id, video_path))
-    thread.daemon = True
-    thread.start()
+    # キューに登録（同時実行数の上限内でスケジューラが順に処理する）
+    if not enqueue_transcription(db, video_id, TRANSCRIBE_PRIORITY_HIGH):
+        return jsonify({'success': False, 'error': '既にキューに登録されています'}), 400
+    transcription_scheduler.start()
     
     return jsonify({
         'success': True, 
@@ -2970,6 +5919,317 @@ def get_transcription_status(video_id):
         'summary': video['summary']
     })
 
+# ========== 文字起こしジョブスケジューラ ==========
+
+# 優先度（小さいほど先に処理）: 新規アップロード・個別実行 > 既存動画の一括処理
+TRANSCRIBE_PRIORITY_HIGH = 0
+TRANSCRIBE_PRIORITY_BACKFILL = 10
+
+def enqueue_transcription(db, video_id, priority=TRANSCRIBE_PRIORITY_HIGH):
+    """文字起こしジョブをキューに登録（登録済み・実行中の場合はFalse）"""
+    active = db.execute(
+        "SELECT 1 FROM transcription_jobs WHERE video_id = ? AND status IN ('queued', 'running')",
+        (video_id,)
+    ).fetchone()
+    if active:
+        return False
+    # テナントはアップロードしたユーザーの所属で判定
+    owner = db.execute('''
+        SELECT u.tenant_id FROM videos v LEFT JOIN users u ON v.uploaded_by = u.id WHERE v.id = ?
+    ''', (video_id,)).fetchone()
+    db.execute('''
+        INSERT INTO transcription_jobs (video_id, tenant_id, priority, status)
+        VALUES (?, ?, ?, 'queued')
+    ''', (video_id, owner['tenant_id'] if owner else None, priority))
+    db.execute('UPDATE videos SET transcription_status = ? WHERE id = ?', ('pending', video_id))
+    db.commit()
+    publish_transcription_status(video_id, 'pending')
+    return True
+
+def enqueue_untranscribed_videos(db, priority=TRANSCRIBE_PRIORITY_BACKFILL):
+    """未文字起こし（未実行・失敗）の全動画をキューに登録し、登録件数を返す"""
+    videos = db.execute('''
+        SELECT id FROM videos
+        WHERE COALESCE(transcription_status, 'none') IN ('none', 'failed')
+        ORDER BY created_at DESC
+    ''').fetchall()
+    return sum(1 for v in videos if enqueue_transcription(db, v['id'], priority))
+
+def is_within_allowed_hours(hour, spec=None):
+    """実行可能な時間帯か判定（'22-6' のように日をまたぐ指定も可、空なら常に可）"""
+    spec = TRANSCRIBE_ALLOWED_HOURS if spec is None else spec
+    if not spec:
+        return True
+    start, end = (int(h) for h in spec.split('-'))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def get_scheduler_setting(db, key, default=None):
+    row = db.execute('SELECT value FROM app_settings WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else default
+
+def set_scheduler_setting(db, key, value):
+    db.execute('INSERT OR REPLACE INTO app_settings (key, value) VALUES (?, ?)', (key, value))
+    db.commit()
+
+def get_transcription_queue_status(db):
+    """キューの深さ・実行中件数・予想完了時間（ETA）を返す"""
+    counts = {r['status']: r['count'] for r in db.execute('''
+        SELECT status, COUNT(*) as count FROM transcription_jobs
+        WHERE status IN ('queued', 'running') GROUP BY status
+    ''').fetchall()}
+    by_priority = {r['priority']: r['count'] for r in db.execute('''
+        SELECT priority, COUNT(*) as count FROM transcription_jobs
+        WHERE status = 'queued' GROUP BY priority
+    ''').fetchall()}
+    # 直近の完了ジョブの平均処理時間からETAを推定
+    avg = db.execute('''
+        SELECT AVG(duration_seconds) FROM (
+            SELECT duration_seconds FROM transcription_jobs
+            WHERE status = 'done' AND duration_seconds IS NOT NULL
+            ORDER BY finished_at DESC LIMIT 20
+        )
+    ''').fetchone()[0]
+    queued = counts.get('queued', 0)
+    running = counts.get('running', 0)
+    eta_seconds = None
+    if avg is not None:
+        slots = max(1, TRANSCRIBE_MAX_CONCURRENT)
+        eta_seconds = int(-(-(queued + running) // slots) * avg)
+    return {
+        'queued': queued,
+        'running': running,
+        'queued_new': by_priority.get(TRANSCRIBE_PRIORITY_HIGH, 0),
+        'queued_backfill': by_priority.get(TRANSCRIBE_PRIORITY_BACKFILL, 0),
+        'avg_job_seconds': round(avg, 1) if avg is not None else None,
+        'eta_seconds': eta_seconds,
+        'paused': get_scheduler_setting(db, 'transcription_paused', '0') == '1',
+        'allowed_hours': TRANSCRIBE_ALLOWED_HOURS or None,
+        'within_allowed_hours': is_within_allowed_hours(datetime.now().hour),
+        'max_concurrent': TRANSCRIBE_MAX_CONCURRENT,
+        'max_per_tenant': TRANSCRIBE_MAX_PER_TENANT
+    }
+
+class TranscriptionScheduler:
+    """文字起こしジョブのディスパッチャ
+
+    キューとロックはDB上にあるため、複数ワーカーで起動しても
+    全体・テナントごとの同時実行数の上限が守られる。
+    """
+    
+    def __init__(self, poll_seconds=5):
+        self.poll_seconds = poll_seconds
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+    
+    def _connect(self):
+        db = sqlite3.connect(os.path.abspath(app.config['DATABASE']), timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+    
+    def start(self):
+        """ディスパッチャを起動（起動済みの場合は即時にキューを確認させる）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_forever, daemon=True)
+                self._thread.start()
+        self._wake.set()
+    
+    def run_forever(self):
+        while True:
+            try:
+                while self.dispatch_next():
+                    pass
+            except sqlite3.Error as e:
+                print(f"[Scheduler] Dispatch error: {e}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+    
+    def claim_next_job(self):
+        """上限内で実行可能な最優先ジョブを取得し、実行中にする（なければNone）"""
+        db = self._connect()
+        try:
+            if get_scheduler_setting(db, 'transcription_paused', '0') == '1':
+                return None
+            if not is_within_allowed_hours(datetime.now().hour):
+                return None
+            # 他ワーカーと同時にジョブを取得しないよう書き込みロックを取る
+            db.execute('BEGIN IMMEDIATE')
+            # 異常終了・再起動で生存確認が途絶えたジョブは待機中に戻して再実行する
+            db.execute('''
+                UPDATE transcription_jobs SET status = 'queued', started_at = NULL, heartbeat_at = NULL
+                WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < datetime('now', ?)
+            ''', (f'-{int(TRANSCRIBE_JOB_LEASE_SECONDS)} seconds',))
+            # 生存確認は続いているが終わらないジョブは失敗扱いにする
+            db.execute('''
+                UPDATE transcription_jobs SET status = 'failed', error = 'timeout', finished_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND started_at < datetime('now', ?)
+            ''', (f'-{int(TRANSCRIBE_JOB_TIMEOUT_HOURS * 3600)} seconds',))
+            running = db.execute(
+                "SELECT COUNT(*) FROM transcription_jobs WHERE status = 'running'"
+            ).fetchone()[0]
+            if running >= TRANSCRIBE_MAX_CONCURRENT:
+                db.execute('ROLLBACK')
+                return None
+            job = db.execute('''
+                SELECT j.id, j.video_id, j.tenant_id FROM transcription_jobs j
+                WHERE j.status = 'queued'
+                AND (SELECT COUNT(*) FROM transcription_jobs r
+                     WHERE r.status = 'running' AND r.tenant_id IS j.tenant_id) < ?
+                ORDER BY j.priority, j.id
+                LIMIT 1
+            ''', (TRANSCRIBE_MAX_PER_TENANT,)).fetchone()
+            if not job:
+                db.execute('ROLLBACK')
+                return None
+            db.execute('''
+                UPDATE transcription_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP,
+                heartbeat_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (job['id'],))
+            db.execute('COMMIT')
+            return dict(job)
+        finally:
+            db.close()
+    
+    def dispatch_next(self):
+        """ジョブを1件取得して別スレッドで実行（取得できればTrue）"""
+        job = self.claim_next_job()
+        if not job:
+            return False
+        thread = threading.Thread(target=self.run_job, args=(job,), daemon=True)
+        thread.start()
+        return True
+    
+    def _heartbeat(self, job_id, stop):
+        """ジョブの実行中、生存確認時刻を定期的に更新する"""
+        while not stop.wait(TRANSCRIBE_JOB_LEASE_SECONDS / 4):
+            try:
+                db = self._connect()
+                try:
+                    db.execute('''
+                        UPDATE transcription_jobs SET heartbeat_at = CURRENT_TIMESTAMP
+                        WHERE id = ? AND status = 'running'
+                    ''', (job_id,))
+                finally:
+                    db.close()
+            except sqlite3.Error as e:
+                print(f"[Scheduler] Heartbeat error: {e}")
+    
+    def run_job(self, job):
+        """ジョブを実行し、結果をキューに記録（例外が起きても必ず終了状態にしてディスパッチャを起こす）"""
+        # このスレッド（と並列処理の子プロセス）のCPU優先度を下げ、Webリクエストを優先させる
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), TRANSCRIBE_NICE)
+        except (AttributeError, OSError):
+            pass  # Windowsなど未対応の環境
+        
+        started = time.time()
+        status, error = 'failed', None
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job['id'], stop_heartbeat), daemon=True).start()
+        try:
+            db = self._connect()
+            try:
+                video = db.execute('SELECT filename FROM videos WHERE id = ?', (job['video_id'],)).fetchone()
+                base_dir = os.path.dirname(os.path.abspath(__file__))
+                video_path = os.path.join(base_dir, app.config['UPLOAD_FOLDER'], video['filename']) if video else None
+                
+                if not video_path or not os.path.exists(video_path):
+                    status, error = 'cancelled', '動画ファイルが見つかりません'
+                else:
+                    transcribe_video_async(job['video_id'], video_path)
+                    result = db.execute('SELECT transcription_status FROM videos WHERE id = ?', (job['video_id'],)).fetchone()
+                    if result and result['transcription_status'] == 'completed':
+                        status = 'done'
+            finally:
+                db.close()
+        except Exception as e:
+            print(f"[Scheduler] Job {job['id']} error: {e}")
+            status, error = 'failed', str(e)
+        finally:
+            stop_heartbeat.set()
+            try:
+                db = self._connect()
+                try:
+                    db.execute('''
+                        UPDATE transcription_jobs
+                        SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP, duration_seconds = ?
+                        WHERE id = ?
+                    ''', (status, error, time.time() - started, job['id']))
+                finally:
+                    db.close()
+                event_hub.publish('transcription', 'queue', {'job_id': job['id'], 'status': status})
+            except sqlite3.Error as e:
+                print(f"[Scheduler] Failed to record job {job['id']}: {e}")
+            finally:
+                self._wake.set()
+
+transcription_scheduler = TranscriptionScheduler()
+_dispatcher_start_lock = threading.Lock()
+_dispatcher_started = False
+
+@app.before_request
+def start_transcription_dispatcher():
+    """最初のリクエストで文字起こしキューのディスパッチャを起動
+    
+    gunicorn などのWSGIサーバーでは __main__ を通らないため、起動時にキューに残っていたジョブも
+    ここで処理を始める（文字起こしエンジンがない環境では起動しない）。
+    """
+    global _dispatcher_started
+    if _dispatcher_started:
+        return
+    with _dispatcher_start_lock:
+        if _dispatcher_started:
+            return
+        _dispatcher_started = True
+    if transcription_available():
+        transcription_scheduler.start()
+
+@app.route('/api/admin/transcription-queue')
+@admin_required
+def transcription_queue_status():
+    """文字起こしキューの状態（深さ・ETA・一時停止中か）"""
+    db = get_db()
+    return jsonify({'success': True, **get_transcription_queue_status(db)})
+
+@app.route('/api/admin/transcription-queue/backfill', methods=['POST'])
+@role_required('super_admin')
+def transcription_queue_backfill():
+    """未文字起こしの全動画を低優先度でキューに登録"""
+    if not transcription_available():
+        return jsonify({
+            'success': False,
+            'error': f'文字起こしエンジン（{TRANSCRIBE_BACKEND}）がインストールされていません。ローカル環境でのみ利用可能です。'
+        }), 400
+    db = get_db()
+    count = enqueue_untranscribed_videos(db)
+    transcription_scheduler.start()
+    return jsonify({
+        'success': True,
+        'enqueued': count,
+        'message': f'{count}件の動画を文字起こしキューに登録しました',
+        **get_transcription_queue_status(db)
+    })
+
+@app.route('/api/admin/transcription-queue/pause', methods=['POST'])
+@role_required('super_admin')
+def transcription_queue_pause():
+    """キューの処理を一時停止（実行中のジョブは完了まで継続）"""
+    db = get_db()
+    set_scheduler_setting(db, 'transcription_paused', '1')
+    return jsonify({'success': True, 'message': '文字起こしキューを一時停止しました'})
+
+@app.route('/api/admin/transcription-queue/resume', methods=['POST'])
+@role_required('super_admin')
+def transcription_queue_resume():
+    """キューの処理を再開"""
+    db = get_db()
+    set_scheduler_setting(db, 'transcription_paused', '0')
+    transcription_scheduler.start()
+    return jsonify({'success': True, 'message': '文字起こしキューを再開しました'})
+
 # ユーザー向け文字起こし取得API
 @app.route('/api/videos/<int:video_id>/transcript')
 @login_required
@@ -2981,6 +6241,39 @@ def get_video_transcript(video_id):
     if not video:
         return jsonify({'success': False, 'error': 'ビデオが見つかりません'}), 404
     
+    # 時間範囲（start/end 秒）、ページ（page/per_page）または位置（offset/limit）指定時はセグメントのみ返す
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    page = request.args.get('page', type=int)
+    offset = request.args.get('offset', type=int)
+    paged = page is not None or offset is not None or 'limit' in request.args
+    if start is not None or end is not None or paged:
+        per_page = min(max(request.args.get('limit', request.args.get('per_page', 50, type=int), type=int), 1), 500)
+        has_more = False
+        if paged:
+            if page is not None:
+                page = max(page, 1)
+                offset = (page - 1) * per_page
+            offset = max(offset or 0, 0)
+            # 1件多く取得して続きがあるかを判定
+            segments = get_transcript_segments(db, video_id, start, end, per_page + 1, offset)
+            has_more = len(segments) > per_page
+            segments = segments[:per_page]
+        else:
+            per_page = None
+            segments = get_transcript_segments(db, video_id, start, end)
+        return jsonify({
+            'success': True,
+            'summary': video['summary'],
+            'segments': segments,
+            'page': page,
+            'per_page': per_page,
+            'offset': offset,
+            'limit': per_page,
+            'has_more': has_more,
+            'status': video['transcription_status'] or 'none'
+        })
+    
     # トランスクリプトを取得
     transcript = db.execute('''
         SELECT content FROM video_transcripts 
@@ -2988,10 +6281,16 @@ def get_video_transcript(video_id):
         ORDER BY created_at DESC LIMIT 1
     ''', (video_id,)).fetchone()
     
+    segment_count = db.execute('''
+        SELECT COUNT(*) FROM video_transcripts
+        WHERE video_id = ? AND content_type = 'segment'
+    ''', (video_id,)).fetchone()[0]
+    
     return jsonify({
         'success': True,
         'summary': video['summary'],
         'transcript': transcript['content'] if transcript else None,
+        'segment_count': segment_count,
         'status': video['transcription_status'] or 'none'
     })
 
@@ -3031,11 +6330,18 @@ def create_external_knowledge_table(db):
         source_file TEXT,
         section TEXT,
         keywords TEXT,
+        section_key TEXT,
+        content_hash TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (industry_id) REFERENCES industries (id)
     )
     ''')
+    # マイグレーション前のテーブルには差分更新用のカラムを追加
+    columns = [col[1] for col in db.execute("PRAGMA table_info(external_knowledge)").fetchall()]
+    for column in ('section_key', 'content_hash'):
+        if column not in columns:
+            db.execute(f"ALTER TABLE external_knowledge ADD COLUMN {column} TEXT")
     db.commit()
 
 def parse_markdown_sections(content, source_file):
@@ -3075,23 +6381,156 @@ def parse_markdown_sections(content, source_file):
     
     return sections
 
+# 複数キーワードの一括検索（オプション - pyahocorasick がない場合は正規表現で代用）
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+class KeywordMatcher:
+    """複数のキーワードを1回の走査で探す（事前にコンパイルしたAho-Corasickオートマトン）
+
+    pyahocorasick がない環境では、長い順に並べたキーワードの選択（|）を1つの正規表現にまとめて代用する。
+    正規表現は一致が重ならないため、他のキーワードを含むキーワード（「介護職員」と「介護」）は
+    含まれる方も見つかったとみなし、末尾と先頭が重なるキーワードがある場合だけ先読みで全位置を調べる。
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(kw for kw in keywords if kw))
+        self._order = {kw: i for i, kw in enumerate(self.keywords)}
+        if ahocorasick:
+            self._automaton = ahocorasick.Automaton()
+            for kw in self.keywords:
+                self._automaton.add_word(kw, kw)
+            self._automaton.make_automaton()
+            return
+        self._automaton = None
+        self._contained = {kw: [other for other in self.keywords if other in kw] for kw in self.keywords}
+        straddling = any(a != b and any(a.endswith(b[:i]) for i in range(1, min(len(a), len(b))))
+                         for a in self.keywords for b in self.keywords)
+        body = '|'.join(re.escape(kw) for kw in sorted(self.keywords, key=len, reverse=True))
+        self._pattern = re.compile(f'(?=({body}))' if straddling else body) if body else None
+
+    def find(self, text):
+        """text に含まれるキーワードを元の並び順で返す"""
+        if self._automaton is not None:
+            found = {kw for _, kw in self._automaton.iter(text)} if self.keywords else set()
+        else:
+            found = set()
+            for match in (self._pattern.findall(text) if self._pattern else []):
+                found.update(self._contained[match])
+        return sorted(found, key=self._order.__getitem__)
+
+KNOWLEDGE_KEYWORDS = [
+    '介護', 'ケアプラン', '記録', '文字起こし', '音声', 'AI', '自動化',
+    '効率化', '削減', '支援', 'システム', 'モニタリング', '見守り',
+    '高齢者', '福祉', 'ケアマネ', '医療', '宿泊', 'ホテル', '旅館',
+    '小売', '飲食', 'レストラン', '教育', '研修', 'トレーニング',
+    '介護職員', '人手不足'
+]
+knowledge_keyword_matcher = KeywordMatcher(KNOWLEDGE_KEYWORDS)
+
 def extract_knowledge_keywords(content):
-    """コンテンツからキーワードを抽出"""
-    import re as regex
-    bold_keywords = regex.findall(r'\*\*(.+?)\*\*', content)
-    
-    industry_keywords = [
-        '介護', 'ケアプラン', '記録', '文字起こし', '音声', 'AI', '自動化',
-        '効率化', '削減', '支援', 'システム', 'モニタリング', '見守り',
-        '高齢者', '福祉', 'ケアマネ', '医療', '宿泊', 'ホテル', '旅館',
-        '小売', '飲食', 'レストラン', '教育', '研修', 'トレーニング'
-    ]
-    
-    found_keywords = [kw for kw in industry_keywords if kw in content]
-    all_keywords = list(set(bold_keywords[:5] + found_keywords[:10]))
-    
+    """コンテンツからキーワードを抽出（太字の語句と業界キーワード。順序は毎回同じ）"""
+    bold_keywords = re.findall(r'\*\*(.+?)\*\*', content)
+    found_keywords = knowledge_keyword_matcher.find(content)
+
+    # 内容のハッシュに含めるため、set() ではなく出現順を保って重複を除く
+    all_keywords = list(dict.fromkeys(bold_keywords[:5] + found_keywords[:10]))
+
     return ','.join(all_keywords[:10])
 
+def knowledge_section_hash(industry_id, title, content, keywords):
+    """セクションの内容のハッシュ（再アップロード時に変更の有無を判定する）"""
+    payload = json.dumps([industry_id, title, content, keywords], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def knowledge_section_rows(sections, industry_id):
+    """parse_markdown_sections のセクションを {section_key: (industry_id, title, content, keywords)} に変換
+
+    section_key は見出し（同じファイル内で重複する場合は「見出し#2」のように出現順を付ける）。
+    短すぎるセクションは除く。
+    """
+    industry_id = int(industry_id) if industry_id is not None else None
+    rows = {}
+    seen = Counter()
+    for section in sections:
+        if len(section['content']) < 50:  # 短すぎるセクションはスキップ
+            continue
+        title = section['title']
+        seen[title] += 1
+        key = title if seen[title] == 1 else f"{title}#{seen[title]}"
+        rows[key] = (industry_id, title, section['content'], extract_knowledge_keywords(section['content']))
+    return rows
+
+def sync_knowledge_sections(db, source_file, industry_id, sections):
+    """ソースファイルのセクションを登録済みのナレッジと比較し、変わったセクションだけを追加・更新・削除する
+
+    セクションは section_key で対応づけ、content_hash が同じなら書き込まない。変更は1つのトランザクションで
+    反映するため、トリガーによるパッセージ・ベクトル・検索インデックスの作り直しや検索結果キャッシュの無効化も
+    変わったセクションの分だけになる。{'added', 'updated', 'deleted', 'unchanged'} の件数を返す。
+    """
+    return sync_knowledge_rows(db, source_file, knowledge_section_rows(sections, industry_id))
+
+def sync_knowledge_rows(db, source_file, incoming):
+    """knowledge_section_rows で作った行を反映する（sync_knowledge_sections の書き込み部分）
+
+    一括取り込み（add_external_knowledge.py）は分割・キーワード抽出を別プロセスで行い、結果をここに渡す。
+    """
+    diff = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+    try:
+        existing = {}
+        stale = []
+        for row in db.execute('''
+            SELECT id, section_key, content_hash, industry_id, title, content, keywords
+            FROM external_knowledge WHERE source_file = ? ORDER BY id
+        ''', (source_file,)).fetchall():
+            if row['section_key'] is None or row['section_key'] in existing:
+                stale.append(row['id'])
+                continue
+            # マイグレーション027より前に登録した行（content_hash なし）はキーワードを除いた内容で比較する。
+            # 当時のキーワードは set() を経由していたため、並び順と選ばれる語が実行ごとに異なる
+            legacy_hash = None if row['content_hash'] else knowledge_section_hash(
+                row['industry_id'], row['title'], row['content'], None)
+            existing[row['section_key']] = (row['id'], row['content_hash'], legacy_hash)
+
+        inserts, updates = [], []
+        for key, (section_industry_id, title, content, keywords) in incoming.items():
+            content_hash = knowledge_section_hash(section_industry_id, title, content, keywords)
+            knowledge_id, current_hash, legacy_hash = existing.pop(key, (None, None, None))
+            if knowledge_id is None:
+                inserts.append((section_industry_id, title, content, source_file, title, keywords, key, content_hash))
+            elif legacy_hash is not None and legacy_hash == knowledge_section_hash(
+                    section_industry_id, title, content, None):
+                diff['unchanged'] += 1
+            elif current_hash != content_hash:
+                updates.append((section_industry_id, title, content, title, keywords, content_hash, knowledge_id))
+            else:
+                diff['unchanged'] += 1
+        deletes = stale + [knowledge_id for knowledge_id, _, _ in existing.values()]
+
+        db.executemany('DELETE FROM external_knowledge WHERE id = ?', [(i,) for i in deletes])
+        db.executemany('''
+            UPDATE external_knowledge
+            SET industry_id = ?, title = ?, content = ?, section = ?, keywords = ?, content_hash = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', updates)
+        db.executemany('''
+            INSERT INTO external_knowledge
+            (industry_id, title, content, source_file, section, keywords, section_key, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', inserts)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    diff.update(added=len(inserts), updated=len(updates), deleted=len(deletes))
+    return diff
+
 @app.route('/api/admin/knowledge/upload', methods=['POST'])
 @admin_required
 def upload_knowledge():
@@ -3127,39 +6566,19 @@ def upload_knowledge():
         # テーブルが存在することを確認
         create_external_knowledge_table(db)
         
-        # 同じソースファイルの既存ナレッジを削除
-        db.execute('DELETE FROM external_knowledge WHERE source_file = ?', (filename,))
-        
-        # Markdownをセクションに分割
+        # Markdownをセクションに分割し、前回から変わったセクションだけを反映
         sections = parse_markdown_sections(content, filename)
-        
-        inserted = 0
-        for section in sections:
-            if len(section['content']) < 50:  # 短すぎるセクションはスキップ
-                continue
-            
-            keywords = extract_knowledge_keywords(section['content'])
-            
-            db.execute('''
-                INSERT INTO external_knowledge 
-                (industry_id, title, content, source_file, section, keywords)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                industry_id,
-                section['title'],
-                section['content'],
-                section['source_file'],
-                section['title'],
-                keywords
-            ))
-            inserted += 1
-        
-        db.commit()
-        
+        diff = sync_knowledge_sections(db, filename, industry_id, sections)
+        if diff['added'] or diff['updated'] or diff['deleted']:
+            refresh_retrieval_indexes(db)
+
+        total = diff['added'] + diff['updated'] + diff['unchanged']
         return jsonify({
-            'success': True, 
-            'message': f'{inserted}件のナレッジを追加しました',
-            'sections': inserted,
+            'success': True,
+            'message': (f"{total}件のナレッジを登録しました（追加 {diff['added']} / 更新 {diff['updated']} / "
+                        f"削除 {diff['deleted']} / 変更なし {diff['unchanged']}）"),
+            'sections': total,
+            'diff': diff,
             'filename': filename
         })
         
@@ -4058,6 +7477,9 @@ if __name__ == '__main__':
             migrate_transcription_columns()
             migrate_tenant_role_columns()
     
+    # 文字起こしキューのディスパッチャを起動（前回終了時に残ったジョブも処理）
+    transcription_scheduler.start()
+    
     # ポート番号を環境変数から取得（デプロイ環境対応）
     port = int(os.environ.get('PORT', 5000))
     
@@ -0,0 +1,572 @@
+"""
+チャット・概要生成の非同期（ASGI）サーバー
+
+使用方法:
+    uvicorn asgi_app:application --host 0.0.0.0 --port 8001 --workers 2
+
+機能:
+- /api/chat, /api/chat/stream, /api/admin/videos/<id>/summary を asyncio で処理
+  （LLMの応答待ちはスレッドではなくコルーチンで待つため、同時に数千件の呼び出しを保持できる）
+- Rakuten AI 3.0 API の呼び出しは httpx.AsyncClient（接続プール・keep-alive は app.py と同じ設定）
+- 同時実行数上限・制限時間・再試行・サーキットブレーカーも app.py と同じ設定で適用
+  （ブレーカーの状態はプロセス内でFlaskアプリと共有）
+- DB・RAG検索・プロンプト組み立ては app.py の関数をそのまま使用（SQLiteの処理はスレッドへ逃がす）
+- ログインはFlaskのセッションCookieをそのまま検証するため、gunicorn側と同じ SECRET_KEY で起動すること
+- 上記以外のパスは asgiref がインストールされていればFlaskアプリへ委譲する
+  （未インストールの場合は 404。リバースプロキシで /api/chat* のみをこのサーバーへ振り分ける）
+"""
+
+import asyncio
+import json
+import re
+import time
+from http.cookies import SimpleCookie
+
+import httpx
+from itsdangerous import BadSignature
+
+import app as lms
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    flask_application = WsgiToAsgi(lms.app)
+except ImportError:
+    flask_application = None
+
+
+# ========== Rakuten AI 3.0 API（非同期クライアント） ==========
+
+_async_client = None
+_async_client_loop = None
+_async_semaphore = None
+_async_semaphore_loop = None
+
+
+def get_async_llm_client():
+    """イベントループ共有のhttpx.AsyncClientを取得（ループが変わったら作り直す）"""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(**lms.llm_client_options())
+        _async_client_loop = loop
+    return _async_client
+
+
+def get_async_llm_semaphore():
+    """LLM呼び出しの同時実行数を RAKUTEN_AI_MAX_CONCURRENT に制限するセマフォ（イベントループごと）"""
+    global _async_semaphore, _async_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _async_semaphore is None or _async_semaphore_loop is not loop:
+        _async_semaphore = asyncio.Semaphore(lms.RAKUTEN_AI_MAX_CONCURRENT)
+        _async_semaphore_loop = loop
+    return _async_semaphore
+
+
+async def close_async_llm_client():
+    """共有クライアントの接続を閉じる（サーバー終了時）"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+    _async_client = None
+
+
+def _async_trace(trace):
+    """同期のトレースコールバックを非同期クライアント用に包む"""
+    async def atrace(event_name, info):
+        trace(event_name, info)
+    return atrace
+
+
+async def post_rakuten_ai(payload, operation='chat', timeout=None):
+    """chat/completionsを呼び出し、所要時間を記録してレスポンスを返す"""
+    start = time.perf_counter()
+    timing = {}
+    status = None
+    try:
+        response = await get_async_llm_client().post(
+            f"{lms.RAKUTEN_AI_BASE_URL}chat/completions",
+            headers=lms._rakuten_ai_headers(),
+            json=payload,
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+            extensions={'trace': _async_trace(lms._llm_timing_trace(start, timing))}
+        )
+        status = response.status_code
+        return response
+    finally:
+        lms.record_llm_call(operation, start, timing, status)
+
+
+async def stream_rakuten_ai(payload, operation='chat_stream', timeout=None):
+    """stream: trueでchat/completionsを呼び出し、生成されたテキスト片を順に返す（APIエラー時はLLMHTTPError）"""
+    start = time.perf_counter()
+    timing = {}
+    status = None
+    ttft_ms = None
+    try:
+        async with get_async_llm_client().stream(
+            'POST',
+            f"{lms.RAKUTEN_AI_BASE_URL}chat/completions",
+            headers=lms._rakuten_ai_headers(),
+            json=dict(payload, stream=True),
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+            extensions={'trace': _async_trace(lms._llm_timing_trace(start, timing))}
+        ) as response:
+            status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                raise lms.LLMHTTPError(response.status_code, response.text, response.headers.get('Retry-After'))
+
+            async for line in response.aiter_lines():
+                done, text = lms.parse_stream_line(line)
+                if done:
+                    break
+                if text:
+                    if ttft_ms is None:
+                        ttft_ms = round((time.perf_counter() - start) * 1000, 1)
+                    yield text
+    finally:
+        lms.record_llm_call(operation, start, timing, status, ttft_ms=ttft_ms)
+
+
+async def _acquire_slot(deadline):
+    """同時実行数の空きを制限時間まで待つ（空かなければ LLMUnavailableError）"""
+    if not lms.llm_circuit_breaker.allow():
+        raise lms.LLMUnavailableError('circuit_open')
+    semaphore = get_async_llm_semaphore()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        lms.llm_circuit_breaker.abandon()
+        raise lms.LLMUnavailableError('busy')
+    return semaphore
+
+
+async def guarded_post_rakuten_ai(payload, deadline, operation='chat'):
+    """app.guarded_post_rakuten_ai の非同期版"""
+    semaphore = await _acquire_slot(deadline)
+    breaker = lms.llm_circuit_breaker
+    try:
+        attempt = 0
+        while True:
+            if deadline.expired:
+                breaker.record_failure()
+                raise lms.LLMUnavailableError('deadline')
+            retry_after = None
+            try:
+                response = await post_rakuten_ai(payload, operation, timeout=lms.deadline_timeout(deadline))
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code not in lms.RETRYABLE_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                error = f"API Error: {response.status_code}"
+                retry_after = response.headers.get('Retry-After')
+
+            delay = lms.retry_delay(attempt, retry_after, deadline)
+            if delay is None:
+                breaker.record_failure()
+                raise lms.LLMUnavailableError(error)
+            await asyncio.sleep(delay)
+            attempt += 1
+    finally:
+        semaphore.release()
+
+
+async def guarded_stream_rakuten_ai(payload, deadline, operation='chat_stream'):
+    """app.guarded_stream_rakuten_ai の非同期版（制限時間・再試行は最初のトークンまで）"""
+    semaphore = await _acquire_slot(deadline)
+    breaker = lms.llm_circuit_breaker
+    try:
+        attempt = 0
+        while True:
+            if deadline.expired:
+                breaker.record_failure()
+                raise lms.LLMUnavailableError('deadline')
+            started = False
+            try:
+                async for text in stream_rakuten_ai(payload, operation, timeout=lms.deadline_timeout(deadline)):
+                    started = True
+                    yield text
+                breaker.record_success()
+                return
+            except (httpx.TransportError, lms.LLMHTTPError) as e:
+                retryable = not isinstance(e, lms.LLMHTTPError) or e.status_code in lms.RETRYABLE_STATUS_CODES
+                if not retryable:
+                    breaker.record_success()
+                    raise
+                if started:
+                    breaker.record_failure()
+                    raise
+                delay = lms.retry_delay(attempt, getattr(e, 'retry_after', None), deadline)
+                if delay is None:
+                    breaker.record_failure()
+                    raise lms.LLMUnavailableError(str(e))
+            await asyncio.sleep(delay)
+            attempt += 1
+    finally:
+        semaphore.release()
+
+
+async def call_rakuten_ai(prompt, context="", available_videos=None, deadline=None):
+    """app.call_rakuten_ai の非同期版（戻り値も同じ形式）"""
+    try:
+        response = await guarded_post_rakuten_ai(lms.build_chat_payload(prompt, context, available_videos),
+                                                 deadline or lms.Deadline(lms.CHAT_DEADLINE_SECONDS), 'chat')
+        if response.status_code == 200:
+            return {'success': True, 'response': response.json()['choices'][0]['message']['content']}
+        return {'success': False, 'error': f"API Error: {response.status_code} - {response.text}"}
+    except lms.LLMUnavailableError as e:
+        return {'success': False, 'unavailable': True, 'error': str(e)}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+
+async def request_summary(system_prompt, user_content, max_tokens=500):
+    """app._request_summary の非同期版（失敗時はNone）"""
+    response = await post_rakuten_ai(lms.build_summary_payload(system_prompt, user_content, max_tokens), 'summary')
+    if response.status_code == 200:
+        return response.json()['choices'][0]['message']['content']
+    print(f"概要生成API エラー: {response.status_code}")
+    return None
+
+
+# ========== 概要生成（map-reduce、非同期版） ==========
+
+def _load_cached_summaries(db_path, keys):
+    db = lms.sqlite3.connect(db_path)
+    try:
+        placeholders = ','.join('?' * len(keys))
+        rows = db.execute(
+            f'SELECT chunk_hash, summary FROM summary_chunk_cache WHERE chunk_hash IN ({placeholders})',
+            keys
+        ).fetchall()
+        return {r[0]: r[1] for r in rows}
+    except lms.sqlite3.OperationalError:
+        return {}
+    finally:
+        db.close()
+
+
+def _store_cached_summaries(db_path, items):
+    db = lms.sqlite3.connect(db_path)
+    try:
+        db.executemany('INSERT OR REPLACE INTO summary_chunk_cache (chunk_hash, summary) VALUES (?, ?)', items)
+        db.commit()
+    except lms.sqlite3.OperationalError:
+        pass
+    finally:
+        db.close()
+
+
+async def summarize_parts(db_path, prompt, parts):
+    """複数テキストを並行に要約（同時実行数は SUMMARY_MAX_WORKERS、キャッシュ済みはAPIを呼ばない）"""
+    keys = [lms._summary_cache_key(prompt, part) for part in parts]
+    cached = await asyncio.to_thread(_load_cached_summaries, db_path, keys)
+
+    missing = [(key, part) for key, part in zip(keys, parts) if key not in cached]
+    semaphore = asyncio.Semaphore(max(1, lms.SUMMARY_MAX_WORKERS))
+
+    async def summarize(part):
+        async with semaphore:
+            return await request_summary(prompt, part)
+
+    results = await asyncio.gather(*(summarize(part) for _, part in missing))
+    new_items = [(key, summary) for (key, _), summary in zip(missing, results) if summary is not None]
+    if new_items:
+        cached.update(new_items)
+        await asyncio.to_thread(_store_cached_summaries, db_path, new_items)
+    print(f"[Summary] {len(parts)} parts ({len(parts) - len(missing)} cached)")
+
+    # 1つでも失敗した場合は不完全な要約を作らない
+    if any(key not in cached for key in keys):
+        return None
+    return [cached[key] for key in keys]
+
+
+async def generate_video_summary(transcript_text, db_path=None):
+    """app.generate_video_summary の非同期版（手順は app.summary_map_reduce を共有）"""
+    if not lms.RAKUTEN_AI_API_KEY:
+        return None
+
+    try:
+        steps = lms.summary_map_reduce(transcript_text)
+        step = next(steps)
+        while True:
+            kind, prompt, content = step
+            if kind == 'parts':
+                result = await summarize_parts(db_path, prompt, content)
+            else:
+                result = await request_summary(prompt, content)
+            try:
+                step = steps.send(result)
+            except StopIteration as done:
+                return done.value
+    except Exception as e:
+        print(f"概要生成エラー: {e}")
+        return None
+
+
+# ========== 認証（FlaskのセッションCookieを検証） ==========
+
+def load_session(scope):
+    """リクエストのCookieからFlaskセッションを復元（無効・期限切れなら空のdict）"""
+    headers = dict(scope.get('headers') or [])
+    cookie = SimpleCookie(headers.get(b'cookie', b'').decode('latin-1'))
+    name = lms.app.config['SESSION_COOKIE_NAME']
+    if name not in cookie:
+        return {}
+    serializer = lms.app.session_interface.get_signing_serializer(lms.app)
+    if serializer is None:
+        return {}
+    try:
+        max_age = int(lms.app.permanent_session_lifetime.total_seconds())
+        return serializer.loads(cookie[name].value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def _is_admin_user(session):
+    """admin_required と同じ判定（旧is_adminフラグとの後方互換を含む）"""
+    if session.get('role', 'user') in ('super_admin', 'company_admin'):
+        return True
+    db = lms.get_db()
+    try:
+        user = db.execute('SELECT is_admin, role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    finally:
+        db.close()
+    return bool(user and (user['is_admin'] or user['role'] in ('super_admin', 'company_admin')))
+
+
+# ========== ASGIレスポンス ==========
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body) if body else {}
+    except ValueError:
+        return {}
+
+
+async def send_json(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_login_redirect(send):
+    """login_required と同様にログイン画面へリダイレクト"""
+    await send({'type': 'http.response.start', 'status': 302, 'headers': [(b'location', b'/login')]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# ========== エンドポイント ==========
+
+def _prepare_chat(session, message):
+    db = lms.get_db()
+    try:
+        return lms.prepare_chat(db, message, session.get('industry_id'),
+                                session.get('industry_name', '全業種'), session.get('is_admin', False))
+    finally:
+        db.close()
+
+
+def _get_cached_response(chat_context, message):
+    db = lms.get_db()
+    try:
+        return lms.get_cached_chat_answer(db, chat_context, message)
+    finally:
+        db.close()
+
+
+def _save_chat_history(user_id, message, response, chat_context, cached, fallback=False):
+    """チャット履歴を保存（APIで生成した回答は応答キャッシュにも保存）"""
+    db = lms.get_db()
+    try:
+        if not cached and not fallback:
+            lms.store_llm_response(db, chat_context['cache_key'], chat_context['industry_id'], message,
+                                   response, chat_context['context_ids'])
+        lms.save_chat_history(db, user_id, message, response, chat_context['recommended_videos'])
+    finally:
+        db.close()
+
+
+async def chat(scope, receive, send, session):
+    """POST /api/chat（app.chat_api の非同期版）"""
+    message = ((await read_json(receive)).get('message') or '').strip()
+    if not message:
+        await send_json(send, 400, {'success': False, 'error': 'メッセージが空です'})
+        return
+
+    deadline = lms.Deadline(lms.CHAT_DEADLINE_SECONDS)
+    chat_context = await asyncio.to_thread(_prepare_chat, session, message)
+    cached = await asyncio.to_thread(_get_cached_response, chat_context, message)
+    if cached is not None:
+        result = {'success': True, 'response': cached}
+    else:
+        result = await call_rakuten_ai(chat_context['prompt'], chat_context['context'],
+                                       chat_context['videos'], deadline)
+        if result.get('unavailable'):
+            result = {'success': True, 'response': lms.build_fallback_answer(chat_context), 'fallback': True}
+
+    if result['success']:
+        fallback = result.get('fallback', False)
+        await asyncio.to_thread(_save_chat_history, session['user_id'], message,
+                                result['response'], chat_context, cached is not None, fallback)
+        await send_json(send, 200, {
+            'success': True,
+            'response': result['response'],
+            'recommended_videos': chat_context['recommended_videos'],
+            'cached': cached is not None,
+            'fallback': fallback
+        })
+    else:
+        await send_json(send, 500, {'success': False, 'error': result['error']})
+
+
+async def chat_stream(scope, receive, send, session):
+    """POST /api/chat/stream（app.chat_stream_api の非同期版、イベントの形式も同じ）"""
+    message = ((await read_json(receive)).get('message') or '').strip()
+    if not message:
+        await send_json(send, 400, {'success': False, 'error': 'メッセージが空です'})
+        return
+
+    deadline = lms.Deadline(lms.CHAT_DEADLINE_SECONDS)
+    chat_context = await asyncio.to_thread(_prepare_chat, session, message)
+    cached = await asyncio.to_thread(_get_cached_response, chat_context, message)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+    async def send_event(event, data):
+        text = lms.format_sse({'event': event, 'data': json.dumps(data, ensure_ascii=False)})
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    # 推薦動画はLLMの回答を待たずに先に送る
+    await send_event('videos', chat_context['recommended_videos'])
+    parts = []
+    fallback = False
+    try:
+        if cached is not None:
+            # キャッシュ済みの回答は1回でまとめて送る
+            parts.append(cached)
+            await send_event('token', {'text': cached})
+        else:
+            async for text in guarded_stream_rakuten_ai(chat_context['payload'], deadline):
+                parts.append(text)
+                await send_event('token', {'text': text})
+    except lms.LLMUnavailableError:
+        # APIの障害・混雑時は検索結果のみの回答を送る
+        fallback = True
+        parts = [lms.build_fallback_answer(chat_context)]
+        await send_event('token', {'text': parts[0]})
+    except Exception as e:
+        await send_event('error', {'error': str(e)})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    # ストリーム完了時にチャット履歴を保存
+    response_text = ''.join(parts)
+    await asyncio.to_thread(_save_chat_history, session['user_id'], message,
+                            response_text, chat_context, cached is not None, fallback)
+    await send_event('done', {'response': response_text, 'cached': cached is not None, 'fallback': fallback})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _load_transcript(video_id):
+    db = lms.get_db()
+    try:
+        if not db.execute('SELECT id FROM videos WHERE id = ?', (video_id,)).fetchone():
+            return False, None
+        return True, lms.load_transcript_for_summary(db, video_id)
+    finally:
+        db.close()
+
+
+def _save_summary(video_id, summary):
+    db = lms.get_db()
+    try:
+        db.execute('UPDATE videos SET summary = ? WHERE id = ?', (summary, video_id))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def video_summary(scope, receive, send, session, video_id):
+    """POST /api/admin/videos/<id>/summary（app.regenerate_video_summary の非同期版）"""
+    if not await asyncio.to_thread(_is_admin_user, session):
+        await send_json(send, 403, {'error': 'Admin access required'})
+        return
+
+    exists, transcript_text = await asyncio.to_thread(_load_transcript, video_id)
+    if not exists:
+        await send_json(send, 404, {'success': False, 'error': 'ビデオが見つかりません'})
+        return
+    if not transcript_text:
+        await send_json(send, 400, {'success': False, 'error': '文字起こしがありません'})
+        return
+
+    summary = await generate_video_summary(transcript_text, lms.app.config['DATABASE'])
+    if not summary:
+        await send_json(send, 500, {'success': False, 'error': '概要の生成に失敗しました'})
+        return
+
+    await asyncio.to_thread(_save_summary, video_id, summary)
+    await send_json(send, 200, {'success': True, 'summary': summary})
+
+
+ROUTES = [
+    ('POST', re.compile(r'^/api/chat$'), chat),
+    ('POST', re.compile(r'^/api/chat/stream$'), chat_stream),
+    ('POST', re.compile(r'^/api/admin/videos/(\d+)/summary$'), video_summary),
+]
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_llm_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGIエントリポイント"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http':
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                session = load_session(scope)
+                if 'user_id' not in session:
+                    await send_login_redirect(send)
+                    return
+                await handler(scope, receive, send, session, *(int(g) for g in match.groups()))
+                return
+
+    if flask_application is not None:
+        await flask_application(scope, receive, send)
+    elif scope['type'] == 'http':
+        await send_json(send, 404, {'error': 'Not Found'})
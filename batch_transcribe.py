@@ -0,0 +1,83 @@
+"""
+動画ライブラリ一括文字起こしスクリプト
+
+使用方法:
+    python batch_transcribe.py enqueue   # 未文字起こし（未実行・失敗）の全動画をキューに登録
+    python batch_transcribe.py status    # キューの深さ・予想完了時間を表示
+    python batch_transcribe.py pause     # キューの処理を一時停止
+    python batch_transcribe.py resume    # キューの処理を再開
+    python batch_transcribe.py run       # このプロセスでキューを処理（Webサーバーとは別の専用ワーカー）
+
+機能:
+- 一括登録したジョブは新規アップロードより低い優先度で処理
+- 同時実行数は TRANSCRIBE_MAX_CONCURRENT（全体）/ TRANSCRIBE_MAX_PER_TENANT（テナントごと）で制限
+- TRANSCRIBE_ALLOWED_HOURS（例: 22-6）の時間帯のみ処理、TRANSCRIBE_NICE でCPU優先度を指定
+"""
+
+import argparse
+import sys
+import time
+
+# Windows環境での日本語出力対応
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+import app as lms
+
+
+def format_eta(seconds):
+    """秒数を「x時間y分」に整形"""
+    if seconds is None:
+        return '不明（完了実績なし）'
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}時間{rest // 60}分"
+
+
+def print_status(db):
+    """キューの状態を表示"""
+    status = lms.get_transcription_queue_status(db)
+    print(f"📊 文字起こしキュー{'（一時停止中）' if status['paused'] else ''}")
+    print(f"  待機中     : {status['queued']} 件（新規 {status['queued_new']} / 一括 {status['queued_backfill']}）")
+    print(f"  実行中     : {status['running']} 件（上限 全体 {status['max_concurrent']} / テナント {status['max_per_tenant']}）")
+    print(f"  実行時間帯 : {status['allowed_hours'] or '制限なし'}"
+          f"{'' if status['within_allowed_hours'] else '（時間外）'}")
+    print(f"  予想完了   : {format_eta(status['eta_seconds'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='動画ライブラリ一括文字起こし')
+    parser.add_argument('command', choices=['enqueue', 'status', 'pause', 'resume', 'run'])
+    args = parser.parse_args()
+
+    db = lms.get_db()
+
+    if args.command == 'enqueue':
+        if not lms.transcription_available():
+            print(f"❌ 文字起こしエンジン（{lms.TRANSCRIBE_BACKEND}）がインストールされていません")
+            sys.exit(1)
+        count = lms.enqueue_untranscribed_videos(db)
+        print(f"✅ {count}件の動画をキューに登録しました")
+        print_status(db)
+    elif args.command == 'status':
+        print_status(db)
+    elif args.command == 'pause':
+        lms.set_scheduler_setting(db, 'transcription_paused', '1')
+        print("⏸ 文字起こしキューを一時停止しました（実行中のジョブは完了まで継続）")
+    elif args.command == 'resume':
+        lms.set_scheduler_setting(db, 'transcription_paused', '0')
+        print("▶ 文字起こしキューを再開しました")
+    elif args.command == 'run':
+        print("▶ 文字起こしキューの処理を開始します（Ctrl+Cで終了）")
+        lms.transcription_scheduler.start()
+        try:
+            while True:
+                time.sleep(60)
+                print_status(db)
+        except KeyboardInterrupt:
+            print("\n⏹ 終了しました（実行中だったジョブは生存確認が途絶えた後に待機中へ戻り、再実行されます）")
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
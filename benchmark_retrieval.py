@@ -0,0 +1,335 @@
+"""
+チャットRAG検索（search_relevant_content）の精度・レイテンシのベンチマーク
+
+使用方法:
+    python benchmark_retrieval.py                                  # 1k / 10k / 100k パッセージで計測
+    python benchmark_retrieval.py --sizes 1000 10000 --repeat 5 --json bench_retrieval.json
+    python benchmark_retrieval.py --sizes 10000 --json after.json --baseline before.json
+
+機能:
+- migrate_db.py のシード（業種・カテゴリー・ユースケース）から、乱数シード固定の合成コーパス
+  （動画・文字起こし・外部ナレッジ）を一時DBに作成（--seed が同じなら毎回同じコーパス）
+- 業種ごとのゴールデンセット（質問 → 正解の動画・文字起こし・ナレッジ・ユースケース）で
+  ソースごとの recall@1/3/5 と MRR を算出
+- 質問ごとの検索時間の p50 / p95（検索結果キャッシュは無効化して計測）と、ソースを順番に検索した場合との比較
+- 検索候補（SuggestIndex.lookup）の1回あたりの時間の p50 / p95（目安: 1ミリ秒未満）
+- コーパスの規模（パッセージ数）ごとに計測し、比較可能なJSONで出力（--baseline で前回との差分を表示）
+- VECTOR_SEARCH_MODEL を設定している場合は、ベクトルインデックスも作成してハイブリッド検索を計測
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Windows環境での日本語出力対応
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+import app as lms
+import migrate_db
+
+# ゴールデンセット: (業種, ユースケース名) → 質問。正解はそのユースケース用に作る動画・文字起こし・ナレッジ
+GOLDEN_QUESTIONS = {
+    ('宿泊', '予約メール自動返信'): ['予約の問い合わせメールに自動で返信したい', '宿泊予約メールの返信文をAIで作るには？'],
+    ('宿泊', '多言語対応'): ['外国人のお客様向けに館内案内を翻訳したい', 'インバウンド観光客への多言語案内のコツは？'],
+    ('宿泊', '口コミ返信作成'): ['レビューサイトの口コミにどう返信すればいい？', 'お客様レビューへの返信文を作りたい'],
+    ('小売', '商品説明文作成'): ['ECサイトの商品説明文を自動で作りたい', '商品の魅力が伝わるコピーライティングは？'],
+    ('小売', '在庫管理レポート'): ['在庫データの分析レポートを作成したい', '需要予測を在庫管理に活かすには？'],
+    ('小売', 'お客様対応FAQ'): ['よくある質問への回答をまとめたい', 'お客様からの問い合わせ対応を効率化したい'],
+    ('飲食', 'メニュー開発アイデア'): ['季節の新メニューのアイデアがほしい', 'レシピ開発にAIを使う方法は？'],
+    ('飲食', 'SNS投稿文作成'): ['料理写真のInstagram投稿文を考えたい', 'SNS投稿のハッシュタグの付け方は？'],
+    ('飲食', 'アレルギー対応案内'): ['メニューのアレルギー情報を説明したい', '食材のアレルギー対応をどう案内する？'],
+    ('介護', 'ケアプラン作成支援'): ['利用者情報からケアプランを作りたい', '介護計画のアセスメントをAIで支援できる？'],
+    ('介護', '家族への報告書作成'): ['ご家族向けの状況報告書を作成したい', '利用者の様子を家族に報告する文書のまとめ方'],
+    ('介護', '記録文書の効率化'): ['介護記録の文書化を効率化したい', 'メモから正式な介護記録を作るには？'],
+    ('医療', '患者説明資料作成'): ['患者さんに分かりやすい説明資料を作りたい', '治療法の患者説明をAIで作成できる？'],
+    ('医療', '医療文書サマリー'): ['カルテの要約をAIで作りたい', '医療文書のサマリー作成のポイントは？'],
+    ('医療', '問診票の分析'): ['問診票の症状を整理して分析したい', '問診情報から重要なポイントを抜き出すには？'],
+    ('教育', '教材作成支援'): ['授業で使う教材を作成したい', 'カリキュラムに沿った教材づくりのコツは？'],
+    ('教育', 'テスト問題作成'): ['理解度確認のテスト問題を作りたい', '評価用の問題をAIで作成できる？'],
+    ('教育', '保護者向け通知作成'): ['保護者へのお知らせ文書を作りたい', '保護者への連絡をAIで作成するには？'],
+}
+
+# 合成文書の文のひな形（{a}{b} に語を入れる）
+FILLER_TEMPLATES = [
+    "{industry}の現場では{a}と{b}の見直しが進んでいます。",
+    "まずは{a}の現状を確認し、{b}との関係を整理しましょう。",
+    "{a}に生成AIを使う場合は、出力を必ず担当者が確認します。",
+    "研修では{a}の事例を紹介しながら、{b}の手順を練習します。",
+    "{b}の担当者は{a}の記録を週に一度振り返ります。",
+    "よくある失敗は、{a}を急ぎすぎて{b}が後回しになることです。",
+]
+GENERIC_TERMS = ['業務改善', 'シフト管理', '情報共有', '研修計画', '品質管理', 'コスト削減', '接客マナー',
+                 '社内マニュアル', '会議の議事録', '売上分析', '安全対策', '顧客満足度']
+PASSAGE_STEP = lms.PASSAGE_CHARS - lms.PASSAGE_OVERLAP_CHARS  # 1パッセージあたりの新しい文字数の目安
+SOURCES = ['videos', 'transcripts', 'usecases', 'knowledge']
+K_VALUES = (1, 3, 5)
+
+
+def filler_text(rng, industry, vocabulary, chars):
+    """語彙からランダムな文を chars 文字程度つなげた文章"""
+    sentences = []
+    length = 0
+    while length < chars:
+        a, b = rng.sample(vocabulary, 2)
+        sentence = rng.choice(FILLER_TEMPLATES).format(industry=industry, a=a, b=b)
+        sentences.append(sentence)
+        length += len(sentence)
+    return ''.join(sentences)
+
+
+def target_text(usecase):
+    """ユースケースの説明・キーワード・例文から正解文書の本文を作る"""
+    keywords = usecase['keywords'].split(',')
+    return (f"{usecase['title']}のポイントを解説します。{usecase['description']}を行う際は、"
+            f"{'・'.join(keywords)}を意識すると効果的です。"
+            f"プロンプト例：「{usecase['example_prompt']}」。"
+            f"{keywords[0]}の作業時間を減らしつつ、{keywords[-1]}の品質を保つことが目標です。")
+
+
+def build_corpus(db, target_passages, rng):
+    """シードを元に合成コーパスを作成し、ゴールデンセット（質問と正解）を返す"""
+    industries = {r['name']: r['id'] for r in db.execute('SELECT id, name FROM industries')}
+    categories = [r['id'] for r in db.execute('SELECT id FROM categories')]
+    industry_category = {r['industry_id']: r['category_id']
+                         for r in db.execute('SELECT industry_id, category_id FROM category_industry_access')}
+    usecases = db.execute('''
+        SELECT u.id, u.title, u.description, u.keywords, u.example_prompt, i.name AS industry, i.id AS industry_id
+        FROM industry_usecases u JOIN industries i ON i.id = u.industry_id
+    ''').fetchall()
+    vocabulary = sorted({k for u in usecases for k in u['keywords'].split(',')} | set(GENERIC_TERMS))
+
+    golden = []
+    video_id = 0
+    for usecase in usecases:
+        questions = GOLDEN_QUESTIONS.get((usecase['industry'], usecase['title']))
+        if not questions:
+            continue
+        industry = usecase['industry']
+        # 正解の動画（関連部分は文字起こしの中ほど）
+        video_id += 1
+        db.execute('INSERT INTO videos (id, title, description, filename, category_id) VALUES (?, ?, ?, ?, ?)',
+                   (video_id, f"{industry}向け {usecase['title']}実践講座", usecase['description'],
+                    f"bench_{video_id}.mp4", industry_category.get(usecase['industry_id'])))
+        transcript = (filler_text(rng, industry, vocabulary, PASSAGE_STEP * 2) + target_text(usecase)
+                      + filler_text(rng, industry, vocabulary, PASSAGE_STEP * 2))
+        transcript_id = db.execute("INSERT INTO video_transcripts (video_id, content, content_type) VALUES (?, ?, 'transcript')",
+                                   (video_id, transcript)).lastrowid
+        # 正解のナレッジ（2セクション）
+        knowledge_ids = [
+            db.execute('INSERT INTO external_knowledge (industry_id, title, content, section) VALUES (?, ?, ?, ?)',
+                       (usecase['industry_id'], f"{usecase['title']}{suffix}",
+                        target_text(usecase) + filler_text(rng, industry, vocabulary, 120), suffix)).lastrowid
+            for suffix in ('の進め方', 'の注意点')
+        ]
+        for question in questions:
+            golden.append({
+                'industry': industry,
+                'industry_id': usecase['industry_id'],
+                'question': question,
+                'relevant': {'videos': {video_id}, 'transcripts': {transcript_id},
+                             'usecases': {usecase['id']}, 'knowledge': set(knowledge_ids)}
+            })
+
+    # 残りのパッセージを、ナレッジ4割・文字起こし（1本あたり10パッセージ程度）6割の雑多な文書で埋める
+    industry_names = list(industries)
+    remaining = max(0, target_passages - len(golden) * 3)
+    knowledge_rows = []
+    for i in range(remaining * 4 // 10):
+        industry = rng.choice(industry_names)
+        knowledge_rows.append((industries[industry], f"{rng.choice(vocabulary)}メモ{i}",
+                               filler_text(rng, industry, vocabulary, PASSAGE_STEP - 20), 'メモ'))
+    db.executemany('INSERT INTO external_knowledge (industry_id, title, content, section) VALUES (?, ?, ?, ?)',
+                   knowledge_rows)
+    for _ in range((remaining - len(knowledge_rows)) // 10):
+        video_id += 1
+        industry = rng.choice(industry_names)
+        a, b = rng.sample(vocabulary, 2)
+        db.execute('INSERT INTO videos (id, title, description, filename, category_id) VALUES (?, ?, ?, ?, ?)',
+                   (video_id, f"{a}と{b}の基礎", f"{industry}の{a}について", f"bench_{video_id}.mp4",
+                    rng.choice(categories)))
+        db.execute("INSERT INTO video_transcripts (video_id, content, content_type) VALUES (?, ?, 'transcript')",
+                   (video_id, filler_text(rng, industry, vocabulary, PASSAGE_STEP * 10)))
+    db.commit()
+    lms.sync_passages(db, batch_size=2000)
+    return golden
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+
+def score(golden, retrieved):
+    """ソースごとの recall@k と MRR（質問の平均）、業種ごとのMRR（ソースの平均）"""
+    metrics = {}
+    for source in SOURCES:
+        recalls = {k: [] for k in K_VALUES}
+        reciprocal_ranks = []
+        for item, results in zip(golden, retrieved):
+            relevant = item['relevant'][source]
+            ids = [r['id'] for r in results[source]]
+            for k in K_VALUES:
+                recalls[k].append(len(relevant & set(ids[:k])) / len(relevant))
+            rank = next((i for i, item_id in enumerate(ids, 1) if item_id in relevant), None)
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+        metrics[source] = {f"recall@{k}": round(sum(v) / len(v), 3) for k, v in recalls.items()}
+        metrics[source]['mrr'] = round(sum(reciprocal_ranks) / len(reciprocal_ranks), 3)
+        for item, rr in zip(golden, reciprocal_ranks):
+            item.setdefault('rr', []).append(rr)
+    by_industry = {}
+    for item in golden:
+        by_industry.setdefault(item['industry'], []).extend(item.pop('rr'))
+    return metrics, {name: round(sum(v) / len(v), 3) for name, v in by_industry.items()}
+
+
+def prepare_vector_index(db, workdir):
+    """VECTOR_SEARCH_MODEL が設定されていれば、このコーパス用のベクトルインデックスを作成"""
+    index = lms.get_vector_index()
+    if index is None:
+        return False
+    lms._vector_index = lms.VectorIndex(os.path.join(workdir, 'vector_index'), index.encoder, lms.VECTOR_INDEX_BACKEND)
+    lms._vector_index.sync(db)
+    return True
+
+
+def measure(repeat, items, call):
+    """items の各要素で call を repeat 周実行し、1回ごとの時間（ミリ秒）を返す"""
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            t = time.perf_counter()
+            call(item)
+            latencies.append((time.perf_counter() - t) * 1000)
+    return latencies
+
+
+def suggest_latencies(db, repeat):
+    """動画タイトルの先頭1〜2文字を入力とした検索候補の時間（全カテゴリー閲覧可として計測）"""
+    index = lms.SuggestIndex()
+    index.refresh(db)
+    everything = frozenset(r['id'] for r in db.execute('SELECT id FROM categories'))
+    queries = sorted({title[:n] for (title,) in db.execute('SELECT title FROM videos LIMIT 200') for n in (1, 2)})
+    return measure(repeat * 10, queries, lambda query: index.lookup(query, everything))
+
+
+def run_size(target_passages, args):
+    """1つの規模でコーパスを作成して計測"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'bench.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate_db.run_migrations(verbose=False, db_path=path)
+        lms.app.config['DATABASE'] = path
+        db = lms.get_db()
+        start = time.perf_counter()
+        golden = build_corpus(db, target_passages, random.Random(args.seed))
+        passages = db.execute('SELECT COUNT(*) FROM content_passages').fetchone()[0]
+        vector = prepare_vector_index(db, workdir)
+        build_seconds = time.perf_counter() - start
+
+        # 1周目はSQLiteのページキャッシュを温めるため計測しない
+        retrieved = [lms.search_relevant_content(db, item['question'], item['industry_id']) for item in golden]
+        latencies = measure(args.repeat, golden,
+                            lambda item: lms.search_relevant_content(db, item['question'], item['industry_id']))
+        # ソース別検索を並行実行しない場合（RETRIEVAL_WORKERS=0）との比較
+        workers = lms.RETRIEVAL_WORKERS
+        lms.RETRIEVAL_WORKERS = 0
+        sequential = measure(args.repeat, golden,
+                             lambda item: lms.search_relevant_content(db, item['question'], item['industry_id']))
+        lms.RETRIEVAL_WORKERS = workers
+        suggest = suggest_latencies(db, args.repeat)
+        db.close()
+
+    metrics, by_industry = score(golden, retrieved)
+    return {
+        'target_passages': target_passages,
+        'passages': passages,
+        'questions': len(golden),
+        'vector_search': vector,
+        'build_seconds': round(build_seconds, 1),
+        'metrics': metrics,
+        'mrr_by_industry': by_industry,
+        'latency_ms': {'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95)},
+        'sequential_latency_ms': {'p50': percentile(sequential, 0.5), 'p95': percentile(sequential, 0.95)},
+        'suggest_latency_ms': {'p50': percentile(suggest, 0.5), 'p95': percentile(suggest, 0.95)}
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, baseline=None):
+    print(f"📊 {result['passages']:,} パッセージ（質問 {result['questions']} 件, 作成 {result['build_seconds']} 秒"
+          f"{', ベクトル検索あり' if result['vector_search'] else ''}）")
+    print(f"  {'source':12s} {'R@1':>6s} {'R@3':>6s} {'R@5':>6s} {'MRR':>6s}")
+    for source, m in result['metrics'].items():
+        delta = ''
+        if baseline:
+            diff = m['mrr'] - baseline['metrics'][source]['mrr']
+            delta = f"  ({diff:+.3f})"
+        print(f"  {source:12s} {m['recall@1']:6.3f} {m['recall@3']:6.3f} {m['recall@5']:6.3f} {m['mrr']:6.3f}{delta}")
+    latency = result['latency_ms']
+    delta = f"（前回 p95 {baseline['latency_ms']['p95']}ms）" if baseline else ''
+    print(f"  レイテンシ : p50 {latency['p50']}ms / p95 {latency['p95']}ms{delta}")
+    sequential = result['sequential_latency_ms']
+    print(f"  順次検索   : p50 {sequential['p50']}ms / p95 {sequential['p95']}ms")
+    suggest = result['suggest_latency_ms']
+    print(f"  検索候補   : p50 {suggest['p50']}ms / p95 {suggest['p95']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='チャットRAG検索の精度（recall@k・MRR）とレイテンシのベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='コーパスのパッセージ数（既定: 1000 10000 100000）')
+    parser.add_argument('--seed', type=int, default=42, help='合成コーパスの乱数シード')
+    parser.add_argument('--repeat', type=int, default=3, help='レイテンシ計測で質問セットを繰り返す回数')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    parser.add_argument('--baseline', help='比較する前回のJSON（同じパッセージ数の結果と差分を表示）')
+    args = parser.parse_args()
+
+    # キャッシュに当たると検索時間を計測できないため無効化
+    lms.RETRIEVAL_CACHE_ENABLED = False
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {r['target_passages']: r for r in json.load(f)['results']}
+
+    report = {
+        'revision': git_revision(),
+        'seed': args.seed,
+        'config': {
+            'passage_chars': lms.PASSAGE_CHARS,
+            'passage_overlap_chars': lms.PASSAGE_OVERLAP_CHARS,
+            'retrieval_workers': lms.RETRIEVAL_WORKERS,
+            'vector_search_model': lms.VECTOR_SEARCH_MODEL or None,
+            'rrf_k': lms.RRF_K
+        },
+        'results': []
+    }
+    for size in args.sizes:
+        result = run_size(size, args)
+        report['results'].append(result)
+        print_result(result, baseline.get(size))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 結果を保存しました: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
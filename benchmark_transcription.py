@@ -0,0 +1,123 @@
+"""
+文字起こし処理のベンチマークスクリプト
+
+使用方法:
+    python benchmark_transcription.py videos/sample.mp4
+    python benchmark_transcription.py videos/sample.mp4 --backends openai-whisper faster-whisper --model small
+    python benchmark_transcription.py videos/sample.mp4 --mode both --workers 4
+    python benchmark_transcription.py videos/sample.mp4 --mode all --backends openai-whisper
+    python benchmark_transcription.py videos/sample.mp4 --json bench_output.json
+
+機能:
+- バックエンド（openai-whisper / faster-whisper）ごとに文字起こし時間を計測
+- 実時間係数（RTF = 処理時間 / 音声長、1未満なら実時間より速い）を算出
+- 計測ごとに新しいプロセスを起動し、ピークRSS（最大常駐メモリ）を計測
+- 従来の単一呼び出しと、無音区間分割による並列文字起こしの比較（--mode both）
+- 進捗通知用のチャンク逐次文字起こし（TRANSCRIBE_PROGRESS_CHUNKS=1 の経路、openai-whisperのみ）の計測（--mode chunked / all）
+- 音声は事前にデコードしてキャッシュ（AUDIO_CACHE_DIR）するため、計測値にffmpegのデコード時間は含まれない
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Windows環境での日本語出力対応
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windowsではピークメモリを計測しない
+
+import app as lms
+
+
+def peak_rss_mb():
+    """自プロセスと子プロセスのピークRSS（MB）を返す"""
+    if resource is None:
+        return None
+    # Linuxの ru_maxrss はKB単位、macOSはバイト単位
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / unit, 1)
+
+
+def run_case(path, backend_name, model_size, mode, workers, threads):
+    """1ケースを計測（子プロセス内で実行される）"""
+    start = time.perf_counter()
+    if mode == 'parallel':
+        result = lms.transcribe_parallel(path, workers, backend_name, model_size)
+        load_seconds = None
+    else:
+        backend = lms.get_transcription_backend(backend_name, model_size, threads)
+        load_seconds = time.perf_counter() - start
+        audio = lms.load_cached_audio(lms.ensure_cached_audio(path))
+        if mode == 'chunked':
+            # 子プロセス内でのみ有効化し、本番と同じく進捗コールバック付きで呼び出す
+            lms.TRANSCRIBE_PROGRESS_CHUNKS = True
+            result = backend.transcribe(audio, progress=lambda ratio: None)
+        else:
+            result = backend.transcribe(audio)
+    elapsed = time.perf_counter() - start
+    return {
+        'backend': backend_name,
+        'mode': mode,
+        'seconds': round(elapsed, 2),
+        'load_seconds': round(load_seconds, 2) if load_seconds is not None else None,
+        'segments': len(result['segments']),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文字起こしバックエンドのベンチマーク（RTF・ピークRSS）')
+    parser.add_argument('file', help='計測に使う動画/音声ファイル')
+    parser.add_argument('--backends', nargs='+', default=list(lms.TRANSCRIPTION_BACKENDS),
+                        help='計測するバックエンド（既定: すべて）')
+    parser.add_argument('--model', default=lms.WHISPER_MODEL_SIZE, help='モデルサイズ（既定: WHISPER_MODEL_SIZE）')
+    parser.add_argument('--mode', choices=['single', 'parallel', 'chunked', 'both', 'all'], default='single',
+                        help='単一呼び出し / 並列文字起こし / チャンク逐次（進捗通知） / 単一と並列 / すべて')
+    parser.add_argument('--workers', type=int, default=lms.TRANSCRIBE_WORKERS, help='並列ワーカー数（既定: TRANSCRIBE_WORKERS）')
+    parser.add_argument('--threads', type=int, default=lms.TRANSCRIBE_THREADS, help='単一呼び出し時のスレッド数')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    if lms.np is None:
+        print("❌ numpy がインストールされていません")
+        sys.exit(1)
+
+    # 先に音声をデコードしてキャッシュしておき、各ケースはデコード済み音声から計測する
+    duration = len(lms.load_cached_audio(lms.ensure_cached_audio(args.file))) / lms.AUDIO_SAMPLE_RATE
+    report = {'file': args.file, 'model': args.model, 'audio_seconds': round(duration, 1), 'results': []}
+    print(f"📊 ファイル: {args.file}（音声 {duration:.1f} 秒, モデル {args.model}）")
+    print(f"  {'backend':16s} {'mode':9s} {'秒':>8s} {'RTF':>6s} {'peak RSS(MB)':>13s}")
+
+    modes = {'both': ['single', 'parallel'], 'all': ['single', 'parallel', 'chunked']}.get(args.mode, [args.mode])
+    for backend_name in args.backends:
+        if not lms.transcription_available(backend_name):
+            print(f"  {backend_name:16s} (未インストールのためスキップ)")
+            continue
+        for mode in modes:
+            if mode == 'chunked' and backend_name != 'openai-whisper':
+                continue  # 他のバックエンドはセグメントごとに進捗を通知するためチャンク分割しない
+            # モデルのメモリを混在させないよう、ケースごとに新しいプロセスで計測
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                case = pool.submit(run_case, args.file, backend_name, args.model,
+                                   mode, args.workers, args.threads).result()
+            case['rtf'] = round(case['seconds'] / max(duration, 1e-9), 3)
+            report['results'].append(case)
+            rss = f"{case['peak_rss_mb']:.1f}" if case['peak_rss_mb'] is not None else '-'
+            print(f"  {backend_name:16s} {mode:9s} {case['seconds']:8.2f} {case['rtf']:6.3f} {rss:>13s}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 結果を保存しました: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
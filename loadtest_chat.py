@@ -0,0 +1,215 @@
+"""
+AIチャットの負荷試験スクリプト
+
+使用方法:
+    python mock_rakuten_ai.py --latency-ms 800 &              # 実APIの代わりにモックサーバーを起動
+    RAKUTEN_AI_BASE_URL=http://127.0.0.1:8900/v1/ RAKUTEN_AI_API_KEY=dummy gunicorn app:app ...
+    python loadtest_chat.py --url http://127.0.0.1:5000 --concurrency 20 --requests 500
+    python loadtest_chat.py --url http://127.0.0.1:8001 --stream --duration 60 --json loadtest.json
+
+機能:
+- 一般ユーザーでログインし、/api/chat（--stream で /api/chat/stream）に同時にリクエストを送る
+- 質問はチャット履歴（chat_history）と業種別ユースケースから作成し、実際の利用に近い質問を再生する
+  （DBが使えない場合は組み込みの質問を使う）
+- 検索・プロンプト組み立て・API呼び出し・履歴保存を含むチャット全体の応答時間 p50/p95/p99 とスループットを集計
+- ストリーミングでは最初のトークンまでの時間（TTFT）も集計し、キャッシュ応答・フォールバック応答の件数も表示
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+# Windows環境での日本語出力対応
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+# DBから質問を取得できない場合の質問
+DEFAULT_QUESTIONS = [
+    "ホテルの予約対応でAIを使うには？",
+    "口コミへの返信をAIで作成する方法を教えてください",
+    "接客でのAI活用事例はありますか？",
+    "清掃スタッフのシフト作成にAIは使えますか",
+    "多言語対応の問い合わせをAIで自動化したい",
+    "生成AIで社内マニュアルを要約するコツは？",
+    "プロンプトの書き方の基本を教えてください",
+    "AI導入時のセキュリティ上の注意点は？",
+]
+
+
+def load_questions(limit=500):
+    """チャット履歴・ユースケースの例から質問を集める（重複を除く）"""
+    try:
+        import app as lms
+        db = lms.get_db()
+        try:
+            rows = db.execute(
+                'SELECT message FROM chat_history ORDER BY created_at DESC LIMIT ?', (limit,)
+            ).fetchall()
+            questions = [r['message'] for r in rows]
+            rows = db.execute(
+                "SELECT example_prompt, title FROM industry_usecases LIMIT ?", (limit,)
+            ).fetchall()
+            questions += [r['example_prompt'] or f"{r['title']}について教えてください" for r in rows]
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"⚠ DBから質問を取得できないため組み込みの質問を使います: {e}")
+        questions = []
+    questions = list(dict.fromkeys(q.strip() for q in questions if q and q.strip()))
+    return questions or DEFAULT_QUESTIONS
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 1)
+
+
+class Results:
+    """1リクエストごとの結果を集める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+def login(client, username, password):
+    response = client.post('/login', json={'username': username, 'password': password})
+    if response.status_code != 200 or not response.json().get('success'):
+        raise RuntimeError(f"ログインに失敗しました: {username} ({response.status_code})")
+
+
+def send_chat(client, question):
+    """/api/chat を呼び出して結果を返す"""
+    start = time.perf_counter()
+    response = client.post('/api/chat', json={'message': question})
+    elapsed = (time.perf_counter() - start) * 1000
+    data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+    return {
+        'status': response.status_code,
+        'ok': response.status_code == 200 and data.get('success', False),
+        'total_ms': elapsed,
+        'ttft_ms': None,
+        'cached': bool(data.get('cached')),
+        'fallback': bool(data.get('fallback'))
+    }
+
+
+def send_chat_stream(client, question):
+    """/api/chat/stream を呼び出し、最初のトークンまでと完了までの時間を計測"""
+    start = time.perf_counter()
+    record = {'status': None, 'ok': False, 'total_ms': None, 'ttft_ms': None, 'cached': False, 'fallback': False}
+    with client.stream('POST', '/api/chat/stream', json={'message': question}) as response:
+        record['status'] = response.status_code
+        event = None
+        for line in response.iter_lines():
+            if line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:'):
+                if event == 'token' and record['ttft_ms'] is None:
+                    record['ttft_ms'] = (time.perf_counter() - start) * 1000
+                elif event == 'done':
+                    data = json.loads(line[5:])
+                    record.update(ok=True, cached=bool(data.get('cached')), fallback=bool(data.get('fallback')))
+                elif event == 'error':
+                    break
+    record['total_ms'] = (time.perf_counter() - start) * 1000
+    return record
+
+
+def worker(args, questions, results, stop_at, counter):
+    """ログイン済みのクライアントで、終了条件まで質問を送り続ける"""
+    with httpx.Client(base_url=args.url, timeout=args.timeout, follow_redirects=False) as client:
+        login(client, args.username, args.password)
+        send = send_chat_stream if args.stream else send_chat
+        while time.perf_counter() < stop_at:
+            with counter['lock']:
+                if args.requests and counter['sent'] >= args.requests:
+                    return
+                counter['sent'] += 1
+            try:
+                results.add(send(client, random.choice(questions)))
+            except httpx.HTTPError as e:
+                results.add({'status': None, 'ok': False, 'total_ms': None, 'ttft_ms': None,
+                             'cached': False, 'fallback': False, 'error': type(e).__name__})
+            if args.think_ms:
+                time.sleep(random.expovariate(1000 / args.think_ms))
+
+
+def summarize(records, elapsed):
+    ok = [r for r in records if r['ok']]
+    total = [r['total_ms'] for r in ok]
+    ttft = [r['ttft_ms'] for r in ok if r['ttft_ms'] is not None]
+    report = {
+        'requests': len(records),
+        'succeeded': len(ok),
+        'failed': len(records) - len(ok),
+        'cached': sum(1 for r in ok if r['cached']),
+        'fallback': sum(1 for r in ok if r['fallback']),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else None,
+        'total_ms': {p: percentile(total, q) for p, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+    }
+    if ttft:
+        report['ttft_ms'] = {p: percentile(ttft, q) for p, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AIチャット（/api/chat）の負荷試験')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='LMSのURL（ASGIサーバーも可）')
+    parser.add_argument('--username', default='ryokan_suzuki', help='ログインするユーザー')
+    parser.add_argument('--password', default='user123')
+    parser.add_argument('--concurrency', type=int, default=10, help='同時に質問するユーザー数')
+    parser.add_argument('--requests', type=int, default=200, help='送信する総リクエスト数（0なら --duration まで）')
+    parser.add_argument('--duration', type=float, default=300, help='最大実行秒数')
+    parser.add_argument('--think-ms', type=float, default=0, help='ユーザーごとの質問間隔の平均（ミリ秒、指数分布）')
+    parser.add_argument('--stream', action='store_true', help='/api/chat/stream を使う（TTFTも計測）')
+    parser.add_argument('--timeout', type=float, default=60, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--seed', type=int, default=None, help='質問選択の乱数シード')
+    parser.add_argument('--json', help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    questions = load_questions()
+    print(f"📊 {args.url} {'/api/chat/stream' if args.stream else '/api/chat'}"
+          f"（同時 {args.concurrency} / 質問 {len(questions)} 種類）")
+
+    results = Results()
+    counter = {'sent': 0, 'lock': threading.Lock()}
+    start = time.perf_counter()
+    stop_at = start + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(worker, args, questions, results, stop_at, counter) for _ in range(args.concurrency)]
+        for future in futures:
+            future.result()
+    report = summarize(results.records, time.perf_counter() - start)
+
+    print(f"  リクエスト : {report['requests']} 件（成功 {report['succeeded']} / 失敗 {report['failed']}）")
+    print(f"  キャッシュ : {report['cached']} 件 / フォールバック {report['fallback']} 件")
+    print(f"  スループット: {report['throughput_rps']} req/秒（{report['elapsed_seconds']} 秒）")
+    for key, label in (('total_ms', '応答時間'), ('ttft_ms', 'TTFT')):
+        if key in report:
+            p = report[key]
+            print(f"  {label:8s}: p50 {p['p50']}ms / p95 {p['p95']}ms / p99 {p['p99']}ms")
+
+    if args.json:
+        report.update(url=args.url, stream=args.stream, concurrency=args.concurrency)
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 結果を保存しました: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -918,6 +918,568 @@ def migration_014_announcements_table(cursor):
     print("    announcements テーブルを作成しました")
 
 
+def migration_015_transcript_segment_index(cursor):
+    """タイムスタンプ付きセグメント検索用インデックスを作成"""
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_video_transcripts_segments
+    ON video_transcripts (video_id, content_type, timestamp_start)
+    ''')
+    print("    idx_video_transcripts_segments インデックスを作成しました")
+
+
+def migration_016_summary_chunk_cache(cursor):
+    """概要生成の部分要約キャッシュテーブルを作成"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS summary_chunk_cache (
+        chunk_hash TEXT PRIMARY KEY,
+        summary TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    print("    summary_chunk_cache テーブルを作成しました")
+
+
+def migration_017_event_feed(cursor):
+    """リアルタイム通知（SSE）のワーカー間配信用イベントフィードを作成"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS event_feed (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel TEXT NOT NULL,
+        event TEXT NOT NULL,
+        data TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    print("    event_feed テーブルを作成しました")
+
+
+def migration_018_transcription_jobs(cursor):
+    """文字起こしジョブキューとアプリ設定テーブルを作成"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transcription_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        video_id INTEGER NOT NULL,
+        tenant_id INTEGER,
+        priority INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'queued',
+        error TEXT,
+        duration_seconds REAL,
+        enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        FOREIGN KEY (video_id) REFERENCES videos (id) ON DELETE CASCADE,
+        FOREIGN KEY (tenant_id) REFERENCES tenants (id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_transcription_jobs_status
+    ON transcription_jobs (status, priority, id)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS app_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+    print("    transcription_jobs, app_settings テーブルを作成しました")
+
+
+def migration_019_llm_response_cache(cursor):
+    """LLM応答キャッシュとキャッシュのヒット/ミス集計テーブルを作成"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS llm_response_cache (
+        cache_key TEXT PRIMARY KEY,
+        industry_id INTEGER,
+        question TEXT NOT NULL,
+        response TEXT NOT NULL,
+        context_ids TEXT,
+        hit_count INTEGER DEFAULT 0,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_llm_response_cache_last_used
+    ON llm_response_cache (last_used_at)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS cache_stats (
+        name TEXT PRIMARY KEY,
+        hits INTEGER DEFAULT 0,
+        misses INTEGER DEFAULT 0
+    )
+    ''')
+    print("    llm_response_cache, cache_stats テーブルを作成しました")
+
+
+def migration_020_llm_cache_invalidation(cursor):
+    """参考情報のコンテンツが更新・削除されたら、それを使った応答キャッシュを削除するトリガーを作成"""
+    # 外部ナレッジはアップロード時に作成していたが、トリガーを張るため先に作成しておく
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS external_knowledge (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        industry_id INTEGER,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        source_file TEXT,
+        section TEXT,
+        keywords TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (industry_id) REFERENCES industries (id)
+    )
+    ''')
+    # context_ids は ["knowledge:12", "transcript:3", ...] 形式のJSON
+    sources = [
+        ('external_knowledge', 'knowledge', ''),
+        ('industry_usecases', 'usecase', ''),
+        # セグメントはチャットの参考情報に使わないため対象外（文字起こしのたびに大量に削除されるため）
+        ('video_transcripts', 'transcript', "WHEN OLD.content_type != 'segment'"),
+    ]
+    for table, prefix, condition in sources:
+        for event in ('UPDATE', 'DELETE'):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_llm_cache_{prefix}_{event.lower()}
+            AFTER {event} ON {table} {condition}
+            BEGIN
+                DELETE FROM llm_response_cache WHERE context_ids LIKE '%"{prefix}:' || OLD.id || '"%';
+            END
+            ''')
+    print("    応答キャッシュ無効化トリガーを作成しました")
+
+
+def migration_021_fulltext_index(cursor):
+    """動画・文字起こし・ユースケース・外部ナレッジの全文検索インデックス（FTS5 trigram）を作成
+    
+    日本語は単語区切りがないため、3文字単位で索引するtrigramトークナイザーを使う（SQLite 3.34以降）。
+    元テーブルの内容はトリガーでインデックスへ反映する。
+    """
+    # (元テーブル, 索引する列)
+    sources = [
+        ('videos', ['title', 'description']),
+        ('video_transcripts', ['content']),
+        ('industry_usecases', ['title', 'description', 'keywords']),
+        ('external_knowledge', ['title', 'content', 'keywords']),
+    ]
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.fts_check USING fts5(x, tokenize='trigram')")
+        cursor.execute("DROP TABLE temp.fts_check")
+    except sqlite3.OperationalError as e:
+        print(f"    ⚠ FTS5（trigram）が使えないため全文検索インデックスを作成しません: {e}")
+        return
+    
+    for table, columns in sources:
+        fts = f"{table}_fts"
+        cols = ', '.join(columns)
+        new_values = ', '.join(f"NEW.{c}" for c in columns)
+        old_values = ', '.join(f"OLD.{c}" for c in columns)
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+        USING fts5({cols}, content='{table}', content_rowid='id', tokenize='trigram')
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+        END
+        ''')
+        # 視聴数などの更新では索引し直さない
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {cols} ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old_values});
+            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new_values});
+        END
+        ''')
+        # 既存の行を索引
+        cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+    print("    videos_fts, video_transcripts_fts, industry_usecases_fts, external_knowledge_fts を作成しました")
+
+
+def migration_022_vector_index(cursor):
+    """ベクトルインデックスの行と出典の対応表、再ベクトル化キューを作成
+    
+    ベクトル自体は VECTOR_INDEX_DIR のファイルに保存する。出典の追加・更新・削除はトリガーでキューに登録し、
+    アプリが差分だけ再計算する。既存のコンテンツはすべてキューに登録する。
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS vector_entries (
+        row INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,
+        source_id INTEGER NOT NULL,
+        passage_index INTEGER NOT NULL,
+        deleted INTEGER DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_vector_entries_source
+    ON vector_entries (source, source_id)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS vector_index_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        source_id INTEGER NOT NULL
+    )
+    ''')
+    # (元テーブル, 出典の種類, ベクトル化する列, 条件)
+    sources = [
+        ('videos', 'video', 'title, description', ''),
+        ('video_transcripts', 'transcript', 'content', "content_type != 'segment'"),
+        ('external_knowledge', 'knowledge', 'title, content', ''),
+    ]
+    for table, source, columns, condition in sources:
+        for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD'), (f'UPDATE OF {columns}', 'NEW')):
+            when = f"WHEN {row}.{condition}" if condition else ''
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_vector_{source}_{event.split()[0].lower()}
+            AFTER {event} ON {table} {when}
+            BEGIN
+                INSERT INTO vector_index_queue (source, source_id) VALUES ('{source}', {row}.id);
+            END
+            ''')
+        cursor.execute(f'''
+        INSERT INTO vector_index_queue (source, source_id)
+        SELECT '{source}', id FROM {table} {'WHERE ' + condition if condition else ''}
+        ''')
+    print("    vector_entries, vector_index_queue テーブルを作成しました")
+
+
+def migration_023_content_passages(cursor):
+    """文字起こし・外部ナレッジを重なりのある窓に分割した検索用パッセージのテーブルを作成
+    
+    パッセージは元の文書内の位置（文字オフセット）と、文字起こしの場合は開始・終了秒を持つ。
+    分割はアプリが行うため、出典の追加・更新はトリガーで passage_queue に登録する（削除は即時に反映）。
+    ベクトルインデックスの対象も文書単位からパッセージ単位に切り替える。
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS content_passages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        source_id INTEGER NOT NULL,
+        passage_index INTEGER NOT NULL,
+        title TEXT,
+        content TEXT NOT NULL,
+        char_start INTEGER NOT NULL,
+        char_end INTEGER NOT NULL,
+        timestamp_start REAL,
+        timestamp_end REAL
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_content_passages_source
+    ON content_passages (source, source_id, passage_index)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS passage_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        source_id INTEGER NOT NULL
+    )
+    ''')
+    # (元テーブル, 出典の種類, 分割する列, 条件)
+    sources = [
+        ('video_transcripts', 'transcript', 'content', "content_type != 'segment'"),
+        ('external_knowledge', 'knowledge', 'title, content', ''),
+    ]
+    for table, source, columns, condition in sources:
+        for event, row in (('INSERT', 'NEW'), (f'UPDATE OF {columns}', 'NEW')):
+            when = f"WHEN {row}.{condition}" if condition else ''
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_passage_{source}_{event.split()[0].lower()}
+            AFTER {event} ON {table} {when}
+            BEGIN
+                INSERT INTO passage_queue (source, source_id) VALUES ('{source}', {row}.id);
+            END
+            ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_passage_{source}_delete
+        AFTER DELETE ON {table}
+        BEGIN
+            DELETE FROM content_passages WHERE source = '{source}' AND source_id = OLD.id;
+        END
+        ''')
+        cursor.execute(f'''
+        INSERT INTO passage_queue (source, source_id)
+        SELECT '{source}', id FROM {table} {'WHERE ' + condition if condition else ''}
+        ''')
+    
+    # 全文検索インデックス（FTS5 trigram が使える場合のみ）
+    fts_tables = cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'videos_fts'"
+    ).fetchone()[0]
+    if fts_tables:
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS content_passages_fts
+        USING fts5(title, content, content='content_passages', content_rowid='id', tokenize='trigram')
+        ''')
+        # パッセージは作り直すだけで更新しないため、追加・削除のみ
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_content_passages_fts_insert AFTER INSERT ON content_passages
+        BEGIN
+            INSERT INTO content_passages_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_content_passages_fts_delete AFTER DELETE ON content_passages
+        BEGIN
+            INSERT INTO content_passages_fts (content_passages_fts, rowid, title, content)
+            VALUES ('delete', OLD.id, OLD.title, OLD.content);
+        END
+        ''')
+    
+    # ベクトルインデックスの対象を文書からパッセージへ切り替え
+    for source in ('transcript', 'knowledge'):
+        for event in ('insert', 'delete', 'update'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_vector_{source}_{event}')
+    cursor.execute("UPDATE vector_entries SET deleted = 1 WHERE source IN ('transcript', 'knowledge')")
+    cursor.execute("DELETE FROM vector_index_queue WHERE source IN ('transcript', 'knowledge')")
+    for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_vector_passage_{event.lower()}
+        AFTER {event} ON content_passages
+        BEGIN
+            INSERT INTO vector_index_queue (source, source_id) VALUES ('passage', {row}.id);
+        END
+        ''')
+    print("    content_passages, passage_queue テーブルを作成しました")
+
+
+def migration_024_content_version(cursor):
+    """検索結果キャッシュ用のコンテンツバージョン（app_settings の content_version）と、それを増やすトリガーを作成
+    
+    検索対象（動画・カテゴリーのアクセス権・文字起こし・ユースケース・外部ナレッジ・パッセージ・ベクトル）が
+    追加・更新・削除されるたびに1増える。キャッシュはバージョンが変わったエントリを使わない。
+    """
+    cursor.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES ('content_version', '0')")
+    # (元テーブル, 更新を監視する列（空なら全列）, 条件)
+    sources = [
+        ('videos', 'title, description, category_id', ''),
+        ('categories', '', ''),
+        ('category_industry_access', '', ''),
+        # セグメントは検索対象ではないため対象外（文字起こしのたびに大量に追加・削除されるため）
+        ('video_transcripts', 'content', "content_type != 'segment'"),
+        ('industry_usecases', '', ''),
+        ('external_knowledge', '', ''),
+        ('content_passages', '', ''),
+        ('vector_entries', 'deleted', ''),
+    ]
+    for table, columns, condition in sources:
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            if event == 'UPDATE' and columns:
+                event = f'UPDATE OF {columns}'
+            when = f"WHEN {row}.{condition}" if condition else ''
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_content_version_{table}_{event.split()[0].lower()}
+            AFTER {event} ON {table} {when}
+            BEGIN
+                UPDATE app_settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'content_version';
+            END
+            ''')
+    print("    コンテンツバージョンのトリガーを作成しました")
+
+
+def migration_025_search_index(cursor):
+    """全体検索（/api/search）用の検索インデックスを作成
+    
+    動画・文字起こしセグメント・Q&Aスレッド・外部ナレッジを1つの search_documents にまとめ、
+    2文字単位（英数字は単語単位）に分割したテキストを search_fts（FTS5）で索引する。
+    trigram では一致しない2文字の日本語（「予約」「接客」など）もインデックスで検索できる。
+    分割はアプリが行うため、出典の追加・更新はトリガーで search_queue に登録する（削除は即時に反映）。
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        video_id INTEGER,
+        tenant_id INTEGER,
+        industry_id INTEGER,
+        title TEXT,
+        body TEXT,
+        timestamp_start REAL,
+        timestamp_end REAL
+    )
+    ''')
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_search_documents_ref
+    ON search_documents (kind, ref_id)
+    ''')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(title, body, tokenize='unicode61')
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_search_documents_delete AFTER DELETE ON search_documents
+    BEGIN
+        DELETE FROM search_fts WHERE rowid = OLD.id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL
+    )
+    ''')
+    # (元テーブル, 文書の種類, 文書のID, 索引する列, 条件)
+    sources = [
+        ('videos', 'video', 'id', 'title, description', ''),
+        ('video_transcripts', 'segment', 'id', 'content', "content_type = 'segment'"),
+        ('video_questions', 'qa', 'id', 'question_text', ''),
+        # 回答は質問のスレッド（qa）の一部として索引する
+        ('video_answers', 'qa', 'question_id', 'answer_text', ''),
+        ('external_knowledge', 'knowledge', 'id', 'title, content', ''),
+    ]
+    for table, kind, ref, columns, condition in sources:
+        for event, row in (('INSERT', 'NEW'), (f'UPDATE OF {columns}', 'NEW'), ('DELETE', 'OLD')):
+            when = f"WHEN {row}.{condition}" if condition else ''
+            if event == 'DELETE' and ref == 'id':
+                action = f"DELETE FROM search_documents WHERE kind = '{kind}' AND ref_id = OLD.id;"
+            else:
+                action = f"INSERT INTO search_queue (kind, ref_id) VALUES ('{kind}', {row}.{ref});"
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_search_{table}_{event.split()[0].lower()}
+            AFTER {event} ON {table} {when}
+            BEGIN
+                {action}
+            END
+            ''')
+        cursor.execute(f'''
+        INSERT INTO search_queue (kind, ref_id)
+        SELECT DISTINCT '{kind}', {ref} FROM {table} {'WHERE ' + condition if condition else ''}
+        ''')
+    # 検索結果キャッシュ（content_version）は検索インデックスの更新でも無効化する（migration_029 で search_version に変更）
+    for event in ('INSERT', 'DELETE'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_content_version_search_documents_{event.lower()}
+        AFTER {event} ON search_documents
+        BEGIN
+            UPDATE app_settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'content_version';
+        END
+        ''')
+    print("    search_documents, search_fts, search_queue を作成しました")
+
+
+def migration_026_slug_content_version(cursor):
+    """スラッグの変更でもコンテンツのバージョンを増やす（タイトル補完のインデックスがスラッグを持つため）"""
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_content_version_videos_slug
+    AFTER UPDATE OF slug ON videos
+    BEGIN
+        UPDATE app_settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'content_version';
+    END
+    ''')
+    print("    trg_content_version_videos_slug を作成しました")
+
+
+def migration_027_knowledge_section_hash(cursor):
+    """外部ナレッジのセクションに安定したキー（section_key）と内容のハッシュ（content_hash）を追加
+    
+    再アップロード時はキーで既存のセクションと対応づけ、ハッシュが変わったセクションだけを更新・追加・削除する。
+    キーは見出し（同じファイル内で重複する場合は「見出し#2」のように出現順を付ける）。
+    既存の行のハッシュは空のままにし、次回のアップロード時に内容から計算する。
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS external_knowledge (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        industry_id INTEGER,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        source_file TEXT,
+        section TEXT,
+        keywords TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (industry_id) REFERENCES industries (id)
+    )
+    ''')
+    if not column_exists(cursor, 'external_knowledge', 'section_key'):
+        cursor.execute("ALTER TABLE external_knowledge ADD COLUMN section_key TEXT")
+    if not column_exists(cursor, 'external_knowledge', 'content_hash'):
+        cursor.execute("ALTER TABLE external_knowledge ADD COLUMN content_hash TEXT")
+    
+    rows = cursor.execute('''
+        SELECT id, source_file, COALESCE(section, title) FROM external_knowledge
+        WHERE source_file IS NOT NULL AND section_key IS NULL ORDER BY source_file, id
+    ''').fetchall()
+    seen = {}
+    for knowledge_id, source_file, title in rows:
+        count = seen[(source_file, title)] = seen.get((source_file, title), 0) + 1
+        key = title if count == 1 else f"{title}#{count}"
+        cursor.execute('UPDATE external_knowledge SET section_key = ? WHERE id = ?', (key, knowledge_id))
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_external_knowledge_section
+    ON external_knowledge (source_file, section_key)
+    ''')
+    print("    external_knowledge に section_key, content_hash を追加しました")
+
+
+def migration_028_llm_cache_content_version(cursor):
+    """LLM応答キャッシュに、回答を作成した時点のコンテンツのバージョンを追加
+    
+    類似質問キャッシュは、参考情報が同じ時点のもの（バージョンが一致する）回答だけを返す。
+    既存のエントリはバージョンがないため、完全一致でのみ使う。
+    """
+    if not column_exists(cursor, 'llm_response_cache', 'content_version'):
+        cursor.execute("ALTER TABLE llm_response_cache ADD COLUMN content_version TEXT")
+    print("    llm_response_cache に content_version を追加しました")
+
+
+def migration_029_search_version(cursor):
+    """検索インデックス（search_documents）の更新は content_version ではなく search_version で数える
+    
+    search_documents はQ&Aスレッド・文字起こしセグメントも索引するため、質問・回答の投稿のたびに
+    content_version が増え、チャットの検索結果キャッシュ・類似質問キャッシュが無効になっていた。
+    検索対象の元テーブルの変更は migration_024 のトリガーで content_version に反映済みのため、
+    search_documents のトリガーは /api/search の結果キャッシュ用の search_version だけを増やす。
+    """
+    cursor.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES ('search_version', '0')")
+    for event in ('INSERT', 'DELETE'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_content_version_search_documents_{event.lower()}')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_search_version_search_documents_{event.lower()}
+        AFTER {event} ON search_documents
+        BEGIN
+            UPDATE app_settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'search_version';
+        END
+        ''')
+    print("    search_version のトリガーを作成しました")
+
+
+def migration_030_llm_cache_video_invalidation(cursor):
+    """回答で案内した動画のタイトル・説明・カテゴリーの変更、削除でも応答キャッシュを削除するトリガーを作成
+    
+    類似質問キャッシュは全体の content_version ではなく、回答の参考情報（context_ids）ごとに有効かを判定する。
+    ナレッジ・ユースケース・文字起こしは migration_020 のトリガーで削除済みのため、動画の分を追加する
+    （llm_response_cache.content_version は使わない）。
+    """
+    for event in ('UPDATE OF title, description, category_id', 'DELETE'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_llm_cache_video_{event.split()[0].lower()}
+        AFTER {event} ON videos
+        BEGIN
+            DELETE FROM llm_response_cache WHERE context_ids LIKE '%"video:' || OLD.id || '"%';
+        END
+        ''')
+    print("    動画の応答キャッシュ無効化トリガーを作成しました")
+
+
+def migration_031_transcription_job_heartbeat(cursor):
+    """文字起こしジョブに実行中の生存確認時刻（heartbeat_at）を追加
+
+    異常終了・再起動で実行中のまま残ったジョブを、タイムアウトを待たずに再登録できるようにする。
+    """
+    if not column_exists(cursor, 'transcription_jobs', 'heartbeat_at'):
+        cursor.execute('ALTER TABLE transcription_jobs ADD COLUMN heartbeat_at TIMESTAMP')
+    print("    transcription_jobs.heartbeat_at を追加しました")
+
+
 MIGRATIONS = [
     (1, '基本テーブル作成', migration_001_base_tables),
     (2, 'テナント・部署・ロール対応', migration_002_tenant_department_role),
@@ -933,6 +1495,23 @@ MIGRATIONS = [
     (12, '全テナントにcompany_admin確保', migration_012_ensure_company_admins),
     (13, '動画Q&Aテーブル作成', migration_013_video_qa_tables),
     (14, 'お知らせテーブル作成', migration_014_announcements_table),
+    (15, '文字起こしセグメント用インデックス作成', migration_015_transcript_segment_index),
+    (16, '部分要約キャッシュテーブル作成', migration_016_summary_chunk_cache),
+    (17, 'イベントフィードテーブル作成', migration_017_event_feed),
+    (18, '文字起こしジョブキュー作成', migration_018_transcription_jobs),
+    (19, 'LLM応答キャッシュテーブル作成', migration_019_llm_response_cache),
+    (20, '応答キャッシュ無効化トリガー作成', migration_020_llm_cache_invalidation),
+    (21, '全文検索インデックス作成', migration_021_fulltext_index),
+    (22, 'ベクトルインデックス管理テーブル作成', migration_022_vector_index),
+    (23, '検索用パッセージテーブル作成', migration_023_content_passages),
+    (24, '検索結果キャッシュ用バージョン作成', migration_024_content_version),
+    (25, '全体検索インデックス作成', migration_025_search_index),
+    (26, 'スラッグ変更時のバージョン更新', migration_026_slug_content_version),
+    (27, '外部ナレッジのセクション差分更新', migration_027_knowledge_section_hash),
+    (28, '応答キャッシュのコンテンツバージョン追加', migration_028_llm_cache_content_version),
+    (29, '検索インデックスのバージョン分離', migration_029_search_version),
+    (30, '動画の応答キャッシュ無効化トリガー作成', migration_030_llm_cache_video_invalidation),
+    (31, '文字起こしジョブの生存確認列追加', migration_031_transcription_job_heartbeat),
 ]
 
 
@@ -0,0 +1,212 @@
+"""
+Rakuten AI 3.0 API のモックサーバー（OpenAI互換 chat/completions）
+
+使用方法:
+    python mock_rakuten_ai.py --port 8900 --latency-ms 800 --latency-dist lognormal --error-rate 0.02
+    RAKUTEN_AI_BASE_URL=http://127.0.0.1:8900/v1/ RAKUTEN_AI_API_KEY=dummy python app.py
+
+機能:
+- POST .../chat/completions に対し、通常応答と stream: true（SSE）の両方を返す
+- 最初のトークンまでの待ち時間を分布（fixed / uniform / lognormal）から抽選
+- トークン生成速度（tokens/秒）と応答トークン数を指定でき、ストリーミングではその速度で1トークンずつ送る
+- 指定した割合で 429/503 などのエラーを返す（再試行・サーキットブレーカーの確認用）
+- 実APIのクォータやネットワークを使わずに /api/chat の負荷試験ができる（loadtest_chat.py と組み合わせる）
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Windows環境での日本語出力対応
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+# 応答に使う文章（トークン数に合わせて繰り返す）
+SAMPLE_ANSWER = (
+    "ご質問ありがとうございます。AIを業務に取り入れる際は、まず問い合わせ対応や予約管理など"
+    "繰り返しの多い作業から始めるのが効果的です。関連するトレーニング動画も参考にしてください。"
+)
+
+
+def sample_latency(config):
+    """設定した分布から最初のトークンまでの待ち秒数を抽選"""
+    mean = config.latency_ms / 1000
+    if config.latency_dist == 'uniform':
+        return random.uniform(0, mean * 2)
+    if config.latency_dist == 'lognormal':
+        # 平均が latency_ms になるよう mu を調整（sigma が大きいほど裾が重い）
+        sigma = config.latency_sigma
+        return random.lognormvariate(0, sigma) * mean / math.exp(sigma ** 2 / 2)
+    return mean
+
+
+def answer_tokens(count):
+    """応答トークン（1文字 = 1トークンとみなす）をcount個返す"""
+    text = SAMPLE_ANSWER * (count // len(SAMPLE_ANSWER) + 1)
+    return list(text[:count])
+
+
+class MockStats:
+    """受信件数を集計（/stats で確認できる）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.streams = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self, stream):
+        with self._lock:
+            self.requests += 1
+            self.streams += int(stream)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.errors += int(error)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'streams': self.streams,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight
+            }
+
+
+def make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-aliveを有効にする（接続プールの挙動を再現）
+
+        def log_message(self, format, *args):
+            if config.verbose:
+                super().log_message(format, *args)
+
+        def send_json(self, status, data, headers=None):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/stats'):
+                self.send_json(200, stats.snapshot())
+            else:
+                self.send_json(404, {'error': {'message': 'Not Found'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self.send_json(400, {'error': {'message': 'invalid JSON'}})
+                return
+            if not self.path.rstrip('/').endswith('chat/completions'):
+                self.send_json(404, {'error': {'message': 'Not Found'}})
+                return
+
+            stream = bool(payload.get('stream'))
+            stats.start(stream)
+            error = False
+            try:
+                time.sleep(sample_latency(config))
+                if random.random() < config.error_rate:
+                    error = True
+                    self.send_json(config.error_status, {'error': {'message': 'mock overloaded'}},
+                                   {'Retry-After': str(config.retry_after)} if config.retry_after else None)
+                    return
+                tokens = answer_tokens(min(config.response_tokens, payload.get('max_tokens') or config.response_tokens))
+                if stream:
+                    self.send_stream(payload, tokens)
+                else:
+                    time.sleep(len(tokens) / config.tokens_per_second)
+                    self.send_json(200, {
+                        'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                        'object': 'chat.completion',
+                        'model': payload.get('model', 'mock'),
+                        'choices': [{'index': 0, 'finish_reason': 'stop',
+                                     'message': {'role': 'assistant', 'content': ''.join(tokens)}}],
+                        'usage': {'completion_tokens': len(tokens)}
+                    })
+            except (BrokenPipeError, ConnectionResetError):
+                error = True  # クライアントが切断（制限時間切れなど）
+            finally:
+                stats.finish(error)
+
+        def send_stream(self, payload, tokens):
+            """SSEで1トークンずつ送る（チャンク転送）"""
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+            def write(data):
+                chunk = f"data: {data}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.flush()
+
+            interval = 1 / config.tokens_per_second
+            for token in tokens:
+                write(json.dumps({
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'model': payload.get('model', 'mock'),
+                    'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]
+                }, ensure_ascii=False))
+                time.sleep(interval)
+            write('[DONE]')
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rakuten AI 3.0 API（OpenAI互換）のモックサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=500, help='最初のトークンまでの平均待ち時間（ミリ秒）')
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'lognormal'], default='lognormal',
+                        help='待ち時間の分布（既定: lognormal）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='lognormal のばらつき（大きいほど裾が重い）')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='トークン生成速度')
+    parser.add_argument('--response-tokens', type=int, default=200, help='応答トークン数（max_tokensが小さければそちら）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラーを返す割合（0〜1）')
+    parser.add_argument('--error-status', type=int, default=503, help='エラー時のステータスコード')
+    parser.add_argument('--retry-after', type=int, default=0, help='エラー時に付けるRetry-After（秒、0なら付けない）')
+    parser.add_argument('--verbose', action='store_true', help='リクエストごとにログを出力')
+    args = parser.parse_args()
+
+    stats = MockStats()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args, stats))
+    server.daemon_threads = True
+    print(f"▶ モックサーバーを起動しました: http://{args.host}:{args.port}/v1/")
+    print(f"  待ち時間 {args.latency_dist} 平均{args.latency_ms:.0f}ms / {args.tokens_per_second:.0f} tokens/秒 / "
+          f"{args.response_tokens} tokens / エラー率 {args.error_rate:.0%}（{args.error_status}）")
+    print(f"  RAKUTEN_AI_BASE_URL=http://{args.host}:{args.port}/v1/ を設定してLMSを起動してください")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n⏹ 終了しました: {stats.snapshot()}")
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
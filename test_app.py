@@ -12,6 +12,9 @@ import pytest
 import sqlite3
 import os
 import sys
+import json
+import time
+import threading
 
 # Windows環境での日本語出力対応
 if sys.platform == 'win32':
@@ -3070,6 +3073,2496 @@ class TestAnnouncements:
         print("✓ 有効期限付き通知の作成・取得成功")
 
 
+
+# ========== 文字起こしセグメントテスト ==========
+
+class TestTranscriptSegments:
+    """タイムスタンプ付き文字起こしセグメントのテスト"""
+    
+    def _ensure_segments(self):
+        """テスト用の動画とセグメントを作成しIDを返す"""
+        from app import save_transcript_segments
+        db = get_db()
+        db.execute('''
+            INSERT OR IGNORE INTO videos (id, title, filename, category_id)
+            VALUES (991, 'セグメントテスト用動画', 'segment_test.mp4', 1)
+        ''')
+        save_transcript_segments(db, 991, [
+            {'start': 0.0, 'end': 5.0, 'text': 'はじめに'},
+            {'start': 5.0, 'end': 12.5, 'text': '予約対応の自動化'},
+            {'start': 12.5, 'end': 20.0, 'text': ' '},
+            {'start': 20.0, 'end': 31.0, 'text': 'まとめ'},
+        ])
+        db.commit()
+        db.close()
+        return 991
+    
+    def test_save_segments_skips_blank(self):
+        """空白のみのセグメントは保存されない"""
+        vid = self._ensure_segments()
+        db = get_db()
+        count = db.execute(
+            "SELECT COUNT(*) FROM video_transcripts WHERE video_id = ? AND content_type = 'segment'",
+            (vid,)
+        ).fetchone()[0]
+        db.close()
+        assert count == 3
+        print("✓ セグメントが個別行として保存される")
+    
+    def test_get_transcript_time_window(self, hotel_client):
+        """時間範囲を指定してセグメントを取得"""
+        vid = self._ensure_segments()
+        response = hotel_client.get(f'/api/videos/{vid}/transcript?start=6&end=21')
+        assert response.status_code == 200
+        data = response.get_json()
+        texts = [s['text'] for s in data['segments']]
+        assert texts == ['予約対応の自動化', 'まとめ']
+        assert data['segments'][0]['start'] == 5.0
+        print("✓ 時間範囲指定でセグメントを取得")
+    
+    def test_get_transcript_page(self, hotel_client):
+        """ページ指定でセグメントを取得"""
+        vid = self._ensure_segments()
+        response = hotel_client.get(f'/api/videos/{vid}/transcript?page=2&per_page=2')
+        data = response.get_json()
+        assert data['page'] == 2
+        assert [s['text'] for s in data['segments']] == ['まとめ']
+        assert data['has_more'] == False
+        print("✓ ページ指定でセグメントを取得")
+
+    def test_get_transcript_offset_limit(self, hotel_client):
+        """位置（offset/limit）指定でセグメントを順に取得し、続きの有無を返す"""
+        vid = self._ensure_segments()
+        first = hotel_client.get(f'/api/videos/{vid}/transcript?offset=0&limit=2').get_json()
+        assert [s['text'] for s in first['segments']] == ['はじめに', '予約対応の自動化']
+        assert first['has_more'] == True
+        rest = hotel_client.get(f'/api/videos/{vid}/transcript?offset=2&limit=2').get_json()
+        assert [s['text'] for s in rest['segments']] == ['まとめ']
+        assert rest['has_more'] == False
+        print("✓ 位置指定でセグメントを順に取得")
+
+    def test_get_transcript_default_includes_segment_count(self, hotel_client):
+        """パラメータなしの場合は従来の全文レスポンス + セグメント数"""
+        vid = self._ensure_segments()
+        data = hotel_client.get(f'/api/videos/{vid}/transcript').get_json()
+        assert 'transcript' in data
+        assert data['segment_count'] == 3
+        print("✓ 従来レスポンスにセグメント数が含まれる")
+    
+    def test_manual_transcript_update_clears_segments(self, admin_client):
+        """全文を手動更新すると古いセグメントは削除される"""
+        vid = self._ensure_segments()
+        response = admin_client.post(f'/api/admin/videos/{vid}/transcript', json={
+            'content': '手動で修正した文字起こし',
+            'content_type': 'transcript'
+        })
+        assert response.status_code == 200
+        data = admin_client.get(f'/api/videos/{vid}/transcript').get_json()
+        assert data['segment_count'] == 0
+        print("✓ 手動更新で古いセグメントが削除される")
+
+
+# ========== 並列文字起こし（無音区間分割）テスト ==========
+
+class TestParallelTranscription:
+    """無音区間分割とセグメント連結のテスト"""
+    
+    def _tone_with_gaps(self, np, pattern, sr=16000):
+        """(秒数, 有音/無音) のパターンからテスト用音声を生成"""
+        parts = []
+        for seconds, voiced in pattern:
+            n = int(seconds * sr)
+            if voiced:
+                parts.append(0.5 * np.sin(np.linspace(0, 440 * 2 * np.pi * seconds, n)).astype(np.float32))
+            else:
+                parts.append(np.zeros(n, dtype=np.float32))
+        return np.concatenate(parts)
+    
+    def test_split_at_silence(self):
+        """目標長を超えた後の無音区間で分割される"""
+        np = pytest.importorskip('numpy')
+        from app import find_silence_chunks
+        audio = self._tone_with_gaps(np, [(12, True), (1, False), (12, True), (1, False), (5, True)])
+        chunks = find_silence_chunks(audio, target_seconds=10, max_seconds=15)
+        assert len(chunks) == 3
+        # 1つ目の区切りは12〜13秒の無音区間内
+        assert 12 * 16000 <= chunks[0][1] <= 13 * 16000
+        # チャンクは連続して全体を覆う
+        assert chunks[0][0] == 0 and chunks[-1][1] == len(audio)
+        assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+        print("✓ 無音区間で音声が分割される")
+    
+    def test_force_split_without_silence(self):
+        """無音がない場合は最大長で強制分割される"""
+        np = pytest.importorskip('numpy')
+        from app import find_silence_chunks
+        audio = self._tone_with_gaps(np, [(25, True)])
+        chunks = find_silence_chunks(audio, target_seconds=5, max_seconds=10)
+        assert [end - start for start, end in chunks[:2]] == [10 * 16000, 10 * 16000]
+        print("✓ 無音がない場合は最大長で分割される")
+    
+    def test_stitch_segments_in_order(self):
+        """チャンクのセグメントが時刻順に連結される"""
+        from app import stitch_chunk_segments
+        result = stitch_chunk_segments([
+            [{'start': 60.0, 'end': 62.0, 'text': 'ふたつめ'}],
+            [{'start': 0.0, 'end': 2.0, 'text': 'ひとつめ'}],
+        ])
+        assert result['text'] == 'ひとつめふたつめ'
+        assert [s['start'] for s in result['segments']] == [0.0, 60.0]
+        print("✓ セグメントが時刻順に連結される")
+    
+    def test_whisper_reports_progress_per_chunk(self, monkeypatch):
+        """TRANSCRIBE_PROGRESS_CHUNKS 有効時はopenai-whisperでもチャンクごとに進捗が通知され、時刻がずらされる"""
+        np = pytest.importorskip('numpy')
+        import app as app_module
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_CHUNK_SECONDS', 10)
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_PROGRESS_CHUNKS', True)
+        
+        class FakeModel:
+            def transcribe(self, audio, **kwargs):
+                return {'text': 'テキスト', 'segments': [{'start': 0.0, 'end': 1.0, 'text': 'テキスト'}]}
+        
+        backend = object.__new__(app_module.WhisperBackend)
+        backend.model = FakeModel()
+        audio = self._tone_with_gaps(np, [(12, True), (1, False), (12, True), (1, False), (5, True)])
+        reported = []
+        result = backend.transcribe(audio, progress=reported.append)
+        assert len(reported) == len(result['segments']) > 1
+        assert reported == sorted(reported) and reported[-1] == 1.0
+        # 2つ目以降のセグメントはチャンクの開始時刻だけずれる
+        assert result['segments'][0]['start'] == 0.0
+        assert 12.0 <= result['segments'][1]['start'] <= 13.0
+        print("✓ openai-whisperでもチャンクごとに進捗が通知される")
+
+    def test_whisper_single_pass_by_default(self, monkeypatch):
+        """既定ではprogressを渡しても全体を1回で文字起こしし、完了時に通知する"""
+        np = pytest.importorskip('numpy')
+        import app as app_module
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_CHUNK_SECONDS', 10)
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_PROGRESS_CHUNKS', False)
+        calls = []
+        
+        class FakeModel:
+            def transcribe(self, audio, **kwargs):
+                calls.append(len(audio))
+                return {'text': 'テキスト', 'segments': [{'start': 0.0, 'end': 1.0, 'text': 'テキスト'}]}
+        
+        backend = object.__new__(app_module.WhisperBackend)
+        backend.model = FakeModel()
+        audio = self._tone_with_gaps(np, [(12, True), (1, False), (12, True), (1, False), (5, True)])
+        reported = []
+        backend.transcribe(audio, progress=reported.append)
+        assert calls == [len(audio)]
+        assert reported == [1.0]
+        print("✓ 既定ではopenai-whisperは1回で文字起こしされる")
+
+
+# ========== 文字起こしバックエンドテスト ==========
+
+class TestTranscriptionBackends:
+    """文字起こしバックエンド選択のテスト"""
+    
+    def test_unknown_backend_unavailable(self):
+        """未知のバックエンドは利用不可と判定される"""
+        from app import transcription_available, get_transcription_backend
+        assert transcription_available('no-such-backend') == False
+        with pytest.raises(ValueError):
+            get_transcription_backend('no-such-backend')
+        print("✓ 未知のバックエンドは拒否される")
+    
+    def test_backend_is_loaded_once(self, monkeypatch):
+        """同一設定のバックエンドはキャッシュされ再ロードされない"""
+        import app as app_module
+        loads = []
+        
+        class DummyBackend:
+            def __init__(self, model_size, threads):
+                loads.append((model_size, threads))
+        
+        monkeypatch.setitem(app_module.TRANSCRIPTION_BACKENDS, 'dummy', (DummyBackend, lambda: True))
+        monkeypatch.setattr(app_module, '_backend_cache', {})
+        first = app_module.get_transcription_backend('dummy', 'tiny', 2)
+        second = app_module.get_transcription_backend('dummy', 'tiny', 2)
+        assert first is second
+        assert loads == [('tiny', 2)]
+        assert app_module.transcription_available('dummy') == True
+        print("✓ バックエンドは1度だけロードされる")
+    
+    def test_idle_backend_is_unloaded(self, monkeypatch):
+        """一定時間使われなかったモデルは解放され、文字起こし中のモデルは解放されない"""
+        import app as app_module
+        loads = []
+        
+        class DummyBackend:
+            def __init__(self, model_size, threads):
+                loads.append(model_size)
+        
+        monkeypatch.setitem(app_module.TRANSCRIPTION_BACKENDS, 'dummy', (DummyBackend, lambda: True))
+        monkeypatch.setattr(app_module, '_backend_cache', {})
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_MODEL_IDLE_SECONDS', 600)
+        with app_module.use_transcription_backend('dummy', 'tiny', 1):
+            assert app_module.unload_idle_transcription_backends(time.monotonic() + 3600) == 0
+        assert app_module.unload_idle_transcription_backends(time.monotonic() + 60) == 0
+        assert app_module.unload_idle_transcription_backends(time.monotonic() + 601) == 1
+        app_module.get_transcription_backend('dummy', 'tiny', 1)
+        assert loads == ['tiny', 'tiny']
+        print("✓ アイドル状態のモデルは解放され、使用中は保持される")
+    
+    def test_start_transcription_requires_backend(self, admin_client, monkeypatch):
+        """バックエンドが未インストールの場合は400を返す"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_BACKEND', 'no-such-backend')
+        response = admin_client.post('/api/admin/videos/1/transcribe')
+        assert response.status_code == 400
+        assert 'no-such-backend' in response.get_json()['error']
+        print("✓ バックエンド未インストール時は文字起こしを開始しない")
+
+
+# ========== デコード済み音声キャッシュテスト ==========
+
+class TestAudioCache:
+    """デコード済み音声キャッシュ（.npy + mmap + LRU）のテスト"""
+    
+    @pytest.fixture
+    def audio_cache(self, tmp_path, monkeypatch):
+        """一時ディレクトリのキャッシュと、ffmpegデコードの呼び出し回数を記録する差し替え"""
+        np = pytest.importorskip('numpy')
+        import app as app_module
+        monkeypatch.setattr(app_module, 'AUDIO_CACHE_DIR', str(tmp_path / 'audio_cache'))
+        decodes = []
+        
+        def fake_decode(path, sample_rate=16000):
+            decodes.append(path)
+            return np.linspace(-1, 1, 16000, dtype=np.float32)
+        
+        monkeypatch.setattr(app_module, 'load_audio_pcm', fake_decode)
+        return app_module, tmp_path, decodes
+    
+    def test_second_call_skips_decode(self, audio_cache):
+        """同じ内容の動画は2回目以降デコードされない"""
+        app_module, tmp_path, decodes = audio_cache
+        video = tmp_path / 'a.mp4'
+        video.write_bytes(b'video-a')
+        first = app_module.ensure_cached_audio(str(video))
+        second = app_module.ensure_cached_audio(str(video))
+        assert first == second
+        assert len(decodes) == 1
+        audio = app_module.load_cached_audio(first)
+        assert len(audio) == 16000
+        assert audio.flags.writeable == False
+        print("✓ キャッシュ済み音声はデコードされずmmapで読み込まれる")
+    
+    def test_cache_keyed_by_content(self, audio_cache):
+        """ファイル名が違っても内容が同じならキャッシュを共有する"""
+        app_module, tmp_path, decodes = audio_cache
+        (tmp_path / 'a.mp4').write_bytes(b'same')
+        (tmp_path / 'b.mp4').write_bytes(b'same')
+        assert app_module.ensure_cached_audio(str(tmp_path / 'a.mp4')) == \
+            app_module.ensure_cached_audio(str(tmp_path / 'b.mp4'))
+        assert len(decodes) == 1
+        print("✓ キャッシュは内容ハッシュで識別される")
+    
+    def test_lru_eviction(self, audio_cache):
+        """容量上限を超えると最終利用が古いキャッシュから削除される"""
+        app_module, tmp_path, decodes = audio_cache
+        paths = []
+        for i, name in enumerate(['old', 'mid', 'new']):
+            video = tmp_path / f'{name}.mp4'
+            video.write_bytes(name.encode())
+            path = app_module.ensure_cached_audio(str(video))
+            os.utime(path, (1000 + i, 1000 + i))
+            paths.append(path)
+        size = os.path.getsize(paths[0])
+        removed = app_module.evict_audio_cache(max_bytes=size * 2)
+        assert removed == 1
+        assert not os.path.exists(paths[0])
+        assert os.path.exists(paths[1]) and os.path.exists(paths[2])
+        print("✓ 古いキャッシュからLRUで削除される")
+
+
+# ========== map-reduce 概要生成テスト ==========
+
+class TestMapReduceSummary:
+    """長い文字起こしの map-reduce 要約とチャンクキャッシュのテスト"""
+    
+    @pytest.fixture
+    def fake_llm(self, monkeypatch):
+        """要約APIの呼び出しを記録する差し替え"""
+        import app as app_module
+        calls = []
+        
+        def fake_request(system_prompt, user_content, max_tokens=500):
+            calls.append((system_prompt, user_content))
+            return f"要約{len(calls)}"
+        
+        monkeypatch.setattr(app_module, 'RAKUTEN_AI_API_KEY', 'test-key')
+        monkeypatch.setattr(app_module, 'SUMMARY_CHUNK_CHARS', 100)
+        monkeypatch.setattr(app_module, '_request_summary', fake_request)
+        return app_module, calls
+    
+    def _segments(self, n, prefix='説明'):
+        return [{'start': i * 10.0, 'end': i * 10.0 + 10, 'text': f'{prefix}{i:03d}番目のセグメントです。'}
+                for i in range(n)]
+    
+    def test_short_transcript_single_call(self, fake_llm):
+        """短い文字起こしは従来通り1回の呼び出しで要約する"""
+        app_module, calls = fake_llm
+        assert app_module.generate_video_summary('短い文字起こしです。') == '要約1'
+        assert len(calls) == 1
+        print("✓ 短い文字起こしは1回で要約される")
+    
+    def test_long_transcript_covers_whole_video(self, fake_llm):
+        """長い文字起こしは全チャンクを要約してから統合する"""
+        app_module, calls = fake_llm
+        segments = self._segments(30)
+        text = ''.join(s['text'] for s in segments)
+        app_module.generate_video_summary(text)
+        mapped = ''.join(c[1] for c in calls if c[0] == app_module.SUMMARY_MAP_PROMPT)
+        # 最後のセグメントまで要約対象に含まれる
+        assert '029番目' in mapped
+        assert calls[-1][0] == app_module.SUMMARY_SYSTEM_PROMPT
+        print("✓ 動画全体がmap-reduceで要約される")
+
+    def _run_map_reduce(self, app_module, text):
+        """部分要約が毎回40文字になるLLMで手順を実行し、(統合段数, 最終入力) を返す"""
+        steps = app_module.summary_map_reduce(text)
+        step = next(steps)
+        rounds = 0
+        while True:
+            kind, prompt, content = step
+            if kind == 'parts':
+                rounds += 1
+                result = [f"要約{rounds}-{i:03d}".ljust(40, 'あ') for i in range(len(content))]
+            else:
+                final = content
+                result = '概要'
+            try:
+                step = steps.send(result)
+            except StopIteration:
+                return rounds, final
+
+    def test_reduce_continues_until_summaries_fit(self, fake_llm, monkeypatch, capsys):
+        """部分要約が収まるまで段数を重ね、最終入力を切り詰めない"""
+        app_module, _ = fake_llm
+        monkeypatch.setattr(app_module, 'SUMMARY_MAX_ROUNDS', 10)
+        text = ''.join(s['text'] for s in self._segments(250))
+        rounds, final = self._run_map_reduce(app_module, text)
+        # 旧実装の上限（3段）を超える統合が必要な入力
+        assert rounds > 3
+        # 最終段の部分要約が欠けずに最終入力へ入る
+        assert f"要約{rounds}-000".ljust(40, 'あ') in final
+        assert '警告' not in capsys.readouterr().out
+        print("✓ 部分要約が収まるまで統合を繰り返す")
+
+    def test_round_cap_warns_before_truncating(self, fake_llm, monkeypatch, capsys):
+        """段数の上限に達した場合は警告を出してから切り詰める"""
+        app_module, _ = fake_llm
+        monkeypatch.setattr(app_module, 'SUMMARY_MAX_ROUNDS', 1)
+        text = ''.join(s['text'] for s in self._segments(250))
+        rounds, final = self._run_map_reduce(app_module, text)
+        assert rounds == 1
+        assert len(final.split('：\n\n', 1)[1]) == app_module.SUMMARY_CHUNK_CHARS
+        assert '警告' in capsys.readouterr().out
+        print("✓ 段数上限での切り詰めは警告される")
+    
+    def test_chunk_boundaries_stable_after_edit(self):
+        """一部を編集しても他のチャンクは変わらない"""
+        from app import chunk_transcript_for_summary
+        segments = self._segments(40)
+        before = chunk_transcript_for_summary(''.join(s['text'] for s in segments), max_chars=100)
+        segments[20]['text'] = '編集したセグメントです。'
+        after = chunk_transcript_for_summary(''.join(s['text'] for s in segments), max_chars=100)
+        unchanged = set(before) & set(after)
+        assert len(unchanged) >= len(before) - 2
+        assert all(len(c) <= 100 for c in after)
+        print("✓ 編集後も大半のチャンクが同一")
+    
+    def test_chunk_boundaries_stable_without_punctuation(self):
+        """句点のない文字起こしでも、編集箇所以外のチャンクは変わらない"""
+        from app import chunk_transcript_for_summary
+        words = [f'単語{i:03d}' for i in range(300)]
+        before = chunk_transcript_for_summary(''.join(words), max_chars=100)
+        words.insert(150, '挿入した語')
+        after = chunk_transcript_for_summary(''.join(words), max_chars=100)
+        unchanged = set(before) & set(after)
+        assert len(unchanged) >= len(before) - 3
+        assert all(len(c) <= 100 for c in after)
+        print("✓ 句点のない文字起こしも内容で区切られる")
+    
+    def test_partial_summaries_cached(self, fake_llm):
+        """再要約時はキャッシュ済みチャンクのAPI呼び出しを省略する"""
+        app_module, calls = fake_llm
+        segments = self._segments(30, prefix='キャッシュ')
+        text = ''.join(s['text'] for s in segments)
+        db = get_db()
+        app_module.generate_video_summary(text, db)
+        first_map_calls = sum(1 for c in calls if c[0] == app_module.SUMMARY_MAP_PROMPT)
+        calls.clear()
+        app_module.generate_video_summary(text, db)
+        db.close()
+        assert first_map_calls > 1
+        assert sum(1 for c in calls if c[0] == app_module.SUMMARY_MAP_PROMPT) == 0
+        print("✓ 部分要約がチャンクハッシュでキャッシュされる")
+    
+    def test_regenerate_endpoint(self, fake_llm, admin_client):
+        """概要再生成APIは保存済みの文字起こしから概要を作り直す"""
+        db = get_db()
+        db.execute('''
+            INSERT OR IGNORE INTO videos (id, title, filename, category_id)
+            VALUES (997, '概要APIテスト用動画', 'summary_api_test.mp4', 1)
+        ''')
+        db.execute("DELETE FROM video_transcripts WHERE video_id = 997")
+        db.commit()
+        response = admin_client.post('/api/admin/videos/997/summary')
+        assert response.status_code == 400
+        
+        db.execute("INSERT INTO video_transcripts (video_id, content, content_type) VALUES (997, '短い文字起こし。', 'transcript')")
+        db.commit()
+        response = admin_client.post('/api/admin/videos/997/summary')
+        assert response.status_code == 200
+        assert response.get_json()['summary'] == '要約1'
+        assert db.execute('SELECT summary FROM videos WHERE id = 997').fetchone()['summary'] == '要約1'
+        db.close()
+        print("✓ 概要再生成APIで概要を更新できる")
+
+
+# ========== リアルタイム通知（SSE）テスト ==========
+
+class TestEventHub:
+    """SSEイベントハブのテスト"""
+    
+    def test_local_publish_delivered(self):
+        """同一プロセスの購読者へ即時配信される"""
+        from app import EventHub
+        hub = EventHub(poll_seconds=0.05)
+        q = hub.subscribe(['test-local'])
+        try:
+            event_id = hub.publish('test-local', 'status', {'video_id': 1, 'progress': 50})
+            message = q.get(timeout=2)
+            assert message['id'] == event_id
+            assert json.loads(message['data'])['progress'] == 50
+            # 追跡スレッドからの二重配信がない
+            time.sleep(0.3)
+            assert q.empty()
+        finally:
+            hub.unsubscribe(q)
+        print("✓ 同一プロセスへ即時配信（二重配信なし）")
+    
+    def test_cross_worker_delivery(self):
+        """他ワーカーがevent_feedに書いたイベントも配信される"""
+        from app import EventHub
+        hub = EventHub(poll_seconds=0.05)
+        q = hub.subscribe(['test-remote'])
+        try:
+            time.sleep(0.2)  # 追跡スレッドの開始を待つ
+            db = get_db()
+            db.execute("INSERT INTO event_feed (channel, event, data) VALUES ('test-remote', 'status', '{\"x\": 1}')")
+            db.commit()
+            db.close()
+            message = q.get(timeout=2)
+            assert message['event'] == 'status'
+            assert json.loads(message['data']) == {'x': 1}
+        finally:
+            hub.unsubscribe(q)
+        print("✓ 他ワーカーのイベントがevent_feed経由で配信される")
+    
+    def test_replay_after_last_event_id(self):
+        """Last-Event-ID以降のイベントを再送できる"""
+        from app import EventHub
+        hub = EventHub()
+        first = hub.publish('test-replay', 'status', {'n': 1})
+        hub.publish('test-replay', 'status', {'n': 2})
+        hub.publish('other', 'status', {'n': 3})
+        replayed = hub.replay(['test-replay'], first)
+        assert [json.loads(m['data'])['n'] for m in replayed] == [2]
+        print("✓ 取りこぼしたイベントを再送できる")
+    
+    def test_format_sse(self):
+        """SSE書式に変換される"""
+        from app import format_sse
+        text = format_sse({'id': 5, 'event': 'status', 'data': '{"a": 1}'})
+        assert text == 'id: 5\nevent: status\ndata: {"a": 1}\n\n'
+        print("✓ SSE書式に変換される")
+    
+    def test_event_stream_requires_admin(self, client):
+        """一般ユーザーは管理者イベントストリームに接続できない"""
+        client.post('/login', json={'username': 'ryokan_suzuki', 'password': 'user123'})
+        response = client.get('/api/admin/events')
+        assert response.status_code in [302, 403]
+        print("✓ 一般ユーザーは管理者イベントストリームに接続不可")
+    
+    def test_event_stream_rejects_unknown_channel(self, admin_client):
+        """未定義チャンネルの購読は400"""
+        response = admin_client.get('/api/admin/events?channels=secret')
+        assert response.status_code == 400
+        print("✓ 未定義チャンネルは購読できない")
+    
+    def test_event_stream_closes_after_max_seconds(self, admin_client, monkeypatch):
+        """SSE接続は上限秒数で閉じられワーカーを占有し続けない"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'SSE_MAX_STREAM_SECONDS', 0.3)
+        started = time.monotonic()
+        response = admin_client.get('/api/admin/events')
+        body = response.get_data(as_text=True)
+        assert response.status_code == 200
+        assert body.startswith('retry: 3000')
+        assert time.monotonic() - started < 5
+        print("✓ SSE接続は上限秒数で閉じられる")
+
+
+# ========== 文字起こしジョブスケジューラテスト ==========
+
+class TestTranscriptionScheduler:
+    """一括文字起こしキュー（優先度・同時実行数上限・一時停止）のテスト"""
+    
+    @pytest.fixture
+    def scheduler(self, monkeypatch):
+        """空のキューとテスト用動画、スケジューラを用意"""
+        import app as app_module
+        db = get_db()
+        db.execute('DELETE FROM transcription_jobs')
+        db.execute("DELETE FROM app_settings WHERE key = 'transcription_paused'")
+        for vid in range(992, 997):
+            db.execute('''
+                INSERT OR IGNORE INTO videos (id, title, filename, category_id)
+                VALUES (?, ?, 'queue_test.mp4', 1)
+            ''', (vid, f'キューテスト動画{vid}'))
+        db.commit()
+        db.close()
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_MAX_CONCURRENT', 2)
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_MAX_PER_TENANT', 1)
+        monkeypatch.setattr(app_module, 'TRANSCRIBE_ALLOWED_HOURS', '')
+        # APIから起動される常駐ディスパッチャはテスト中は動かさない
+        monkeypatch.setattr(app_module.transcription_scheduler, 'start', lambda: None)
+        return app_module.TranscriptionScheduler()
+    
+    def _add_job(self, video_id, tenant_id, priority):
+        db = get_db()
+        db.execute('''
+            INSERT INTO transcription_jobs (video_id, tenant_id, priority, status)
+            VALUES (?, ?, ?, 'queued')
+        ''', (video_id, tenant_id, priority))
+        db.commit()
+        db.close()
+    
+    def test_allowed_hours(self):
+        """日をまたぐ時間帯指定を判定できる"""
+        from app import is_within_allowed_hours
+        assert is_within_allowed_hours(23, '22-6') == True
+        assert is_within_allowed_hours(3, '22-6') == True
+        assert is_within_allowed_hours(12, '22-6') == False
+        assert is_within_allowed_hours(12, '9-18') == True
+        assert is_within_allowed_hours(12, '') == True
+        print("✓ 実行可能な時間帯を判定できる")
+    
+    def test_enqueue_is_idempotent(self, scheduler):
+        """同じ動画は二重に登録されない"""
+        from app import enqueue_transcription
+        db = get_db()
+        assert enqueue_transcription(db, 992) == True
+        assert enqueue_transcription(db, 992) == False
+        status = db.execute('SELECT transcription_status FROM videos WHERE id = 992').fetchone()[0]
+        db.close()
+        assert status == 'pending'
+        print("✓ 登録済みの動画は再登録されない")
+    
+    def test_new_uploads_before_backfill(self, scheduler):
+        """新規アップロードは先に登録された一括処理より優先される"""
+        from app import TRANSCRIBE_PRIORITY_HIGH, TRANSCRIBE_PRIORITY_BACKFILL
+        self._add_job(992, 1, TRANSCRIBE_PRIORITY_BACKFILL)
+        self._add_job(993, 2, TRANSCRIBE_PRIORITY_HIGH)
+        job = scheduler.claim_next_job()
+        assert job['video_id'] == 993
+        print("✓ 新規アップロードが優先される")
+    
+    def test_concurrency_caps(self, scheduler):
+        """全体・テナントごとの同時実行数上限が守られる"""
+        self._add_job(992, 1, 10)
+        self._add_job(993, 1, 10)
+        self._add_job(994, 2, 10)
+        self._add_job(995, 3, 10)
+        first = scheduler.claim_next_job()
+        second = scheduler.claim_next_job()
+        # テナント1の2件目はスキップされ、テナント2のジョブが実行される
+        assert (first['video_id'], second['video_id']) == (992, 994)
+        # 全体の上限（2件）に達したため取得されない
+        assert scheduler.claim_next_job() is None
+        print("✓ 同時実行数の上限が守られる")
+    
+    def test_pause_and_resume(self, scheduler, admin_client):
+        """一時停止中はジョブが実行されず、再開後に実行される"""
+        self._add_job(992, 1, 10)
+        assert admin_client.post('/api/admin/transcription-queue/pause').status_code == 200
+        assert scheduler.claim_next_job() is None
+        status = admin_client.get('/api/admin/transcription-queue').get_json()
+        assert status['paused'] == True and status['queued'] == 1
+        assert admin_client.post('/api/admin/transcription-queue/resume').status_code == 200
+        assert scheduler.claim_next_job()['video_id'] == 992
+        print("✓ 一時停止・再開できる")
+
+    def _add_running_job(self, video_id, heartbeat_offset):
+        db = get_db()
+        db.execute('''
+            INSERT INTO transcription_jobs (video_id, tenant_id, priority, status, started_at, heartbeat_at)
+            VALUES (?, 1, 10, 'running', datetime('now', '-1 hour'), datetime('now', ?))
+        ''', (video_id, heartbeat_offset))
+        db.commit()
+        db.close()
+
+    def test_orphaned_running_job_is_requeued(self, scheduler):
+        """生存確認が途絶えた実行中ジョブは、タイムアウトを待たずに再実行される"""
+        self._add_running_job(992, '-10 minutes')
+        job = scheduler.claim_next_job()
+        assert job['video_id'] == 992
+        print("✓ 再起動で残った実行中ジョブが再実行される")
+
+    def test_live_running_job_is_kept(self, scheduler):
+        """生存確認が続いている実行中ジョブはそのまま"""
+        self._add_running_job(992, '-10 seconds')
+        self._add_job(993, 1, 10)
+        # テナント1は実行中のため、待機中のジョブは取得されない
+        assert scheduler.claim_next_job() is None
+        db = get_db()
+        status = db.execute('SELECT status FROM transcription_jobs WHERE video_id = 992').fetchone()[0]
+        db.close()
+        assert status == 'running'
+        print("✓ 実行中のジョブは再登録されない")
+
+    def test_run_job_failure_finishes_job(self, scheduler, monkeypatch):
+        """文字起こし中の例外でもジョブは失敗で終了し、ディスパッチャが起こされる"""
+        import app as app_module
+
+        def boom(video_id, video_path):
+            raise RuntimeError('decoder crashed')
+
+        monkeypatch.setattr(app_module, 'transcribe_video_async', boom)
+        monkeypatch.setattr(app_module.os.path, 'exists', lambda path: True)
+        self._add_job(992, 1, 10)
+        job = scheduler.claim_next_job()
+        scheduler.run_job(job)
+        db = get_db()
+        row = db.execute('SELECT status, error FROM transcription_jobs WHERE id = ?', (job['id'],)).fetchone()
+        db.close()
+        assert (row['status'], row['error']) == ('failed', 'decoder crashed')
+        assert scheduler._wake.is_set()
+        print("✓ 例外が起きてもジョブは失敗で終了する")
+
+    def test_eta_from_history(self, scheduler):
+        """完了ジョブの平均処理時間からETAを推定する"""
+        from app import get_transcription_queue_status
+        db = get_db()
+        db.execute('''
+            INSERT INTO transcription_jobs (video_id, priority, status, duration_seconds, finished_at)
+            VALUES (992, 10, 'done', 100, CURRENT_TIMESTAMP)
+        ''')
+        db.commit()
+        self._add_job(993, 1, 10)
+        self._add_job(994, 2, 10)
+        self._add_job(995, 3, 10)
+        status = get_transcription_queue_status(db)
+        db.close()
+        # 3件を2並列で処理 → 2巡 × 100秒
+        assert status['queued'] == 3
+        assert status['eta_seconds'] == 200
+        print("✓ キューの深さとETAを取得できる")
+    
+    def test_company_admin_cannot_backfill(self, hotel_client):
+        """一括登録はsuper_adminのみ"""
+        response = hotel_client.post('/api/admin/transcription-queue/backfill')
+        assert response.status_code == 403
+        print("✓ company_adminは一括登録できない")
+    
+    def test_dispatcher_starts_on_first_request(self, client, monkeypatch):
+        """WSGIサーバーでも最初のリクエストでディスパッチャを1回だけ起動し、アップロード時の自動登録は既定で無効"""
+        import app as app_module
+        started = []
+        monkeypatch.setattr(app_module, '_dispatcher_started', False)
+        monkeypatch.setattr(app_module, 'transcription_available', lambda backend_name=None: True)
+        monkeypatch.setattr(app_module.transcription_scheduler, 'start', lambda: started.append(1))
+        client.get('/login')
+        client.get('/login')
+        assert started == [1]
+        assert app_module.TRANSCRIBE_ON_UPLOAD is False
+        print("✓ 最初のリクエストでディスパッチャを起動")
+
+# ========== Rakuten AI HTTPクライアントテスト ==========
+
+class TestLLMClientPool:
+    """Rakuten AI呼び出しの共有HTTPクライアントと所要時間計測のテスト"""
+    
+    @pytest.fixture
+    def mock_llm(self, monkeypatch):
+        """モックトランスポートの共有クライアントと空の計測を用意"""
+        import httpx
+        import app as app_module
+        calls = []
+        
+        def handler(request):
+            calls.append(json.loads(request.content))
+            return httpx.Response(200, json={'choices': [{'message': {'content': 'モック回答'}}]})
+        
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(app_module, '_llm_client', client)
+        monkeypatch.setattr(app_module, '_llm_client_pid', os.getpid())
+        monkeypatch.setattr(app_module, 'llm_metrics', app_module.LLMMetrics())
+        yield calls
+        client.close()
+    
+    def test_client_is_shared(self, monkeypatch):
+        """同一プロセスでは同じクライアントを使い回す"""
+        import app as app_module
+        monkeypatch.setattr(app_module, '_llm_client', None)
+        first = app_module.get_llm_client()
+        assert app_module.get_llm_client() is first
+        app_module.close_llm_client()
+        assert app_module._llm_client is None
+        assert first.is_closed
+        print("✓ 共有クライアントを再利用し、終了時に閉じる")
+    
+    def test_client_recreated_after_fork(self, monkeypatch):
+        """fork後の子プロセスでは新しいクライアントを作る"""
+        import app as app_module
+        monkeypatch.setattr(app_module, '_llm_client', None)
+        first = app_module.get_llm_client()
+        monkeypatch.setattr(app_module, '_llm_client_pid', -1)
+        second = app_module.get_llm_client()
+        assert second is not first
+        first.close()
+        app_module.close_llm_client()
+        print("✓ 別プロセスでは作り直す")
+    
+    def test_calls_use_pool_and_record_metrics(self, mock_llm):
+        """チャットと概要生成が共有クライアント経由で呼ばれ、所要時間が記録される"""
+        import app as app_module
+        result = app_module.call_rakuten_ai('質問', context='参考情報')
+        assert result == {'success': True, 'response': 'モック回答'}
+        assert app_module._request_summary('要約して', '本文') == 'モック回答'
+        assert len(mock_llm) == 2
+        
+        metrics = app_module.llm_metrics.summary()
+        assert metrics['chat']['count'] == 1
+        assert metrics['summary']['count'] == 1
+        assert metrics['chat']['errors'] == 0
+        assert metrics['chat']['total_ms']['p50'] is not None
+        print("✓ 共有クライアント経由で呼び出し、所要時間を記録")
+    
+    def test_metrics_endpoint_admin_only(self, admin_client, client):
+        """計測値は管理者のみ取得できる"""
+        response = admin_client.get('/api/admin/llm-metrics')
+        assert response.status_code == 200
+        assert 'metrics' in response.get_json()
+        admin_client.get('/logout')
+        client.post('/login', json={'username': 'ryokan_suzuki', 'password': 'user123'})
+        response = client.get('/api/admin/llm-metrics')
+        assert response.status_code in [302, 403]
+        print("✓ LLM計測値は管理者のみ取得可能")
+
+# ========== ストリーミングチャットテスト ==========
+
+class TestChatStreaming:
+    """チャット回答のSSEストリーミングのテスト"""
+    
+    @staticmethod
+    def _parse_sse(body):
+        events = []
+        for block in body.strip().split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.split('\n'))
+            events.append((lines['event'], json.loads(lines['data'])))
+        return events
+    
+    @pytest.fixture
+    def mock_stream(self, monkeypatch):
+        """OpenAI互換のストリーミング応答を返す共有クライアントを用意"""
+        import httpx
+        import app as app_module
+        state = {'status': 200, 'requests': []}
+        
+        def handler(request):
+            state['requests'].append(json.loads(request.content))
+            if state['status'] != 200:
+                return httpx.Response(state['status'], text='overloaded')
+            chunks = ['こん', 'にちは', '！']
+            body = ''.join(
+                'data: ' + json.dumps({'choices': [{'delta': {'content': c}}]}) + '\n\n' for c in chunks
+            ) + 'data: [DONE]\n\n'
+            return httpx.Response(200, text=body, headers={'Content-Type': 'text/event-stream'})
+        
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(app_module, '_llm_client', client)
+        monkeypatch.setattr(app_module, '_llm_client_pid', os.getpid())
+        monkeypatch.setattr(app_module, 'llm_metrics', app_module.LLMMetrics())
+        monkeypatch.setattr(app_module, 'LLM_CACHE_ENABLED', False)
+        monkeypatch.setattr(app_module, 'llm_circuit_breaker', app_module.CircuitBreaker(5, 30))
+        yield state
+        client.close()
+    
+    def test_stream_relays_tokens_and_saves_history(self, hotel_client, mock_stream):
+        """推薦動画→トークン→完了の順に届き、完了時に履歴が保存される"""
+        import app as app_module
+        db = get_db()
+        before = db.execute('SELECT COUNT(*) FROM chat_history').fetchone()[0]
+        db.close()
+        
+        response = hotel_client.post('/api/chat/stream', json={'message': '接客でのAI活用'})
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        events = self._parse_sse(response.get_data(as_text=True))
+        
+        assert events[0][0] == 'videos'
+        assert [data['text'] for event, data in events if event == 'token'] == ['こん', 'にちは', '！']
+        assert events[-1] == ('done', {'response': 'こんにちは！', 'cached': False, 'fallback': False})
+        assert mock_stream['requests'][0]['stream'] is True
+        
+        db = get_db()
+        row = db.execute('SELECT message, response FROM chat_history ORDER BY id DESC LIMIT 1').fetchone()
+        after = db.execute('SELECT COUNT(*) FROM chat_history').fetchone()[0]
+        db.close()
+        assert after == before + 1
+        assert row['response'] == 'こんにちは！'
+        
+        metrics = app_module.llm_metrics.summary()
+        assert metrics['chat_stream']['ttft_ms']['p50'] is not None
+        print("✓ ストリーミングで回答を中継し、完了時に履歴を保存（TTFT記録）")
+    
+    def test_stream_error_not_saved(self, hotel_client, mock_stream):
+        """再試行しないAPIエラー時はerrorイベントを送り、履歴は保存しない"""
+        mock_stream['status'] = 400
+        db = get_db()
+        before = db.execute('SELECT COUNT(*) FROM chat_history').fetchone()[0]
+        db.close()
+        
+        response = hotel_client.post('/api/chat/stream', json={'message': '接客でのAI活用'})
+        events = self._parse_sse(response.get_data(as_text=True))
+        assert events[0][0] == 'videos'
+        assert events[-1][0] == 'error'
+        assert '400' in events[-1][1]['error']
+        
+        db = get_db()
+        after = db.execute('SELECT COUNT(*) FROM chat_history').fetchone()[0]
+        db.close()
+        assert after == before
+        print("✓ APIエラー時はerrorイベント（履歴は保存しない）")
+    
+    def test_stream_rejects_empty_message(self, hotel_client):
+        """空メッセージは400"""
+        response = hotel_client.post('/api/chat/stream', json={'message': '  '})
+        assert response.status_code == 400
+        print("✓ 空メッセージは拒否")
+    
+    def test_stream_requires_login(self, client):
+        """未ログインでは利用できない"""
+        response = client.post('/api/chat/stream', json={'message': 'テスト'})
+        assert response.status_code in [302, 401]
+        print("✓ 未ログインではストリーミング不可")
+
+# ========== 非同期（ASGI）チャット・概要生成テスト ==========
+
+class TestAsyncChatServer:
+    """asgi_app（httpx.AsyncClientでLLMを呼ぶ非同期サーバー）のテスト"""
+    
+    @staticmethod
+    def _llm_handler(request):
+        import httpx
+        payload = json.loads(request.content)
+        if payload.get('stream'):
+            body = ''.join(
+                'data: ' + json.dumps({'choices': [{'delta': {'content': c}}]}) + '\n\n' for c in ['非同期', '回答']
+            ) + 'data: [DONE]\n\n'
+            return httpx.Response(200, text=body, headers={'Content-Type': 'text/event-stream'})
+        return httpx.Response(200, json={'choices': [{'message': {'content': '非同期回答'}}]})
+    
+    @pytest.fixture
+    def session_cookie(self, client):
+        """Flask側でログインしたセッションCookieを返す"""
+        def login(username, password):
+            client.post('/login', json={'username': username, 'password': password})
+            return client.get_cookie('session').value
+        return login
+    
+    def _request(self, monkeypatch, method, path, cookie=None, **kwargs):
+        """ASGIアプリへリクエストを送る（LLMはモック）"""
+        import asyncio
+        import httpx
+        import asgi_app
+        
+        import app as app_module
+        monkeypatch.setattr(app_module, 'LLM_CACHE_ENABLED', False)
+        
+        async def run():
+            llm = httpx.AsyncClient(transport=httpx.MockTransport(self._llm_handler))
+            monkeypatch.setattr(asgi_app, 'get_async_llm_client', lambda: llm)
+            cookies = {'session': cookie} if cookie else None
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app.application),
+                                         base_url='http://testserver', cookies=cookies) as http:
+                response = await http.request(method, path, **kwargs)
+            await llm.aclose()
+            return response
+        
+        return asyncio.run(run())
+    
+    def test_chat(self, monkeypatch, session_cookie):
+        """非同期チャットがFlask版と同じ形式で回答し、履歴を保存する"""
+        cookie = session_cookie('hotel_tanaka', 'user123')
+        response = self._request(monkeypatch, 'POST', '/api/chat', cookie, json={'message': '接客でのAI活用'})
+        assert response.status_code == 200
+        data = response.json()
+        assert data['success'] is True
+        assert data['response'] == '非同期回答'
+        assert 'recommended_videos' in data
+        
+        db = get_db()
+        row = db.execute('SELECT response FROM chat_history ORDER BY id DESC LIMIT 1').fetchone()
+        db.close()
+        assert row['response'] == '非同期回答'
+        print("✓ 非同期チャットで回答し、履歴を保存")
+    
+    def test_chat_stream(self, monkeypatch, session_cookie):
+        """非同期ストリーミングで推薦動画→トークン→完了の順に届く"""
+        cookie = session_cookie('hotel_tanaka', 'user123')
+        response = self._request(monkeypatch, 'POST', '/api/chat/stream', cookie, json={'message': '接客でのAI活用'})
+        assert response.status_code == 200
+        events = TestChatStreaming._parse_sse(response.text)
+        assert events[0][0] == 'videos'
+        assert [data['text'] for event, data in events if event == 'token'] == ['非同期', '回答']
+        assert events[-1] == ('done', {'response': '非同期回答', 'cached': False, 'fallback': False})
+        print("✓ 非同期ストリーミングでトークンを中継")
+    
+    def test_requires_login(self, monkeypatch):
+        """Cookieなし・改ざんされたCookieはログイン画面へリダイレクト"""
+        response = self._request(monkeypatch, 'POST', '/api/chat', json={'message': 'テスト'})
+        assert response.status_code == 302
+        response = self._request(monkeypatch, 'POST', '/api/chat', 'forged.cookie.value', json={'message': 'テスト'})
+        assert response.status_code == 302
+        print("✓ 未ログイン・不正なセッションは拒否")
+    
+    def test_empty_message(self, monkeypatch, session_cookie):
+        """空メッセージは400"""
+        cookie = session_cookie('hotel_tanaka', 'user123')
+        response = self._request(monkeypatch, 'POST', '/api/chat', cookie, json={'message': ''})
+        assert response.status_code == 400
+        print("✓ 空メッセージは拒否")
+    
+    def test_summary_admin_only(self, monkeypatch, session_cookie):
+        """概要再生成は管理者のみ"""
+        cookie = session_cookie('ryokan_suzuki', 'user123')
+        response = self._request(monkeypatch, 'POST', '/api/admin/videos/1/summary', cookie)
+        assert response.status_code == 403
+        print("✓ 一般ユーザーは概要を再生成できない")
+    
+    def test_summary_regenerated(self, monkeypatch, session_cookie):
+        """管理者は保存済みの文字起こしから概要を再生成できる"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'RAKUTEN_AI_API_KEY', 'test-key')
+        video_id = 998
+        db = get_db()
+        db.execute('''
+            INSERT OR IGNORE INTO videos (id, title, filename, category_id)
+            VALUES (998, '概要再生成テスト用動画', 'summary_test.mp4', 1)
+        ''')
+        db.execute("DELETE FROM video_transcripts WHERE video_id = ? AND content_type = 'transcript'", (video_id,))
+        db.execute("INSERT INTO video_transcripts (video_id, content, content_type) VALUES (?, ?, 'transcript')",
+                   (video_id, '生成AIの業務活用について説明します。'))
+        db.commit()
+        db.close()
+        
+        cookie = session_cookie('admin', 'admin123')
+        response = self._request(monkeypatch, 'POST', f'/api/admin/videos/{video_id}/summary', cookie)
+        assert response.status_code == 200
+        assert response.json()['summary'] == '非同期回答'
+        
+        db = get_db()
+        summary = db.execute('SELECT summary FROM videos WHERE id = ?', (video_id,)).fetchone()['summary']
+        db.execute("DELETE FROM video_transcripts WHERE video_id = ? AND content_type = 'transcript'", (video_id,))
+        db.commit()
+        db.close()
+        assert summary == '非同期回答'
+        print("✓ 管理者は非同期で概要を再生成できる")
+    
+    def test_unknown_path(self, monkeypatch):
+        """対象外のパスはFlaskへ委譲（asgiref未導入なら404）"""
+        import asgi_app
+        response = self._request(monkeypatch, 'GET', '/api/unknown')
+        assert response.status_code == 404
+        if asgi_app.flask_application is None:
+            assert response.json() == {'error': 'Not Found'}
+        print("✓ 対象外のパスは処理しない")
+
+# ========== LLM応答キャッシュテスト ==========
+
+class TestLLMResponseCache:
+    """LLM応答キャッシュ（キー・TTL・LRU・ヒット率）のテスト"""
+    
+    @pytest.fixture
+    def llm_cache(self, monkeypatch):
+        """空のキャッシュと呼び出し回数を記録するLLMを用意"""
+        import app as app_module
+        db = get_db()
+        db.execute('DELETE FROM llm_response_cache')
+        db.execute('DELETE FROM cache_stats')
+        db.commit()
+        db.close()
+        calls = []
+        
+        def fake_call(prompt, context="", available_videos=None, deadline=None):
+            calls.append(prompt)
+            return {'success': True, 'response': f'回答{len(calls)}'}
+        
+        monkeypatch.setattr(app_module, 'LLM_CACHE_ENABLED', True)
+        monkeypatch.setattr(app_module, 'call_rakuten_ai', fake_call)
+        return app_module, calls
+    
+    def _payload(self):
+        return {'model': 'rakutenai-3.0', 'temperature': 0.7}
+    
+    def test_normalize_question(self):
+        """全角半角・空白・末尾の記号の違いは同じ質問として扱う"""
+        from app import normalize_question
+        assert normalize_question('ＡＩ の 使い方？') == normalize_question('ai の使い方')
+        print("✓ 質問の表記ゆれを正規化")
+    
+    def test_key_depends_on_context(self):
+        """参考情報の内容・業種・temperatureが変わるとキーが変わる"""
+        from app import llm_cache_key
+        base = llm_cache_key('質問', 1, ['knowledge:1'], '内容A', self._payload())
+        assert base == llm_cache_key('質問 ', 1, ['knowledge:1'], '内容A', self._payload())
+        assert base != llm_cache_key('質問', 1, ['knowledge:1'], '内容B', self._payload())
+        assert base != llm_cache_key('質問', 2, ['knowledge:1'], '内容A', self._payload())
+        assert base != llm_cache_key('質問', 1, ['knowledge:1'], '内容A', {'model': 'rakutenai-3.0', 'temperature': 0.2})
+        print("✓ 参考情報の更新でキーが変わる（自動無効化）")
+    
+    def test_repeated_question_served_from_cache(self, llm_cache, hotel_client):
+        """同じ質問の2回目はAPIを呼ばずキャッシュから回答する"""
+        app_module, calls = llm_cache
+        first = hotel_client.post('/api/chat', json={'message': '予約対応でAIを使うには？'}).get_json()
+        second = hotel_client.post('/api/chat', json={'message': '予約対応でAIを使うには'}).get_json()
+        assert first['cached'] is False
+        assert second['cached'] is True
+        assert second['response'] == first['response']
+        assert len(calls) == 1
+        
+        response = hotel_client.get('/api/admin/llm-cache')
+        stats = response.get_json()['cache']
+        assert stats['entries'] == 1
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_rate'] == 0.5
+        print("✓ 同じ質問はキャッシュから回答（ヒット率を集計）")
+    
+    def test_ttl_expired(self, llm_cache, monkeypatch):
+        """期限切れのエントリは使わない"""
+        app_module, _ = llm_cache
+        db = get_db()
+        app_module.store_llm_response(db, 'k-ttl', 1, '質問', '回答', [])
+        monkeypatch.setattr(app_module, 'LLM_CACHE_TTL_SECONDS', -1)
+        assert app_module.get_cached_llm_response(db, 'k-ttl') is None
+        assert db.execute("SELECT COUNT(*) FROM llm_response_cache WHERE cache_key = 'k-ttl'").fetchone()[0] == 0
+        db.close()
+        print("✓ TTLを過ぎたキャッシュは削除される")
+    
+    def test_lru_eviction(self, llm_cache, monkeypatch):
+        """上限を超えると最終利用が古いものから削除される"""
+        app_module, _ = llm_cache
+        monkeypatch.setattr(app_module, 'LLM_CACHE_MAX_ENTRIES', 2)
+        db = get_db()
+        app_module.store_llm_response(db, 'k1', 1, '質問1', '回答1', [])
+        time.sleep(0.01)
+        app_module.store_llm_response(db, 'k2', 1, '質問2', '回答2', [])
+        time.sleep(0.01)
+        assert app_module.get_cached_llm_response(db, 'k1') == '回答1'  # k1を最近利用に
+        app_module.store_llm_response(db, 'k3', 1, '質問3', '回答3', [])
+        keys = {r[0] for r in db.execute('SELECT cache_key FROM llm_response_cache').fetchall()}
+        db.close()
+        assert keys == {'k1', 'k3'}
+        print("✓ LRUで上限件数に収まる")
+    
+    def test_clear_cache_admin_only(self, llm_cache, client):
+        """キャッシュの削除は管理者のみ"""
+        client.post('/login', json={'username': 'ryokan_suzuki', 'password': 'user123'})
+        assert client.delete('/api/admin/llm-cache').status_code in [302, 403]
+        client.get('/logout')
+        client.post('/login', json={'username': 'admin', 'password': 'admin123'})
+        assert client.delete('/api/admin/llm-cache').get_json()['success'] is True
+        print("✓ 管理者のみキャッシュを削除可能")
+
+# ========== 類似質問キャッシュテスト ==========
+
+class TestSemanticCache:
+    """言い換えた質問に過去の回答を返す類似質問キャッシュのテスト"""
+    
+    SEED_QUESTIONS = [
+        '客室清掃の効率化にAIは使える？',
+        '口コミへの返信をAIで作成したい',
+        '多言語での問い合わせ対応を自動化するには',
+        '売上データを分析するには？',
+    ]
+    
+    @pytest.fixture
+    def semantic(self, monkeypatch):
+        """同じ業種の回答済み質問をいくつか登録し、LLM呼び出しを記録する"""
+        import app as app_module
+        db = get_db()
+        db.execute('DELETE FROM llm_response_cache')
+        db.execute('DELETE FROM cache_stats')
+        db.commit()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        for i, question in enumerate(self.SEED_QUESTIONS):
+            app_module.store_llm_response(db, f'seed-{i}', industry_id, question, f'既存の回答{i}', [])
+        db.close()
+        calls = []
+        
+        def fake_call(prompt, context="", available_videos=None, deadline=None):
+            calls.append(prompt)
+            return {'success': True, 'response': f'回答{len(calls)}'}
+        
+        monkeypatch.setattr(app_module, 'LLM_CACHE_ENABLED', True)
+        monkeypatch.setattr(app_module, 'SEMANTIC_CACHE_ENABLED', True)
+        monkeypatch.setattr(app_module, 'SEMANTIC_CACHE_THRESHOLD', None)
+        monkeypatch.setattr(app_module, 'call_rakuten_ai', fake_call)
+        app_module.semantic_cache.clear()
+        return app_module, calls
+    
+    def test_paraphrase_served_from_cache(self, semantic, hotel_client):
+        """言い換えた質問には類似質問の回答を返す"""
+        app_module, calls = semantic
+        first = hotel_client.post('/api/chat', json={'message': 'ホテルの予約対応でAIを使うには？'}).get_json()
+        second = hotel_client.post('/api/chat', json={'message': '予約対応にAIを活用する方法は？'}).get_json()
+        assert first['cached'] is False
+        assert second['cached'] is True
+        assert second['response'] == first['response']
+        assert len(calls) == 1
+        
+        stats = hotel_client.get('/api/admin/llm-cache').get_json()['cache']
+        assert stats['semantic']['hits'] == 1
+        assert stats['semantic']['backend'] == 'ngram'
+        assert stats['overall_hit_rate'] == 0.5
+        print("✓ 言い換えた質問に類似質問の回答を返す（ヒット率を集計）")
+    
+    def test_unrelated_question_misses(self, semantic):
+        """内容の異なる質問はヒットしない"""
+        app_module, _ = semantic
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        assert app_module.semantic_cache.lookup(db, industry_id, '清掃スタッフのシフト作成') is None
+        match = app_module.semantic_cache.lookup(db, industry_id, '口コミ返信をAIで書きたい')
+        db.close()
+        assert match['cache_key'] == 'seed-1'
+        print("✓ 内容の異なる質問はヒットしない")
+    
+    def test_other_industry_not_shared(self, semantic):
+        """他業種の回答済み質問は使わない"""
+        app_module, _ = semantic
+        db = get_db()
+        other = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0] + 1000
+        assert app_module.semantic_cache.lookup(db, other, '口コミへの返信をAIで作成したい') is None
+        db.close()
+        print("✓ 業種をまたいで回答を共有しない")
+    
+    def test_threshold_tunable(self, semantic, monkeypatch):
+        """閾値を上げると言い換えはヒットしない"""
+        app_module, _ = semantic
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        assert app_module.semantic_cache.lookup(db, industry_id, '口コミ返信をAIで書きたい') is not None
+        monkeypatch.setattr(app_module, 'SEMANTIC_CACHE_THRESHOLD', '0.99')
+        assert app_module.semantic_cache.threshold == 0.99
+        assert app_module.semantic_cache.lookup(db, industry_id, '口コミ返信をAIで書きたい') is None
+        db.close()
+        print("✓ 類似度の閾値を変更できる")
+    
+    def test_knowledge_update_invalidates_cache(self, semantic):
+        """参考情報のナレッジが更新されると、それを使った回答キャッシュは削除される"""
+        app_module, _ = semantic
+        db = get_db()
+        cursor = db.execute("INSERT INTO external_knowledge (industry_id, title, content) VALUES (NULL, 'テスト', '内容')")
+        knowledge_id = cursor.lastrowid
+        app_module.store_llm_response(db, 'uses-knowledge', None, '質問', '回答', [f'knowledge:{knowledge_id}'])
+        app_module.store_llm_response(db, 'other-knowledge', None, '質問2', '回答2', [f'knowledge:{knowledge_id}0'])
+        db.execute("UPDATE external_knowledge SET content = '更新後' WHERE id = ?", (knowledge_id,))
+        db.commit()
+        keys = {r[0] for r in db.execute("SELECT cache_key FROM llm_response_cache WHERE industry_id IS NULL").fetchall()}
+        db.execute('DELETE FROM external_knowledge WHERE id = ?', (knowledge_id,))
+        db.commit()
+        db.close()
+        assert 'uses-knowledge' not in keys
+        assert 'other-knowledge' in keys
+        print("✓ ナレッジ更新で該当する回答キャッシュを削除")
+    
+    def test_semantic_hit_survives_unrelated_changes(self, semantic):
+        """無関係なコンテンツの更新では類似質問の回答は有効なまま、参考にした動画が変わると使わない"""
+        app_module, _ = semantic
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        db.execute("INSERT OR REPLACE INTO videos (id, title, filename) VALUES (979, 'チェックインの動画', 'c.mp4')")
+        db.commit()
+        app_module.store_llm_response(db, 'uses-video', industry_id, 'フロントのチェックイン業務を自動化したい', '動画の回答',
+                                      ['video:979'])
+        chat = {'cache_key': 'no-such-key', 'industry_id': industry_id, 'is_admin': False}
+        cursor = db.execute("INSERT INTO external_knowledge (industry_id, title, content) VALUES (NULL, '清掃', '新しい手順')")
+        db.commit()
+        assert app_module.get_cached_chat_answer(db, chat, 'フロントのチェックイン業務を自動化したい') == '動画の回答'
+        db.execute("UPDATE videos SET description = '内容を変更しました' WHERE id = 979")
+        db.commit()
+        answer = app_module.get_cached_chat_answer(db, chat, 'フロントのチェックイン業務を自動化したい')
+        db.execute('DELETE FROM external_knowledge WHERE id = ?', (cursor.lastrowid,))
+        db.execute('DELETE FROM videos WHERE id = 979')
+        db.commit()
+        db.close()
+        assert answer is None
+        print("✓ 参考情報が変わったときだけ類似質問の回答を使わない")
+    
+    def test_semantic_hit_requires_accessible_videos(self, semantic):
+        """回答で案内した動画を閲覧できないユーザーには類似質問の回答を返さない"""
+        app_module, _ = semantic
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        restricted = db.execute("SELECT id FROM categories WHERE name = '小売業向けAI活用'").fetchone()[0]
+        db.execute("INSERT OR REPLACE INTO videos (id, title, filename, category_id) VALUES (979, '小売向け動画', 'r.mp4', ?)",
+                   (restricted,))
+        db.commit()
+        app_module.store_llm_response(db, 'retail-video', industry_id, '在庫管理をAIで効率化したい', '小売の回答',
+                                      ['video:979'])
+        chat = {'cache_key': 'no-such-key', 'industry_id': industry_id, 'is_admin': False}
+        user_answer = app_module.get_cached_chat_answer(db, chat, '在庫管理をAIで効率化したい')
+        chat['is_admin'] = True
+        admin_answer = app_module.get_cached_chat_answer(db, chat, '在庫管理をAIで効率化したい')
+        db.execute('DELETE FROM videos WHERE id = 979')
+        db.commit()
+        db.close()
+        assert user_answer is None
+        assert admin_answer == '小売の回答'
+        print("✓ 閲覧できない動画を案内する回答は返さない")
+    
+    def test_index_encodes_only_new_answers_outside_lock(self, semantic, monkeypatch):
+        """索引は新しい回答だけをベクトル化し、ベクトル化中も他の業種の検索を待たせない"""
+        import numpy
+        app_module, _ = semantic
+        encoded = []
+        release = threading.Event()
+        
+        class FakeEmbedding:
+            backend = 'embedding'
+            incremental = True
+            
+            def fit(self, texts):
+                encoded.append(list(texts))
+                if any('遅い' in t for t in texts):
+                    release.wait(5)
+                return [numpy.array([1.0, float(len(t))]) / numpy.hypot(1.0, len(t)) for t in texts]
+            
+            def transform(self, text):
+                return self.fit([text])[0]
+            
+            def stack(self, vectors):
+                return numpy.array(vectors) if vectors else []
+            
+            def similarities(self, query, vectors):
+                return [float(v) for v in vectors @ query] if len(vectors) else []
+        
+        monkeypatch.setattr(app_module.semantic_cache, '_vectorizer', lambda: FakeEmbedding())
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        app_module.semantic_cache.lookup(db, industry_id, '質問')
+        assert len(encoded[0]) == len(self.SEED_QUESTIONS)
+        app_module.store_llm_response(db, 'new-answer', industry_id, '新しい質問', '回答', [])
+        encoded.clear()
+        app_module.semantic_cache.lookup(db, industry_id, '質問')
+        assert encoded[0] == ['新しい質問']
+        
+        # 別の業種の索引を作っている（ベクトル化で止まっている）間も検索できる
+        app_module.store_llm_response(db, 'slow-answer', industry_id + 1000, '遅い質問', '回答', [])
+        db.close()
+        
+        def build_other():
+            other_db = get_db()
+            app_module.semantic_cache.lookup(other_db, industry_id + 1000, '質問')
+            other_db.close()
+        
+        worker = threading.Thread(target=build_other)
+        worker.start()
+        time.sleep(0.2)
+        
+        def lookup_own():
+            own_db = get_db()
+            app_module.semantic_cache.lookup(own_db, industry_id, '質問')
+            own_db.close()
+        
+        # 別の業種のベクトル化が終わる（release）前に、自分の業種の検索が完了する
+        looker = threading.Thread(target=lookup_own)
+        looker.start()
+        looker.join(10)
+        finished_before_release = not looker.is_alive()
+        release.set()
+        worker.join()
+        looker.join()
+        db = get_db()
+        db.execute('DELETE FROM llm_response_cache WHERE industry_id = ?', (industry_id + 1000,))
+        db.commit()
+        db.close()
+        assert finished_before_release
+        print("✓ 新しい回答だけをロックの外でベクトル化")
+
+# ========== LLM呼び出しの耐障害性テスト ==========
+
+class TestLLMResilience:
+    """同時実行数上限・再試行・サーキットブレーカー・フォールバック回答のテスト"""
+    
+    @pytest.fixture
+    def flaky_llm(self, monkeypatch):
+        """指定したステータスを順に返すモッククライアントと、新しいブレーカーを用意"""
+        import httpx
+        import app as app_module
+        state = {'statuses': [], 'calls': 0}
+        
+        def handler(request):
+            state['calls'] += 1
+            status = state['statuses'].pop(0) if state['statuses'] else 200
+            if status != 200:
+                return httpx.Response(status, text='overloaded')
+            if json.loads(request.content).get('stream'):
+                body = 'data: ' + json.dumps({'choices': [{'delta': {'content': '回復'}}]}) + '\n\ndata: [DONE]\n\n'
+                return httpx.Response(200, text=body, headers={'Content-Type': 'text/event-stream'})
+            return httpx.Response(200, json={'choices': [{'message': {'content': '回復しました'}}]})
+        
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(app_module, '_llm_client', client)
+        monkeypatch.setattr(app_module, '_llm_client_pid', os.getpid())
+        monkeypatch.setattr(app_module, 'llm_metrics', app_module.LLMMetrics())
+        monkeypatch.setattr(app_module, 'llm_circuit_breaker', app_module.CircuitBreaker(2, 30))
+        monkeypatch.setattr(app_module, 'RAKUTEN_AI_RETRY_BASE_SECONDS', 0)
+        monkeypatch.setattr(app_module, 'LLM_CACHE_ENABLED', False)
+        yield state
+        client.close()
+    
+    def test_transient_errors_retried(self, flaky_llm):
+        """503が続いても再試行の範囲内で回復すれば回答を返す"""
+        import app as app_module
+        flaky_llm['statuses'] = [503, 503]
+        result = app_module.call_rakuten_ai('質問')
+        assert result == {'success': True, 'response': '回復しました'}
+        assert flaky_llm['calls'] == 3
+        assert app_module.llm_circuit_breaker.snapshot()['state'] == 'closed'
+        print("✓ 一時的なエラーは再試行して回復")
+    
+    def test_client_errors_not_retried(self, flaky_llm):
+        """400は再試行せず、ブレーカーの失敗にも数えない"""
+        import app as app_module
+        flaky_llm['statuses'] = [400]
+        result = app_module.call_rakuten_ai('質問')
+        assert result['success'] is False
+        assert 'unavailable' not in result
+        assert flaky_llm['calls'] == 1
+        assert app_module.llm_circuit_breaker.snapshot()['consecutive_failures'] == 0
+        print("✓ 400は再試行しない")
+    
+    def test_breaker_opens_and_chat_falls_back(self, hotel_client, flaky_llm):
+        """再試行しても失敗が続くとブレーカーが開き、APIを呼ばずに検索結果のみで回答する"""
+        import app as app_module
+        flaky_llm['statuses'] = [503] * 6
+        for _ in range(2):
+            data = hotel_client.post('/api/chat', json={'message': '接客でのAI活用'}).get_json()
+            assert data['success'] is True
+            assert data['fallback'] is True
+        assert flaky_llm['calls'] == 6
+        assert app_module.llm_circuit_breaker.snapshot()['state'] == 'open'
+        
+        data = hotel_client.post('/api/chat', json={'message': '接客でのAI活用'}).get_json()
+        assert data['fallback'] is True
+        assert 'AIアシスタントが応答できない' in data['response']
+        assert flaky_llm['calls'] == 6
+        print("✓ 連続失敗でブレーカーが開き、検索結果のみで回答")
+    
+    def test_half_open_closes_on_success(self, flaky_llm):
+        """待機時間の経過後は1件試し、成功すれば閉じる"""
+        import app as app_module
+        breaker = app_module.CircuitBreaker(1, 0)
+        breaker.record_failure()
+        assert breaker.snapshot()['state'] == 'open'
+        assert breaker.allow() is True
+        assert breaker.snapshot()['state'] == 'half_open'
+        breaker.record_success()
+        assert breaker.snapshot()['state'] == 'closed'
+        
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.snapshot()['state'] == 'open'
+        print("✓ half_openで成功すれば閉じ、失敗すれば再び開く")
+    
+    def test_half_open_allows_single_probe(self):
+        """half_open では同時に来た呼び出しのうち1件だけを通し、結果が出るまで他は拒否する"""
+        import app as app_module
+        breaker = app_module.CircuitBreaker(1, 0.2)
+        breaker.record_failure()
+        time.sleep(0.25)
+        barrier = threading.Barrier(20)
+        allowed = []
+        
+        def call():
+            barrier.wait()
+            allowed.append(breaker.allow())
+        
+        threads = [threading.Thread(target=call) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert allowed.count(True) == 1
+        assert breaker.allow() is False
+        breaker.abandon()
+        assert breaker.allow() is True  # 試行を断念したら次の1件を通す
+        breaker.record_success()
+        assert all(breaker.allow() for _ in range(5))
+        print("✓ half_openでは1件だけ試す")
+    
+    def test_busy_falls_back(self, hotel_client, flaky_llm, monkeypatch):
+        """同時実行数の上限に達したまま制限時間を過ぎると、APIを呼ばずにフォールバックする"""
+        import threading
+        import app as app_module
+        semaphore = threading.BoundedSemaphore(1)
+        semaphore.acquire()
+        monkeypatch.setattr(app_module, 'llm_semaphore', semaphore)
+        monkeypatch.setattr(app_module, 'CHAT_DEADLINE_SECONDS', 0.2)
+        
+        data = hotel_client.post('/api/chat', json={'message': '接客でのAI活用'}).get_json()
+        semaphore.release()
+        assert data['success'] is True
+        assert data['fallback'] is True
+        assert flaky_llm['calls'] == 0
+        print("✓ 混雑時は待ちすぎずにフォールバック")
+    
+    def test_stream_falls_back(self, hotel_client, flaky_llm):
+        """ストリーミングでも最初のトークン前に失敗したらフォールバック回答を送る"""
+        flaky_llm['statuses'] = [503] * 3
+        response = hotel_client.post('/api/chat/stream', json={'message': '接客でのAI活用'})
+        events = TestChatStreaming._parse_sse(response.get_data(as_text=True))
+        assert events[-1][0] == 'done'
+        assert events[-1][1]['fallback'] is True
+        assert [data['text'] for event, data in events if event == 'token'] == [events[-1][1]['response']]
+        print("✓ ストリーミングでもフォールバック回答を送信")
+    
+    def test_stream_retries_before_first_token(self, hotel_client, flaky_llm):
+        """ストリーミングも最初のトークン前の一時的なエラーは再試行する"""
+        flaky_llm['statuses'] = [429]
+        response = hotel_client.post('/api/chat/stream', json={'message': '接客でのAI活用'})
+        events = TestChatStreaming._parse_sse(response.get_data(as_text=True))
+        assert events[-1] == ('done', {'response': '回復', 'cached': False, 'fallback': False})
+        assert flaky_llm['calls'] == 2
+        print("✓ ストリーミングも最初のトークン前は再試行")
+    
+    def test_fallback_answer_lists_retrieved_content(self):
+        """フォールバック回答は検索で見つかったユースケースを含む"""
+        import app as app_module
+        chat = {
+            'knowledge': [],
+            'usecases': [{'title': '予約対応の自動化', 'description': 'AIで問い合わせに対応'}],
+            'recommended_videos': []
+        }
+        answer = app_module.build_fallback_answer(chat)
+        assert '予約対応の自動化' in answer
+        empty = app_module.build_fallback_answer({'knowledge': [], 'usecases': [], 'recommended_videos': []})
+        assert '再度お試しください' in empty
+        print("✓ フォールバック回答に検索結果を含める")
+
+# ========== RAGコンテキスト（トークン予算）テスト ==========
+
+class TestContextPacker:
+    """関連度順・重複除去・トークン予算によるコンテキスト組み立てのテスト"""
+    
+    @staticmethod
+    def _relevant(knowledge=(), usecases=(), videos=(), transcripts=()):
+        return {'knowledge': list(knowledge), 'usecases': list(usecases),
+                'videos': list(videos), 'transcripts': list(transcripts)}
+    
+    def test_estimate_tokens(self):
+        """日本語は文字種ごと、英語は単語の長さから概算する"""
+        import app as app_module
+        assert app_module.estimate_tokens('') == 0
+        assert app_module.estimate_tokens('予約対応') == 4
+        assert app_module.estimate_tokens('ホテル') == 2
+        assert app_module.estimate_tokens('reservation') == 3
+        assert app_module.estimate_tokens('AI。') == 2
+        print("✓ トークン数を文字種ごとに概算")
+    
+    def test_relevant_passage_preferred_within_budget(self):
+        """長いナレッジは質問に関係する部分を優先して予算内に収める"""
+        import app as app_module
+        filler = '一般的な業界の動向について説明します。' * 30
+        content = filler + '予約対応の自動化にはチャットボットが有効です。' + filler
+        relevant = self._relevant(knowledge=[{'id': 1, 'title': '業界ガイド', 'content': content}])
+        packed = app_module.pack_context(relevant, '予約対応の自動化について', budget=300)
+        assert packed['tokens'] <= 300
+        assert '予約対応の自動化にはチャットボット' in packed['context']
+        assert '■ 業界ガイド' in packed['context']
+        assert packed['dropped'] > 0
+        assert packed['context_ids'] == ['knowledge:1']
+        print("✓ 関連する部分を優先して予算内に収める")
+    
+    def test_duplicate_passages_removed(self):
+        """同じ内容の文字起こしは1回だけ使う"""
+        import app as app_module
+        text = '接客でAIを使うと問い合わせ対応が早くなります。'
+        relevant = self._relevant(transcripts=[
+            {'id': 1, 'video_title': '動画A', 'content': text},
+            {'id': 2, 'video_title': '動画B', 'content': text},
+        ])
+        packed = app_module.pack_context(relevant, '接客 AI', budget=1000)
+        assert packed['context'].count(text) == 1
+        assert packed['context_ids'] == ['transcript:1']
+        print("✓ 重複するパッセージを除去")
+    
+    def test_sections_in_fixed_order(self):
+        """出典ごとの見出しは常に同じ順で並ぶ"""
+        import app as app_module
+        relevant = self._relevant(
+            knowledge=[{'id': 1, 'title': '知識', 'content': '清掃の手順をAIで作成する。'}],
+            usecases=[{'id': 2, 'title': '清掃計画', 'description': 'シフトと清掃順を提案'}],
+            videos=[{'id': 3, 'title': '清掃研修', 'description': '客室清掃の基本'}],
+        )
+        context = app_module.pack_context(relevant, '清掃', budget=1000)['context']
+        assert context.index('【業界の専門知識') < context.index('【関連ユースケース】') < context.index('【関連トレーニング動画】')
+        assert app_module.pack_context(relevant, '清掃', budget=0)['context'] == ''
+        print("✓ 見出しの順序を維持し、予算0では空")
+    
+    def test_prepare_chat_logs_tokens(self, capsys):
+        """チャット準備時に使用トークン数を記録する"""
+        import app as app_module
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        chat = app_module.prepare_chat(db, '接客でのAI活用', industry_id, '宿泊業', False)
+        db.close()
+        assert chat['context_tokens'] <= app_module.CONTEXT_TOKEN_BUDGET
+        assert f"[Context] {chat['context_tokens']}/" in capsys.readouterr().out
+        print("✓ 使用トークン数をログに出力")
+
+# ========== 全文検索インデックステスト ==========
+
+class TestFullTextSearch:
+    """FTS5 trigramインデックスによるRAG検索のテスト"""
+    
+    @pytest.fixture
+    def indexed_videos(self):
+        """タイトル・説明文に検索語を含む動画を用意（テスト後に削除）"""
+        db = get_db()
+        db.execute('''INSERT OR REPLACE INTO videos (id, title, description, filename, category_id)
+                      VALUES (981, 'ハウスキーピング研修', '客室清掃の手順', 'fts_a.mp4', NULL)''')
+        db.execute('''INSERT OR REPLACE INTO videos (id, title, description, filename, category_id)
+                      VALUES (982, '接遇の基本', 'ハウスキーピング部門との連携も紹介', 'fts_b.mp4', NULL)''')
+        db.commit()
+        db.close()
+        yield
+        db = get_db()
+        db.execute('DELETE FROM videos WHERE id IN (981, 982, 983)')
+        db.commit()
+        db.close()
+    
+    def test_index_created_by_migration(self):
+        """マイグレーションでインデックスが作成される"""
+        import app as app_module
+        db = get_db()
+        assert app_module.fulltext_index_available(db)
+        db.close()
+        print("✓ 全文検索インデックスが作成済み")
+    
+    def test_bm25_ranks_title_matches_first(self, indexed_videos):
+        """タイトルに一致する動画を説明文のみの一致より上位に返す"""
+        import app as app_module
+        db = get_db()
+        result = app_module.search_relevant_content(db, 'ハウスキーピングについて', None, is_admin=True)
+        db.close()
+        ids = [v['id'] for v in result['videos']]
+        assert ids[:2] == [981, 982]
+        print("✓ bm25でタイトル一致を上位に")
+    
+    def test_triggers_keep_index_in_sync(self, indexed_videos):
+        """更新・削除がインデックスに反映される"""
+        import app as app_module
+        db = get_db()
+        db.execute("UPDATE videos SET title = 'ベッドメイキング研修', description = '' WHERE id = 981")
+        db.execute("DELETE FROM videos WHERE id = 982")
+        db.execute('''INSERT INTO videos (id, title, description, filename) VALUES (983, 'ハウスキーピング応用', '', 'fts_c.mp4')''')
+        db.commit()
+        ids = [v['id'] for v in app_module.search_relevant_content(db, 'ハウスキーピング', None, is_admin=True)['videos']]
+        renamed = [v['id'] for v in app_module.search_relevant_content(db, 'ベッドメイキング', None, is_admin=True)['videos']]
+        db.close()
+        assert ids == [983]
+        assert renamed == [981]
+        print("✓ トリガーで追加・更新・削除をインデックスに反映")
+    
+    def test_short_keywords_use_like(self, indexed_videos):
+        """trigramで検索できない2文字のキーワードも見つかる"""
+        import app as app_module
+        db = get_db()
+        ids = [v['id'] for v in app_module.search_relevant_content(db, '接遇', None, is_admin=True)['videos']]
+        db.close()
+        assert 982 in ids
+        print("✓ 2文字のキーワードはLIKEで補完")
+    
+    def test_falls_back_without_index(self, indexed_videos, monkeypatch):
+        """インデックスがない環境でも従来どおりLIKEで検索する"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'fulltext_index_available', lambda db: False)
+        db = get_db()
+        ids = [v['id'] for v in app_module.search_relevant_content(db, 'ハウスキーピング', None, is_admin=True)['videos']]
+        db.close()
+        assert set(ids) >= {981, 982}
+        print("✓ インデックスなしではLIKE検索にフォールバック")
+    
+    def test_knowledge_limited_to_industry(self):
+        """外部ナレッジはユーザーの業種のみ検索する"""
+        import app as app_module
+        db = get_db()
+        industries = [r[0] for r in db.execute('SELECT id FROM industries ORDER BY id LIMIT 2').fetchall()]
+        cursor = db.execute('''INSERT INTO external_knowledge (industry_id, title, content, keywords)
+                               VALUES (?, 'レベニューマネジメント入門', '客室単価の最適化', '')''', (industries[0],))
+        knowledge_id = cursor.lastrowid
+        db.commit()
+        own = app_module.search_relevant_content(db, 'レベニューマネジメント', industries[0])['knowledge']
+        other = app_module.search_relevant_content(db, 'レベニューマネジメント', industries[1])['knowledge']
+        db.execute('DELETE FROM external_knowledge WHERE id = ?', (knowledge_id,))
+        db.commit()
+        db.close()
+        assert [k['id'] for k in own] == [knowledge_id]
+        assert other == []
+        print("✓ 外部ナレッジは業種で絞り込み")
+
+# ========== ハイブリッド検索（ベクトル検索）テスト ==========
+
+class TestHybridRetrieval:
+    """ベクトルインデックスの差分更新とRRFによる語句検索との統合のテスト"""
+    
+    class ConceptEncoder:
+        """同義語のグループごとに1次元を割り当てるテスト用エンコーダー"""
+        CONCEPTS = [('客室清掃', 'ハウスキーピング'), ('口コミ', 'レビュー'), ('予約', 'ブッキング')]
+        dim = 4
+        
+        def encode(self, texts, query=False):
+            import numpy as np
+            vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+            for i, text in enumerate(texts):
+                for d, terms in enumerate(self.CONCEPTS):
+                    vectors[i, d] = any(t in text for t in terms)
+                vectors[i, -1] = 0.1
+                vectors[i] /= np.linalg.norm(vectors[i])
+            return vectors
+    
+    @pytest.fixture
+    def vector_index(self, tmp_path, monkeypatch):
+        """一時ディレクトリのベクトルインデックスを有効化"""
+        pytest.importorskip('numpy')
+        import app as app_module
+        index = app_module.VectorIndex(str(tmp_path), self.ConceptEncoder())
+        monkeypatch.setattr(app_module, '_vector_index', index)
+        monkeypatch.setattr(app_module, '_vector_index_loaded', True)
+        return index
+    
+    @pytest.fixture
+    def knowledge(self):
+        """業種付きの外部ナレッジを1件追加（テスト後に削除）"""
+        db = get_db()
+        industry_id = db.execute("SELECT industry_id FROM users WHERE username = 'hotel_tanaka'").fetchone()[0]
+        cursor = db.execute('''INSERT INTO external_knowledge (industry_id, title, content, keywords)
+                               VALUES (?, 'ハウスキーピングの標準手順', 'ベッドメイクと水回りの点検を順に行う。', '')''',
+                            (industry_id,))
+        knowledge_id = cursor.lastrowid
+        db.commit()
+        db.close()
+        yield industry_id, knowledge_id
+        db = get_db()
+        db.execute('DELETE FROM external_knowledge WHERE id = ?', (knowledge_id,))
+        db.commit()
+        db.close()
+    
+    def test_sync_appends_and_tombstones(self, vector_index, knowledge):
+        """キューのパッセージだけを再ベクトル化し、更新前の行は無効化する"""
+        import numpy as np
+        import app as app_module
+        _, knowledge_id = knowledge
+        entries_sql = '''
+            SELECT e.row, e.deleted FROM vector_entries e
+            WHERE e.source = 'passage' AND e.source_id IN (SELECT id FROM content_passages WHERE source = 'knowledge' AND source_id = ?)
+            ORDER BY e.row
+        '''
+        db = get_db()
+        app_module.sync_passages(db)
+        vector_index.sync(db)
+        assert db.execute('SELECT COUNT(*) FROM vector_index_queue').fetchone()[0] == 0
+        before = db.execute(entries_sql, (knowledge_id,)).fetchall()
+        assert [r['deleted'] for r in before] == [0]
+        
+        db.execute("UPDATE external_knowledge SET content = '口コミへの返信例。' WHERE id = ?", (knowledge_id,))
+        db.commit()
+        app_module.sync_passages(db)
+        assert vector_index.sync(db) == 2  # 削除されたパッセージと新しいパッセージ
+        after = db.execute(entries_sql, (knowledge_id,)).fetchall()
+        stale = db.execute('SELECT deleted FROM vector_entries WHERE row = ?', (before[0]['row'],)).fetchone()
+        db.close()
+        assert stale['deleted'] == 1
+        assert [r['deleted'] for r in after] == [0]
+        assert after[0]['row'] > before[0]['row']
+        
+        matrix = np.memmap(vector_index.path, dtype=np.float16, mode='r').reshape(-1, 4)
+        assert matrix[after[0]['row']][1] > 0.5
+        print("✓ 変更されたパッセージだけを追記し、古い行を無効化")
+    
+    def test_vector_hit_fused_into_results(self, vector_index, knowledge):
+        """語句が一致しない言い換えでも、ベクトル検索で見つかったナレッジを返す"""
+        import app as app_module
+        industry_id, knowledge_id = knowledge
+        db = get_db()
+        app_module.sync_passages(db)
+        vector_index.sync(db)
+        lexical_only = app_module.fulltext_search(db, 'SELECT k.id FROM external_knowledge k', 'k.id',
+                                                  'external_knowledge_fts', ['k.title', 'k.content'],
+                                                  'k.industry_id = ?', [industry_id],
+                                                  app_module.extract_keywords('客室清掃のコツ'), 5)
+        result = app_module.search_relevant_content(db, '客室清掃のコツ', industry_id)
+        db.close()
+        assert knowledge_id not in [k['id'] for k in lexical_only]
+        assert knowledge_id in [k['id'] for k in result['knowledge']]
+        print("✓ ベクトル検索の結果を語句検索と統合")
+    
+    def test_other_industry_not_returned(self, vector_index, knowledge):
+        """ベクトル検索で近くても他業種のナレッジは返さない"""
+        import app as app_module
+        industry_id, knowledge_id = knowledge
+        db = get_db()
+        app_module.sync_passages(db)
+        vector_index.sync(db)
+        other = db.execute('SELECT id FROM industries WHERE id != ? LIMIT 1', (industry_id,)).fetchone()[0]
+        result = app_module.search_relevant_content(db, '客室清掃のコツ', other)
+        db.close()
+        assert knowledge_id not in [k['id'] for k in result['knowledge']]
+        print("✓ ベクトル検索でもアクセス制御を適用")
+    
+    def test_rrf_prefers_items_found_by_both(self):
+        """両方の検索で上位の出典が、片方のみの出典より上位になる"""
+        import app as app_module
+        db = get_db()
+        ids = [r[0] for r in db.execute('SELECT id FROM industries ORDER BY id LIMIT 3').fetchall()]
+        lexical = [{'id': ids[0]}, {'id': ids[1]}]
+        fused = app_module.rrf_fuse(db, lexical, [ids[1], ids[2]], 'SELECT i.id FROM industries i', 'i.id', '1 = 1', [], 3)
+        db.close()
+        assert [r['id'] for r in fused] == [ids[1], ids[0], ids[2]]
+        print("✓ RRFで両方に現れる出典を優先")
+    
+    def test_hnsw_backend(self, tmp_path, knowledge):
+        """HNSWでも総当たりと同じ出典が見つかる"""
+        pytest.importorskip('hnswlib')
+        import app as app_module
+        index = app_module.VectorIndex(str(tmp_path), self.ConceptEncoder(), backend='hnsw')
+        db = get_db()
+        index.sync(db)
+        rows = [r for r, _ in index.search('ハウスキーピング', 3)]
+        entry = db.execute('SELECT source_id FROM vector_entries WHERE row = ?', (rows[0],)).fetchone()
+        db.close()
+        assert entry['source_id'] == knowledge[1]
+        print("✓ HNSWで近傍探索")
+
+# ========== 検索用パッセージテスト ==========
+
+class TestPassageStore:
+    """文字起こし・外部ナレッジのパッセージ分割と検索のテスト"""
+    
+    @pytest.fixture
+    def long_transcript(self):
+        """末尾付近にだけ検索語が出てくる、セグメント付きの文字起こしを用意"""
+        import app as app_module
+        db = get_db()
+        db.execute("INSERT OR REPLACE INTO videos (id, title, filename) VALUES (984, 'パッセージ検索テスト', 'passage.mp4')")
+        sentences = [f"これは導入部分の説明その{i}です。" for i in range(60)]
+        sentences.append('最後にインバウンド対応の多言語チャットを紹介します。')
+        content = ''.join(sentences)
+        cursor = db.execute("INSERT INTO video_transcripts (video_id, content, content_type) VALUES (984, ?, 'transcript')",
+                            (content,))
+        transcript_id = cursor.lastrowid
+        db.executemany('''INSERT INTO video_transcripts (video_id, content, content_type, timestamp_start, timestamp_end)
+                          VALUES (984, ?, 'segment', ?, ?)''',
+                       [(text, i * 40.0, i * 40.0 + 40) for i, text in enumerate(sentences)])
+        db.commit()
+        app_module.sync_passages(db)
+        db.close()
+        yield transcript_id
+        db = get_db()
+        db.execute('DELETE FROM video_transcripts WHERE video_id = 984')
+        db.execute('DELETE FROM videos WHERE id = 984')
+        db.commit()
+        db.close()
+    
+    def test_chunk_passages_overlap(self):
+        """窓は前の窓と重なり、文末で区切られ、全文を覆う"""
+        import app as app_module
+        text = ''.join(f"文{i:02d}の内容です。" for i in range(40))
+        spans = app_module.chunk_passages(text, size=60, overlap=15)
+        assert spans[0][0] == 0 and spans[-1][1] == len(text)
+        for (s1, e1), (s2, e2) in zip(spans, spans[1:]):
+            assert s2 < e1  # 重なりがある
+            assert text[e1 - 1] == '。'
+        print("✓ 重なりのある窓に分割")
+    
+    def test_transcript_passages_keep_timestamps(self, long_transcript):
+        """文字起こしのパッセージは元のオフセットと開始・終了秒を持つ"""
+        import app as app_module
+        db = get_db()
+        app_module.sync_passages(db)
+        rows = db.execute('''SELECT content, char_start, char_end, timestamp_start, timestamp_end FROM content_passages
+                             WHERE source = 'transcript' AND source_id = ? ORDER BY passage_index''',
+                          (long_transcript,)).fetchall()
+        full = db.execute('SELECT content FROM video_transcripts WHERE id = ?', (long_transcript,)).fetchone()[0]
+        db.close()
+        assert len(rows) > 1
+        assert all(full[r['char_start']:r['char_end']].strip() == r['content'] for r in rows)
+        assert rows[0]['timestamp_start'] == 0
+        assert rows[-1]['timestamp_end'] == 61 * 40.0
+        print("✓ パッセージにオフセットとタイムスタンプを記録")
+    
+    def test_search_returns_matching_passage(self, long_transcript):
+        """検索は文字起こしの冒頭ではなく一致したパッセージを返す"""
+        import app as app_module
+        db = get_db()
+        result = app_module.search_relevant_content(db, 'インバウンド対応について', None, is_admin=True)
+        db.close()
+        hit = next(t for t in result['transcripts'] if t['id'] == long_transcript)
+        assert 'インバウンド対応' in hit['content']
+        assert '導入部分の説明その0です' not in hit['content']
+        assert hit['timestamp_start'] > 2000
+        context = app_module.pack_context(result, 'インバウンド対応について')['context']
+        assert f"パッセージ検索テスト（{app_module.format_timestamp(hit['timestamp_start'])}〜）" in context
+        print("✓ 一致したパッセージと再生位置を返す")
+    
+    def test_knowledge_passages_follow_updates(self):
+        """ナレッジの更新でパッセージを作り直し、削除で即時に消える"""
+        import app as app_module
+        db = get_db()
+        cursor = db.execute("INSERT INTO external_knowledge (industry_id, title, content) VALUES (NULL, '旧見出し', '旧本文です。')")
+        knowledge_id = cursor.lastrowid
+        db.commit()
+        app_module.sync_passages(db)
+        db.execute("UPDATE external_knowledge SET title = '新見出し', content = '新本文です。' WHERE id = ?", (knowledge_id,))
+        db.commit()
+        app_module.sync_passages(db)
+        rows = db.execute("SELECT title, content FROM content_passages WHERE source = 'knowledge' AND source_id = ?",
+                          (knowledge_id,)).fetchall()
+        assert [(r['title'], r['content']) for r in rows] == [('新見出し', '新本文です。')]
+        db.execute('DELETE FROM external_knowledge WHERE id = ?', (knowledge_id,))
+        db.commit()
+        remaining = db.execute("SELECT COUNT(*) FROM content_passages WHERE source = 'knowledge' AND source_id = ?",
+                               (knowledge_id,)).fetchone()[0]
+        db.close()
+        assert remaining == 0
+        print("✓ ナレッジの更新・削除をパッセージに反映")
+    
+    def test_search_drains_queue_in_background(self, monkeypatch):
+        """検索リクエストはキューの先頭だけを処理し、残りはバックグラウンドで処理する"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'INLINE_INDEX_SYNC_LIMIT', 2)
+        db = get_db()
+        app_module.sync_passages(db)
+        ids = [db.execute("INSERT INTO external_knowledge (industry_id, title, content) VALUES (NULL, ?, ?)",
+                          (f'キュー{i}', f'キューの処理を確認する本文{i}です。')).lastrowid for i in range(6)]
+        db.commit()
+        processed = []
+        sync = app_module.sync_passages
+        monkeypatch.setattr(app_module, '_drain_index_queues', lambda db_path: None)
+        monkeypatch.setattr(app_module, 'sync_passages',
+                            lambda db, **kwargs: processed.append(sync(db, **kwargs)) or processed[-1])
+        app_module.search_relevant_content(db, 'キューの処理', None, is_admin=True)
+        remaining = db.execute('SELECT COUNT(*) FROM passage_queue').fetchone()[0]
+        monkeypatch.undo()
+        app_module.refresh_retrieval_indexes(db)
+        indexed = db.execute(f"SELECT COUNT(DISTINCT source_id) FROM content_passages WHERE source = 'knowledge' "
+                             f"AND source_id IN ({','.join('?' * len(ids))})", ids).fetchone()[0]
+        db.executemany('DELETE FROM external_knowledge WHERE id = ?', [(i,) for i in ids])
+        db.commit()
+        db.close()
+        assert processed == [2] and remaining == 4
+        assert indexed == 6
+        print("✓ 検索リクエストではキューの先頭だけを処理")
+
+# ========== 検索の並行実行テスト ==========
+
+class TestConcurrentRetrieval:
+    """ソース別検索の並行実行・タイムアウトのテスト"""
+    
+    def test_concurrent_matches_sequential(self, monkeypatch):
+        """並行実行しても順番に実行した場合と同じ結果になり、ソースごとの所要時間を返す"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'RETRIEVAL_CACHE_ENABLED', False)
+        db = get_db()
+        industry_id = db.execute('SELECT id FROM industries LIMIT 1').fetchone()[0]
+        concurrent = app_module.search_relevant_content(db, 'AIで予約対応と口コミ返信を効率化', industry_id)
+        monkeypatch.setattr(app_module, 'RETRIEVAL_WORKERS', 0)
+        sequential = app_module.search_relevant_content(db, 'AIで予約対応と口コミ返信を効率化', industry_id)
+        db.close()
+        for name, _ in app_module.RETRIEVAL_SOURCES:
+            assert concurrent[name] == sequential[name]
+            assert concurrent['timings'][name] is not None
+        print("✓ 並行実行と順次実行の結果が一致")
+    
+    def test_sources_run_in_parallel(self, monkeypatch):
+        """ソースが同時に実行される（全ソースがそろうまで待つソースでも完了する）"""
+        import app as app_module
+        # 3つのソースが同時に実行中でなければ BrokenBarrierError になる
+        barrier = threading.Barrier(3, timeout=10)
+        def waiting(name):
+            def search(db, req):
+                barrier.wait()
+                return [{'id': name}]
+            return search
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCES', [(n, waiting(n)) for n in ('a', 'b', 'c')])
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCE_TIMEOUT', 30)
+        db = get_db()
+        results, timings = app_module.run_retrieval(db, {})
+        db.close()
+        assert results == {'a': [{'id': 'a'}], 'b': [{'id': 'b'}], 'c': [{'id': 'c'}]}
+        assert all(ms is not None for ms in timings.values())
+        print("✓ ソースを並行に検索")
+    
+    def test_timeout_interrupts_slow_source(self, monkeypatch):
+        """制限時間を超えたソースはクエリを中断して結果なしにし、他のソースの結果は返す"""
+        import app as app_module
+        interrupted = threading.Event()
+        def runaway(db, req):
+            try:
+                db.execute('''
+                    WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+                    SELECT COUNT(*) FROM (SELECT x FROM c LIMIT 1000000000)
+                ''').fetchone()
+            except sqlite3.OperationalError:
+                interrupted.set()
+                raise
+            return [{'id': 'late'}]
+        def fast(db, req):
+            return [dict(r) for r in db.execute('SELECT id FROM industries ORDER BY id LIMIT 1')]
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCES', [('slow', runaway), ('fast', fast)])
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCE_TIMEOUT', 0.2)
+        db = get_db()
+        results, timings = app_module.run_retrieval(db, {})
+        db.close()
+        assert results['slow'] == [] and timings['slow'] is None
+        assert results['fast'] and timings['fast'] is not None
+        assert interrupted.wait(2)
+        print("✓ 時間切れのソースを中断")
+    
+    def test_worker_connections_are_read_only(self, monkeypatch):
+        """ワーカーの接続では書き込みできない"""
+        import app as app_module
+        def writer(db, req):
+            db.execute("UPDATE industries SET name = name")
+            return []
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCES', [('writer', writer)])
+        db = get_db()
+        with pytest.raises(sqlite3.OperationalError, match='readonly'):
+            app_module.run_retrieval(db, {})
+        db.close()
+        print("✓ 読み取り専用接続で検索")
+
+# ========== 検索結果キャッシュテスト ==========
+
+class TestRetrievalCache:
+    """検索結果のLRUキャッシュとコンテンツバージョンによる無効化のテスト"""
+    
+    @pytest.fixture
+    def counted(self, monkeypatch):
+        """run_retrieval（DBの検索）の呼び出し回数を数える"""
+        import app as app_module
+        app_module.retrieval_cache.clear()
+        calls = []
+        original = app_module.run_retrieval
+        def counting(db, req):
+            calls.append(req['keywords'])
+            return original(db, req)
+        monkeypatch.setattr(app_module, 'run_retrieval', counting)
+        return calls
+    
+    def test_repeated_query_hits_cache(self, counted):
+        """同じキーワード・業種の検索は2回目からDBを検索しない"""
+        import app as app_module
+        db = get_db()
+        industry_id = db.execute('SELECT id FROM industries LIMIT 1').fetchone()[0]
+        first = app_module.search_relevant_content(db, '口コミ返信のコツ', industry_id)
+        second = app_module.search_relevant_content(db, '口コミ返信 の コツ？', industry_id)
+        db.close()
+        assert len(counted) == 1
+        assert first['cached'] is False and second['cached'] is True
+        assert second['usecases'] == first['usecases'] and second['timings'] == {}
+        print("✓ 2回目の検索はキャッシュから返す")
+    
+    def test_scope_is_part_of_key(self, counted):
+        """業種・管理者かが違う検索はキャッシュを共有しない"""
+        import app as app_module
+        db = get_db()
+        industries = [r[0] for r in db.execute('SELECT id FROM industries ORDER BY id LIMIT 2')]
+        app_module.search_relevant_content(db, '口コミ返信', industries[0])
+        app_module.search_relevant_content(db, '口コミ返信', industries[1])
+        app_module.search_relevant_content(db, '口コミ返信', None, is_admin=True)
+        db.close()
+        assert len(counted) == 3
+        print("✓ アクセス範囲ごとにキャッシュ")
+    
+    def test_content_change_invalidates(self, counted):
+        """ユースケースを追加するとバージョンが上がり、次の検索は新しい結果になる"""
+        import app as app_module
+        db = get_db()
+        industry_id = db.execute('SELECT id FROM industries LIMIT 1').fetchone()[0]
+        before = app_module.search_relevant_content(db, 'キャッシュ無効化確認', industry_id)
+        version = app_module.content_version(db)
+        db.execute("INSERT INTO industry_usecases (industry_id, title, description, keywords) VALUES (?, 'キャッシュ無効化確認', '説明', '')",
+                   (industry_id,))
+        db.commit()
+        assert app_module.content_version(db) != version
+        after = app_module.search_relevant_content(db, 'キャッシュ無効化確認', industry_id)
+        db.execute("DELETE FROM industry_usecases WHERE title = 'キャッシュ無効化確認'")
+        db.commit()
+        db.close()
+        assert before['usecases'] == [] and after['cached'] is False
+        assert [u['title'] for u in after['usecases']] == ['キャッシュ無効化確認']
+        print("✓ コンテンツの更新でキャッシュを無効化")
+    
+    def test_lru_eviction(self):
+        """上限を超えると最も使われていないエントリから削除する"""
+        import app as app_module
+        cache = app_module.RetrievalCache(2)
+        cache.put('a', '1', 'A')
+        cache.put('b', '1', 'B')
+        assert cache.get('a', '1') == 'A'
+        cache.put('c', '1', 'C')
+        assert cache.get('b', '1') is None
+        assert cache.get('a', '1') == 'A' and cache.get('c', '1') == 'C'
+        assert cache.get('a', '2') is None  # バージョンが変わったエントリは使わない
+        assert cache.stats() == {'entries': 1, 'hits': 3, 'misses': 2}
+        print("✓ LRUで上限を維持")
+    
+    def test_timed_out_results_not_cached(self, monkeypatch, counted):
+        """時間切れのソースがある結果はキャッシュしない"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCES', [('videos', lambda db, req: time.sleep(0.5) or [])])
+        monkeypatch.setattr(app_module, 'RETRIEVAL_SOURCE_TIMEOUT', 0.05)
+        db = get_db()
+        app_module.search_relevant_content(db, '時間切れ確認', None, is_admin=True)
+        result = app_module.search_relevant_content(db, '時間切れ確認', None, is_admin=True)
+        db.close()
+        assert len(counted) == 2 and result['cached'] is False
+        print("✓ 時間切れの結果はキャッシュしない")
+    
+    def test_preview_endpoint(self, hotel_client, counted):
+        """プレビューAPIはLLMを呼ばずに関連コンテンツを返し、検索結果キャッシュを使う"""
+        first = hotel_client.get('/api/chat/preview?q=口コミ返信').get_json()
+        second = hotel_client.get('/api/chat/preview?q=口コミ返信').get_json()
+        assert first['success'] and first['cached'] is False and second['cached'] is True
+        assert any('口コミ' in u['title'] for u in first['usecases'])
+        assert len(counted) == 1
+        assert hotel_client.get('/api/chat/preview?q=').status_code == 400
+        print("✓ プレビューAPI")
+
+# ========== 全体検索APIテスト ==========
+
+class TestGlobalSearch:
+    """/api/search（検索インデックス・アクセス制御・ハイライト・ファセット・ページング）のテスト"""
+    
+    @pytest.fixture
+    def search_data(self):
+        """宿泊業カテゴリー・小売業カテゴリーの動画、セグメント、テナント別のQ&Aを用意"""
+        import app as app_module
+        db = get_db()
+        hotel_cat = db.execute("SELECT id FROM categories WHERE name = '宿泊業向けAI活用'").fetchone()[0]
+        retail_cat = db.execute("SELECT id FROM categories WHERE name = '小売業向けAI活用'").fetchone()[0]
+        hotel_user = db.execute("SELECT id, tenant_id FROM users WHERE username = 'hotel_tanaka'").fetchone()
+        retail_user = db.execute("SELECT id, tenant_id FROM users WHERE username = 'retail_yamada'").fetchone()
+        db.execute("""INSERT INTO videos (id, title, description, filename, category_id)
+                      VALUES (985, '朝食会場のAI案内', 'ビュッフェの混雑を予測します', 's1.mp4', ?)""", (hotel_cat,))
+        db.execute("""INSERT INTO videos (id, title, description, filename, category_id)
+                      VALUES (986, '店舗の朝食需要予測', '小売向けの事例', 's2.mp4', ?)""", (retail_cat,))
+        db.executemany("""INSERT INTO video_transcripts (video_id, content, content_type, timestamp_start, timestamp_end)
+                          VALUES (985, ?, 'segment', ?, ?)""",
+                       [('まずはフロントの準備から始めます。', 0.0, 30.0),
+                        ('次に朝食会場の混雑状況をAIで予測します。', 95.0, 120.0)])
+        cursor = db.execute("INSERT INTO video_questions (video_id, user_id, tenant_id, question_text) VALUES (985, ?, ?, ?)",
+                            (hotel_user['id'], hotel_user['tenant_id'], '朝食の混雑予測は何日前から可能ですか'))
+        hotel_question = cursor.lastrowid
+        db.execute("INSERT INTO video_questions (video_id, user_id, tenant_id, question_text) VALUES (985, ?, ?, ?)",
+                   (retail_user['id'], retail_user['tenant_id'], '朝食の他社事例はありますか'))
+        db.commit()
+        app_module.sync_search_index(db)
+        db.close()
+        yield {'hotel_question': hotel_question, 'hotel_user': hotel_user['id']}
+        db = get_db()
+        db.execute('DELETE FROM video_answers WHERE question_id IN (SELECT id FROM video_questions WHERE video_id = 985)')
+        db.execute('DELETE FROM video_questions WHERE video_id = 985')
+        db.execute('DELETE FROM video_transcripts WHERE video_id = 985')
+        db.execute('DELETE FROM videos WHERE id IN (985, 986)')
+        db.commit()
+        db.close()
+    
+    def test_tokens_and_expression(self):
+        """日本語は2文字ずつ、英数字は単語で索引し、検索語はすべてを含む条件にする"""
+        import app as app_module
+        assert app_module.search_tokens('予約管理とAI') == '予約 約管 管理 理と と ai'
+        expression, terms = app_module.search_match_expression('予約　ＡＩ 茶')
+        assert expression == '"予約" AND "ai"* AND "茶"*'
+        assert terms == ['予約', 'ai', '茶']
+        print("✓ 検索語をインデックスの語に変換")
+    
+    def test_two_char_word_uses_index(self, hotel_client, search_data):
+        """2文字の語でも動画・セグメント（再生位置付き）・Q&Aが見つかり、一致部分をハイライトする"""
+        data = hotel_client.get('/api/search?q=朝食').get_json()
+        assert data['success'] is True
+        by_type = {}
+        for r in data['results']:
+            by_type.setdefault(r['type'], []).append(r)
+        assert [r['id'] for r in by_type['video']] == [985]
+        assert by_type['video'][0]['snippet'] == '<mark>朝食</mark>会場のAI案内'  # 説明文に一致しなければタイトル
+        segment = by_type['segment'][0]
+        assert segment['timestamp_start'] == 95.0 and segment['title'] == '朝食会場のAI案内'
+        assert '<mark>朝食</mark>会場' in segment['snippet'] and segment['url'].startswith('/watch/')
+        assert [r['id'] for r in by_type['qa']] == [search_data['hotel_question']]
+        print("✓ 2文字の語をインデックスで検索")
+    
+    def test_access_control(self, client, search_data):
+        """他業種のカテゴリーの動画、他テナントのQ&Aは返さない"""
+        client.post('/login', json={'username': 'hotel_tanaka', 'password': 'user123'})
+        hotel = client.get('/api/search?q=朝食').get_json()['results']
+        assert {r['video']['id'] for r in hotel} == {985}
+        assert len([r for r in hotel if r['type'] == 'qa']) == 1
+        client.get('/logout')
+        client.post('/login', json={'username': 'retail_yamada', 'password': 'user123'})
+        retail = client.get('/api/search?q=朝食').get_json()['results']
+        assert {r['video']['id'] for r in retail if r['video']} == {986}
+        print("✓ アクセス制御を適用")
+    
+    def test_facets_and_type_filter(self, hotel_client, search_data):
+        """カテゴリー別・種類別の件数を返し、type で絞り込める"""
+        data = hotel_client.get('/api/search?q=朝食').get_json()
+        assert data['facets']['types'] == {'video': 1, 'segment': 1, 'qa': 1}
+        assert data['facets']['categories'] == [{'id': data['results'][0]['category']['id'],
+                                                 'name': '宿泊業向けAI活用', 'count': 3}]
+        filtered = hotel_client.get('/api/search?q=朝食&type=segment').get_json()
+        assert [r['type'] for r in filtered['results']] == ['segment']
+        assert filtered['facets']['types'] == data['facets']['types']  # 種類の件数は type の絞り込みに依存しない
+        print("✓ ファセットと種類の絞り込み")
+    
+    def test_keyset_pagination(self, hotel_client, search_data):
+        """next_cursor で重複・欠落なく次のページを取得できる"""
+        full = [(r['type'], r['id']) for r in hotel_client.get('/api/search?q=朝食').get_json()['results']]
+        pages = []
+        url = '/api/search?q=朝食&per_page=1'
+        while url:
+            data = hotel_client.get(url).get_json()
+            pages.extend((r['type'], r['id']) for r in data['results'])
+            url = f"/api/search?q=朝食&per_page=1&cursor={data['next_cursor']}" if data['next_cursor'] else None
+        assert pages == full and len(full) == 3
+        print("✓ キーセットページング")
+    
+    def test_index_follows_changes(self, hotel_client, search_data):
+        """回答の追加はQ&Aスレッドに、動画の削除は検索結果に反映される"""
+        db = get_db()
+        db.execute("INSERT INTO video_answers (question_id, user_id, answer_text) VALUES (?, ?, '三日前からの予測に対応しています')",
+                   (search_data['hotel_question'], search_data['hotel_user']))
+        db.commit()
+        db.close()
+        data = hotel_client.get('/api/search?q=三日前').get_json()
+        assert [(r['type'], r['id']) for r in data['results']] == [('qa', search_data['hotel_question'])]
+        assert '<mark>三日前</mark>' in data['results'][0]['snippet']
+        db = get_db()
+        db.execute('DELETE FROM videos WHERE id = 985')
+        db.commit()
+        db.close()
+        assert hotel_client.get('/api/search?q=ビュッフェ').get_json()['results'] == []
+        print("✓ インデックスを更新に追従")
+    
+    def test_qa_post_does_not_bump_content_version(self, hotel_client, search_data):
+        """Q&Aの投稿は全体検索のキャッシュだけを無効にし、チャットのキャッシュ（content_version）は変えない"""
+        import app as app_module
+        assert hotel_client.get('/api/search?q=五日前').get_json()['results'] == []
+        db = get_db()
+        version = app_module.content_version(db)
+        search_version = app_module.content_version(db, 'search_version')
+        db.execute("INSERT INTO video_answers (question_id, user_id, answer_text) VALUES (?, ?, '五日前から予測できます')",
+                   (search_data['hotel_question'], search_data['hotel_user']))
+        db.commit()
+        app_module.sync_search_index(db)
+        assert app_module.content_version(db) == version
+        assert app_module.content_version(db, 'search_version') != search_version
+        db.close()
+        results = hotel_client.get('/api/search?q=五日前').get_json()['results']
+        assert [(r['type'], r['id']) for r in results] == [('qa', search_data['hotel_question'])]
+        print("✓ Q&Aの投稿はcontent_versionを変えない")
+    
+    def test_invalid_parameters(self, hotel_client):
+        """検索語なし・不正な type / cursor は400"""
+        assert hotel_client.get('/api/search?q=').status_code == 400
+        assert hotel_client.get('/api/search?q=朝食&type=unknown').status_code == 400
+        assert hotel_client.get('/api/search?q=朝食&cursor=abc').status_code == 400
+        print("✓ 不正なパラメータを拒否")
+    
+    def test_search_caps_inline_queue_drain(self, monkeypatch):
+        """検索リクエストはインデックス更新キューの先頭だけを処理し、残りはバックグラウンドに回す"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'INLINE_INDEX_SYNC_LIMIT', 3)
+        started = []
+        monkeypatch.setattr(app_module, '_drain_index_queues', started.append)
+        db = get_db()
+        app_module.sync_search_index(db)
+        db.executemany("INSERT INTO search_queue (kind, ref_id) VALUES ('video', ?)", [(i,) for i in range(900, 910)])
+        db.commit()
+        app_module.search_content(db, '朝食', None, True, 'super_admin', None)
+        remaining = db.execute('SELECT COUNT(*) FROM search_queue').fetchone()[0]
+        time.sleep(0.1)
+        app_module.sync_search_index(db)
+        db.close()
+        assert remaining == 7
+        assert len(started) == 1
+        print("✓ 検索リクエストではキューの先頭だけを処理")
+
+# ========== タイトル補完テスト ==========
+
+class TestSuggest:
+    """/api/suggest（漢字・かな・ローマ字の前方一致インデックス）のテスト"""
+    
+    @pytest.fixture
+    def suggest_videos(self):
+        db = get_db()
+        hotel_cat = db.execute("SELECT id FROM categories WHERE name = '宿泊業向けAI活用'").fetchone()[0]
+        retail_cat = db.execute("SELECT id FROM categories WHERE name = '小売業向けAI活用'").fetchone()[0]
+        db.execute("""INSERT INTO videos (id, title, filename, category_id, slug)
+                      VALUES (987, 'ホテルの予約管理入門', 'g1.mp4', ?, 'hoteru-no-yoyaku-kanri-nyuumon')""", (hotel_cat,))
+        db.execute("INSERT INTO videos (id, title, filename, category_id) VALUES (988, '予約管理', 'g2.mp4', NULL)")
+        db.execute("INSERT INTO videos (id, title, filename, category_id) VALUES (989, '予約の在庫連携', 'g3.mp4', ?)",
+                   (retail_cat,))
+        db.commit()
+        db.close()
+        yield
+        db = get_db()
+        db.execute('DELETE FROM videos WHERE id IN (987, 988, 989)')
+        db.commit()
+        db.close()
+    
+    def suggest(self, client, q):
+        return [(s['type'], s['id']) for s in client.get(f'/api/suggest?q={q}').get_json()['suggestions']]
+    
+    def test_keys_cover_readings(self):
+        """表記・ひらがな・ローマ字のキーを各語の先頭から作る"""
+        import app as app_module
+        keys = dict(app_module.suggest_keys('ホテルの予約管理', 'hoteru-no-yoyaku-kanri'))
+        assert keys['ほてるの予約管理'] == 0 and keys['hoterunoyoyakukanri'] == 0
+        assert keys['予約管理'] == 2 and keys['よやくかんり'] == 2 and keys['yoyakukanri'] == 2
+        print("✓ 読み・ローマ字のキーを作成")
+    
+    def test_prefix_in_any_script(self, hotel_client, suggest_videos):
+        """漢字・ひらがな・カタカナ・ローマ字・スラッグのどれでも補完でき、タイトル先頭の一致を優先する"""
+        for q in ('予約', 'よやく', 'ヨヤク', 'yoyak', 'YOYAKU'):
+            videos = [r for r in self.suggest(hotel_client, q) if r[0] == 'video']
+            assert videos[:2] == [('video', 988), ('video', 987)], q
+        assert self.suggest(hotel_client, 'hoteru-no-yo') == [('video', 987)]
+        assert self.suggest(hotel_client, 'しゅくはくぎょう')[0][0] == 'category'
+        print("✓ 表記によらず前方一致で補完")
+    
+    def test_access_filtering(self, hotel_client, suggest_videos):
+        """閲覧できないカテゴリーの動画・カテゴリーは候補に出さない"""
+        results = self.suggest(hotel_client, 'yoyaku')
+        assert ('video', 989) not in results
+        assert self.suggest(hotel_client, 'kourigyou') == []
+        assert self.suggest(hotel_client, 'shukuhakugyou') != []
+        print("✓ 業種でアクセス制御")
+    
+    def test_incremental_refresh(self, suggest_videos):
+        """変更された項目だけを作り直す"""
+        import app as app_module
+        db = get_db()
+        app_module.suggest_index.refresh(db)
+        assert app_module.suggest_index.refresh(db) == 0
+        db.execute("UPDATE videos SET title = 'チェックアウト業務' WHERE id = 988")
+        db.commit()
+        assert app_module.suggest_index.refresh(db) == 1
+        db.close()
+        everything = frozenset(range(1000))
+        assert ('video', 988) in [(s['type'], s['id']) for s in app_module.suggest_index.lookup('chekkuauto', everything)]
+        assert ('video', 988) not in [(s['type'], s['id']) for s in app_module.suggest_index.lookup('よやくかんり', everything)]
+        print("✓ 差分だけ作り直す")
+    
+    def test_incremental_refresh_matches_full_build(self, suggest_videos):
+        """差分更新後のキー配列は、最初から作り直した配列と同じ（ソート済み）"""
+        import app as app_module
+        db = get_db()
+        app_module.suggest_index.refresh(db)
+        db.execute("UPDATE videos SET title = 'ハウスキーピング入門' WHERE id = 988")
+        db.commit()
+        app_module.suggest_index.refresh(db)
+        fresh = app_module.SuggestIndex()
+        fresh.refresh(db)
+        db.close()
+        assert app_module.suggest_index._keys == fresh._keys == sorted(fresh._keys)
+        print("✓ 差分更新と全体構築の結果が一致")
+
+# ========== 外部ナレッジの差分更新テスト ==========
+
+class TestKnowledgeDiffIngestion:
+    """外部ナレッジの再アップロード時に変わったセクションだけを反映するテスト"""
+    
+    SOURCE = 'diff_ingestion_test.md'
+    
+    @staticmethod
+    def markdown(sections):
+        return '\n'.join(f"## {title}\n{body}\n" for title, body in sections)
+    
+    @pytest.fixture
+    def sections(self):
+        yield [
+            ('予約対応', '予約の電話対応をAIで自動化し、スタッフの負担を減らす取り組みです。' * 2),
+            ('口コミ返信', '口コミへの返信文をAIで下書きし、担当者が確認してから投稿する運用です。' * 2),
+            ('清掃計画', '客室の清掃計画をAIで作成し、チェックアウト時刻に合わせて割り当てます。' * 2),
+        ]
+        db = get_db()
+        db.execute('DELETE FROM external_knowledge WHERE source_file = ?', (self.SOURCE,))
+        db.commit()
+        db.close()
+    
+    def upload(self, client, sections):
+        import io
+        data = {'file': (io.BytesIO(self.markdown(sections).encode('utf-8')), self.SOURCE), 'industry_id': '1'}
+        response = client.post('/api/admin/knowledge/upload', data=data, content_type='multipart/form-data')
+        assert response.status_code == 200
+        return response.get_json()
+    
+    def rows(self):
+        db = get_db()
+        rows = {r['section_key']: (r['id'], r['content']) for r in db.execute(
+            'SELECT id, section_key, content FROM external_knowledge WHERE source_file = ?', (self.SOURCE,))}
+        db.close()
+        return rows
+    
+    def test_reupload_unchanged_writes_nothing(self, admin_client, sections):
+        """同じファイルの再アップロードでは行もコンテンツのバージョンも変わらない"""
+        import app as app_module
+        first = self.upload(admin_client, sections)
+        assert first['diff'] == {'added': 3, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        before = self.rows()
+        db = get_db()
+        version = app_module.content_version(db)
+        db.close()
+        second = self.upload(admin_client, sections)
+        assert second['diff'] == {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 3}
+        assert second['sections'] == 3
+        db = get_db()
+        assert app_module.content_version(db) == version
+        db.close()
+        assert self.rows() == before
+        print("✓ 変更のない再アップロードは書き込まない")
+    
+    def test_reupload_applies_only_changes(self, admin_client, sections):
+        """編集・追加・削除したセクションだけを反映し、他の行のIDは変わらない"""
+        self.upload(admin_client, sections)
+        before = self.rows()
+        edited = [
+            sections[0],
+            ('口コミ返信', '口コミへの返信文をAIで下書きし、多言語の口コミにも同じ手順で対応します。' * 2),
+            ('多言語案内', '館内案内を多言語に翻訳し、外国人のお客様からの質問にAIが回答します。' * 2),
+        ]
+        result = self.upload(admin_client, edited)
+        assert result['diff'] == {'added': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1}
+        after = self.rows()
+        assert set(after) == {'予約対応', '口コミ返信', '多言語案内'}
+        assert after['予約対応'] == before['予約対応']
+        assert after['口コミ返信'][0] == before['口コミ返信'][0]
+        assert '多言語の口コミ' in after['口コミ返信'][1]
+        print("✓ 変わったセクションだけを追加・更新・削除")
+    
+    def test_duplicate_titles_and_legacy_rows(self, sections):
+        """重複する見出しは出現順でキーを付け、キーのない既存行は置き換える"""
+        import app as app_module
+        db = get_db()
+        db.execute('INSERT INTO external_knowledge (industry_id, title, content, source_file) VALUES (1, ?, ?, ?)',
+                   ('予約対応', '古い形式で登録した行です。', self.SOURCE))
+        db.commit()
+        parsed = app_module.parse_markdown_sections(self.markdown(sections + [sections[0]]), self.SOURCE)
+        diff = app_module.sync_knowledge_sections(db, self.SOURCE, 1, parsed)
+        keys = [r[0] for r in db.execute(
+            'SELECT section_key FROM external_knowledge WHERE source_file = ? ORDER BY id', (self.SOURCE,))]
+        db.close()
+        assert diff == {'added': 4, 'updated': 0, 'deleted': 1, 'unchanged': 0}
+        assert keys == ['予約対応', '口コミ返信', '清掃計画', '予約対応#2']
+        print("✓ 重複する見出しとキーのない行を処理")
+    
+    def test_premigration_rows_not_rewritten(self, sections):
+        """ハッシュのない既存行は、キーワードの並びが違っても本文が同じなら書き換えない"""
+        import app as app_module
+        db = get_db()
+        parsed = app_module.parse_markdown_sections(self.markdown(sections), self.SOURCE)
+        app_module.sync_knowledge_sections(db, self.SOURCE, 1, parsed)
+        # マイグレーション027より前の状態（ハッシュなし、キーワードの並びが異なる）を再現
+        db.execute("UPDATE external_knowledge SET content_hash = NULL, keywords = 'AI,旧形式' WHERE source_file = ?",
+                   (self.SOURCE,))
+        db.commit()
+        version = app_module.content_version(db)
+        diff = app_module.sync_knowledge_sections(db, self.SOURCE, 1, parsed)
+        assert diff == {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 3}
+        assert app_module.content_version(db) == version
+        
+        edited = app_module.parse_markdown_sections(
+            self.markdown([sections[0], sections[1], ('清掃計画', '清掃計画を見直しました。' * 10)]), self.SOURCE)
+        diff = app_module.sync_knowledge_sections(db, self.SOURCE, 1, edited)
+        hashes = [r[0] for r in db.execute(
+            'SELECT content_hash FROM external_knowledge WHERE source_file = ? ORDER BY id', (self.SOURCE,))]
+        db.close()
+        assert diff == {'added': 0, 'updated': 1, 'deleted': 0, 'unchanged': 2}
+        assert hashes[:2] == [None, None] and hashes[2] is not None
+        print("✓ マイグレーション前の行は本文が変わったときだけ更新")
+    
+    def test_bulk_ingestion_keys_by_filename(self, tmp_path):
+        """一括取り込みはアップロードと同じくファイル名で管理し、同名のファイルはエラーにする"""
+        import add_external_knowledge
+        (tmp_path / 'a').mkdir()
+        (tmp_path / 'b').mkdir()
+        (tmp_path / 'a' / self.SOURCE).write_text('## 見出し\n本文', encoding='utf-8')
+        files = add_external_knowledge.collect_knowledge_files(
+            [tmp_path / 'a', tmp_path / 'a' / self.SOURCE], '*.md')
+        assert files == [(tmp_path / 'a' / self.SOURCE, self.SOURCE)]
+        (tmp_path / 'b' / self.SOURCE).write_text('## 見出し\n別の本文', encoding='utf-8')
+        with pytest.raises(ValueError):
+            add_external_knowledge.collect_knowledge_files([tmp_path], '*.md')
+        print("✓ 一括取り込みはファイル名で管理し、同名のファイルを拒否")
+    
+    def test_section_hash_stable_across_processes(self):
+        """キーワードの並び（内容のハッシュ）はPYTHONHASHSEEDに依存しない"""
+        import subprocess
+        code = ("import app; print(app.extract_knowledge_keywords("
+                "'**送迎**と**記録**の業務をAIで効率化し、介護職員の負担を減らす。ケアプランも作成。'))")
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+            outputs.add(result.stdout.strip().splitlines()[-1])
+        assert len(outputs) == 1
+        print("✓ キーワードの並びはプロセスによらず同じ")
+
+# ========== ナレッジのキーワード抽出テスト ==========
+
+class TestKnowledgeKeywordMatcher:
+    """複数キーワードの一括検索とキーワード抽出のテスト"""
+    
+    def test_matches_same_as_substring_search(self):
+        """重なり・包含のあるキーワードも、1つずつ `in` で調べた結果と同じになる"""
+        import random
+        import app as app_module
+        rng = random.Random(0)
+        for keywords in (['介護', '介護職員', '職員', 'AI', '護職'], ['ab', 'bc', 'abc', 'c', 'ca', 'bca']):
+            matcher = app_module.KeywordMatcher(keywords)
+            pieces = keywords + sorted(set(''.join(keywords))) + ['x']
+            for _ in range(500):
+                text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 10)))
+                assert matcher.find(text) == [kw for kw in keywords if kw in text], text
+        print("✓ 部分文字列検索と同じ結果")
+    
+    def test_keywords_are_stable(self):
+        """抽出結果の順序が一定（内容のハッシュが実行ごとに変わらない）"""
+        import app as app_module
+        content = '**予約対応**では介護職員の人手不足をAIとシステムで補います。**口コミ**にも対応。'
+        keywords = app_module.extract_knowledge_keywords(content)
+        assert keywords == '予約対応,口コミ,介護,AI,システム,介護職員,人手不足'
+        assert app_module.extract_knowledge_keywords('キーワードを含まない文章です。') == ''
+        print("✓ キーワードを一定の順序で抽出")
+
 # ========== テスト実行 ==========
 
 if __name__ == '__main__':